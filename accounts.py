@@ -0,0 +1,192 @@
+# accounts.py
+"""
+複数ユーザーのモード（STUDY_USERS_DIR を設定した場合だけ有効。設定しなければ従来どおり STUDY_DB_PATH の1ユーザー）
+- ユーザー（名前・パスワードのハッシュ）は STUDY_USERS_DIR/accounts.db に保存する
+- 各ユーザーのカテゴリ・教材・セッション・運動の記録は STUDY_USERS_DIR/users/<ユーザーID>.db に分けて保存する。
+  書き込みロックはファイルごとなので、ユーザーが増えても1つのファイルのロックを取り合わない
+- リクエストの間は db.set_database() でログイン中のユーザーのファイルに切り替える。
+  db のプール・cache.py のキャッシュ・進行中のセッション・/events もファイルごとに分かれる
+- 各ファイルのスキーマの移行は、プロセスごとに最初に使うときに1回だけ行う
+
+使い方:
+    python accounts.py add <名前>   # ユーザーを追加する（パスワードを入力する）
+    python accounts.py list
+"""
+import argparse
+import getpass
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from flask import g, redirect, request, session, url_for
+from werkzeug.security import check_password_hash, generate_password_hash
+
+import db
+from db import use_database
+
+USERS_DIR = os.getenv("STUDY_USERS_DIR", "")
+ALLOW_SIGNUP = os.getenv("STUDY_ALLOW_SIGNUP", "0") == "1"
+MIN_PASSWORD_LENGTH = 8
+
+# ログインしていなくても使えるページ（監視用を含む）
+PUBLIC_ENDPOINTS = {"login", "register", "logout", "metrics", "internal_stats", "static"}
+
+_ready = set()  # このプロセスで移行を確認したユーザーのファイル
+_ready_lock = threading.Lock()
+
+
+def enabled():
+    return bool(USERS_DIR)
+
+
+def accounts_path():
+    return os.path.join(USERS_DIR, "accounts.db")
+
+
+def user_database_path(user_id):
+    return os.path.join(USERS_DIR, "users", f"{int(user_id)}.db")
+
+
+def init():
+    """ユーザーのテーブルとフォルダを用意する"""
+    os.makedirs(os.path.join(USERS_DIR, "users"), exist_ok=True)
+    with use_database(accounts_path()), db.connect() as conn:
+        # ID は使い回さない（削除したユーザーのファイルを別のユーザーが使わないように）
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL UNIQUE,
+                password_hash TEXT NOT NULL,
+                created_at INTEGER NOT NULL
+            )
+        ''')
+
+
+def get_user(user_id):
+    """(ID, 名前) を取得（なければ None）"""
+    with use_database(accounts_path()), db.connect() as conn:
+        return conn.execute('SELECT id, name FROM users WHERE id = ?', (user_id,)).fetchone()
+
+
+def list_users():
+    """(ID, 名前, 作成日時) のリスト"""
+    with use_database(accounts_path()), db.connect() as conn:
+        return conn.execute('SELECT id, name, created_at FROM users ORDER BY id').fetchall()
+
+
+def user_database_paths():
+    """すべてのユーザーのファイル（メンテナンス用）"""
+    return [user_database_path(user_id) for user_id, _, _ in list_users()]
+
+
+def open_user_database(user_id):
+    """
+    ユーザーのファイルを返す（このプロセスで初めて使う場合は、ユーザーの存在を確認してスキーマを移行する）
+    :return: ファイルのパス。ユーザーがいなければ None
+    """
+    path = user_database_path(user_id)
+    if path in _ready:
+        return path
+    if get_user(user_id) is None:
+        return None
+    from database import init_db
+    with _ready_lock:
+        if path not in _ready:
+            with use_database(path):
+                init_db()
+            _ready.add(path)
+    return path
+
+
+def create_user(name, password):
+    """
+    ユーザーを追加し、そのユーザーのファイルを作る
+    :return: ユーザーの ID。名前が使われていれば None
+    """
+    try:
+        with use_database(accounts_path()), db.transaction(immediate=True) as conn:
+            cursor = conn.execute(
+                'INSERT INTO users (name, password_hash, created_at) VALUES (?, ?, ?)',
+                (name, generate_password_hash(password), int(time.time())),
+            )
+            user_id = cursor.lastrowid
+    except sqlite3.IntegrityError:
+        return None
+    open_user_database(user_id)
+    return user_id
+
+
+def authenticate(name, password):
+    """:return: ユーザーの ID（名前かパスワードが違えば None）"""
+    with use_database(accounts_path()), db.connect() as conn:
+        row = conn.execute('SELECT id, password_hash FROM users WHERE name = ?', (name,)).fetchone()
+    if row and check_password_hash(row[1], password):
+        return row[0]
+    return None
+
+
+def init_app(app):
+    """複数ユーザーのモードで、リクエストごとにログイン中のユーザーのファイルに切り替える"""
+    if not enabled():
+        return
+    init()
+
+    @app.before_request
+    def select_user_database():
+        user_id = session.get("user_id")
+        path = open_user_database(user_id) if user_id is not None else None
+        if path is None:
+            if user_id is not None:
+                # 削除されたユーザー
+                session.pop("user_id", None)
+            if request.endpoint in PUBLIC_ENDPOINTS:
+                return None
+            return redirect(url_for("login", next=request.full_path.rstrip("?")))
+        g.database_token = db.set_database(path)
+        return None
+
+    @app.teardown_request
+    def reset_user_database(exc):
+        token = g.pop("database_token", None)
+        if token is None:
+            return
+        try:
+            db.reset_database(token)
+        except ValueError:
+            # ストリーミングのレスポンスなどで別のコンテキストから呼ばれた場合
+            db.set_database(None)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="複数ユーザーのモードのユーザー管理")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    add_parser = subparsers.add_parser("add", help="ユーザーを追加する")
+    add_parser.add_argument("name")
+    subparsers.add_parser("list", help="ユーザーの一覧")
+    args = parser.parse_args(argv)
+
+    if not enabled():
+        print("STUDY_USERS_DIR を設定してください。")
+        return 1
+    init()
+    if args.command == "add":
+        password = getpass.getpass("パスワード: ")
+        if len(password) < MIN_PASSWORD_LENGTH:
+            print(f"パスワードは{MIN_PASSWORD_LENGTH}文字以上にしてください。")
+            return 1
+        user_id = create_user(args.name, password)
+        if user_id is None:
+            print(f"ユーザー {args.name} は既に存在します。")
+            return 1
+        print(f"ユーザー {args.name}（ID {user_id}）を追加しました: {user_database_path(user_id)}")
+        return 0
+
+    for user_id, name, created_at in list_users():
+        print(f"{user_id}\t{name}\t{time.strftime('%Y-%m-%d %H:%M', time.localtime(created_at))}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
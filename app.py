@@ -1,26 +1,89 @@
 # app.py
-from flask import Flask
-from routes import configure_routes
-from database import init_db
-from datetime import datetime
+"""
+アプリケーションの作成（create_app）と開発用サーバーの起動
+
+本番環境では wsgi.py を WSGI サーバーから読み込む（README.md を参照）。
+"""
+import os
+import secrets
 import signal
 import sys
-import os
 
-import secrets
+from flask import Flask
+
+SECRET_KEY_FILE = "secret_key"  # instance フォルダに保存する秘密鍵のファイル名
+
+
+def load_secret_key(app):
+    """
+    セッション・フラッシュメッセージの署名に使う秘密鍵を読み込む
+    - 環境変数 STUDY_SECRET_KEY があればそれを使う
+    - なければ instance フォルダのファイルから読み込む（初回は作成する）。
+      複数のワーカーが同時に起動しても、最初に作成したワーカーの鍵を全員が使う
+    """
+    key = os.getenv("STUDY_SECRET_KEY")
+    if key:
+        return key
+    os.makedirs(app.instance_path, exist_ok=True)
+    path = os.path.join(app.instance_path, SECRET_KEY_FILE)
+    if not os.path.exists(path):
+        # 一時ファイルに書いてからリンクするので、他のワーカーが書きかけのファイルを読むことはない
+        tmp_path = f"{path}.{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            f.write(secrets.token_hex(32))
+        os.chmod(tmp_path, 0o600)
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+    with open(path) as f:
+        return f.read().strip()
+
+
+def create_app():
+    """
+    アプリケーションを作成する
+    - スキーマの移行は BEGIN IMMEDIATE で1つのプロセスだけが行い、他のワーカーは最新になったことを確認するだけ
+    - 移行に使った接続は閉じるので、WSGI サーバーが fork する前に呼んでも接続を共有しない
+    """
+    import accounts
+    import db
+    import instrumentation
+    import maintenance
+    from database import init_db
+    from routes import configure_routes
+    from utils import from_epoch
+
+    app = Flask(__name__)
+    app.secret_key = load_secret_key(app)
+
+    @app.template_filter('datetimeformat')
+    def datetimeformat(value, fmt="default"):
+        dt = from_epoch(value)
+        if fmt == "iso":
+            return dt.isoformat()
+        return dt.strftime('%Y年%m月%d日 %H:%M')
+
+    # Configure routes
+    configure_routes(app)
+
+    # データベースアクセスの計測（/metrics・遅いクエリの出力）
+    instrumentation.init_app(app)
 
-app = Flask(__name__)
-app.secret_key = secrets.token_hex(16)
+    if accounts.enabled():
+        # 複数ユーザーのモード: ユーザーごとのファイルはログイン後に最初に使うときに移行する
+        accounts.init_app(app)
+    else:
+        # テーブル（集計テーブルを含む）を用意する
+        init_db()
+    db.configure()
 
-@app.template_filter('datetimeformat')
-def datetimeformat(value, fmt="default"):
-    dt = datetime.fromisoformat(value)
-    if fmt == "iso":
-        return dt.isoformat()
-    return dt.strftime('%Y年%m月%d日 %H:%M')
+    # 古い記録の保管・VACUUM などの定期メンテナンス（STUDY_MAINTENANCE_HOURS=0 で無効）
+    maintenance.start_scheduler()
 
-# Configure routes
-configure_routes(app)
+    return app
 
 
 def handle_exit_signal(signum, frame):
@@ -33,9 +96,10 @@ if __name__ == "__main__":
         signal.signal(signal.SIGINT, handle_exit_signal)  # Ctrl+C
         signal.signal(signal.SIGTERM, handle_exit_signal)  # 終了リクエスト
 
+    app = create_app()
     try:
         app.run(debug=True)
     except Exception as e:
         print(f"エラーが発生しました: {e}")
     finally:
-        print("サーバーが停止しました。ポートが解放されたか確認してください。")
\ No newline at end of file
+        print("サーバーが停止しました。ポートが解放されたか確認してください。")
@@ -0,0 +1,112 @@
+# archive.py
+"""
+古いセッション・運動の記録の保管
+- 開始時刻（運動は記録時刻）が STUDY_ARCHIVE_DAYS 日より前の記録を sessions_archive / exercise_sessions_archive に移す
+- ID は変えずに移すので、編集・削除するときは unarchive_*() で元のテーブルに戻してから行う
+- 集計テーブルは保管した分も含めたまま保つ（移すだけなので累計は変わらない）
+- app_meta の archived_before に保管の境界（エポック秒）を記録する。保管したテーブルの行はすべてこれより古い
+- 各テーブルの最も新しい ID の行は移さない（ID の採番が保管した ID と重ならないように）
+"""
+import os
+import time
+from datetime import datetime, timezone
+
+from db import connect, dialect, transaction
+
+ARCHIVE_DAYS = int(os.getenv("STUDY_ARCHIVE_DAYS", "365"))
+MIN_ARCHIVE_DAYS = 60  # 直近の集計（今月・過去30日）は元のテーブルだけを読むので、これより新しい記録は移さない
+BATCH_SIZE = 5000
+
+
+def archived_before():
+    """保管の境界（エポック秒、保管していなければ 0）"""
+    with connect() as conn:
+        row = conn.execute("SELECT value FROM app_meta WHERE key = 'archived_before'").fetchone()
+    return row[0] if row else 0
+
+
+def record_time_text(epoch):
+    """エポック秒を運動の記録時刻と比べられる文字列（UTC）にする"""
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _move(cursor, table, columns, where, params, batch_size):
+    """条件に合う行を batch_size 件まで保管用のテーブルに移す（移した件数を返す）"""
+    cursor.execute(
+        f'SELECT id FROM {table} WHERE {where} AND id < (SELECT MAX(id) FROM {table}) LIMIT ?',
+        (*params, batch_size),
+    )
+    ids = [row[0] for row in cursor.fetchall()]
+    if not ids:
+        return 0
+    placeholders = ','.join('?' * len(ids))
+    cursor.execute(
+        f'INSERT INTO {table}_archive ({columns}) SELECT {columns} FROM {table} WHERE id IN ({placeholders})', ids
+    )
+    cursor.execute(f'DELETE FROM {table} WHERE id IN ({placeholders})', ids)
+    return len(ids)
+
+
+def archive_old_records(days=ARCHIVE_DAYS, batch_size=BATCH_SIZE):
+    """
+    古い記録を保管用のテーブルに移す
+    - 1バッチを1トランザクションで移すので、他の書き込みを長く止めない
+    :return: (移したセッション数, 移した運動の記録数)
+    """
+    days = max(days, MIN_ARCHIVE_DAYS)
+    cutoff = int(time.time()) - days * 24 * 60 * 60
+    with transaction(immediate=True) as conn:
+        # 境界を先に記録する（移している途中でも、境界より古い記録は両方のテーブルから探す）
+        conn.execute(
+            f"UPDATE app_meta SET value = {dialect().greatest('value', '?')} WHERE key = 'archived_before'", (cutoff,)
+        )
+
+    moved_sessions = 0
+    while True:
+        with transaction(immediate=True) as conn:
+            moved = _move(
+                conn.cursor(), 'sessions', 'id, material_id, start_time, end_time',
+                'end_time IS NOT NULL AND start_time < ?', (cutoff,), batch_size,
+            )
+        moved_sessions += moved
+        if moved < batch_size:
+            break
+
+    moved_logs = 0
+    while True:
+        with transaction(immediate=True) as conn:
+            moved = _move(
+                conn.cursor(), 'exercise_sessions', 'id, exercise_id, value, value_type, record_time',
+                'record_time < ?', (record_time_text(cutoff),), batch_size,
+            )
+        moved_logs += moved
+        if moved < batch_size:
+            break
+    return moved_sessions, moved_logs
+
+
+def _unarchive(cursor, table, columns, row_id):
+    cursor.execute(f'INSERT INTO {table} ({columns}) SELECT {columns} FROM {table}_archive WHERE id = ?', (row_id,))
+    if cursor.rowcount == 0:
+        return False
+    cursor.execute(f'DELETE FROM {table}_archive WHERE id = ?', (row_id,))
+    return True
+
+
+def unarchive_session(cursor, session_id):
+    """保管したセッションを sessions に戻す（保管していなければ何もしない）。:return: 戻したか"""
+    return _unarchive(cursor, 'sessions', 'id, material_id, start_time, end_time', session_id)
+
+
+def unarchive_exercise_log(cursor, log_id):
+    """保管した運動の記録を exercise_sessions に戻す（保管していなければ何もしない）。:return: 戻したか"""
+    return _unarchive(cursor, 'exercise_sessions', 'id, exercise_id, value, value_type, record_time', log_id)
+
+
+def counts():
+    """各テーブルの行数（監視・確認用）"""
+    with connect() as conn:
+        return {
+            table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+            for table in ('sessions', 'sessions_archive', 'exercise_sessions', 'exercise_sessions_archive')
+        }
@@ -0,0 +1,314 @@
+# backends.py
+"""
+データベースの種類ごとの違い（接続と SQL の方言）
+- SQLite（既定）: STUDY_DB_PATH のファイル
+- PostgreSQL: STUDY_DATABASE_URL に postgresql://... を設定した場合（psycopg 3 が必要。使うときだけ読み込む）
+
+クエリは SQLite と PostgreSQL の両方で動く SQL で書き、違う部分（日付の計算など）だけ dialect() の関数で作る。
+プレースホルダーは sqlite3 と同じく ? / :name で書く。PostgreSQL では PostgresConnection が %s / %(name)s に置き換え、
+sqlite3 と同じく INSERT / UPDATE / DELETE の前に暗黙にトランザクションを始める。
+BEGIN IMMEDIATE は BEGIN と勧告ロックにして、SQLite の書き込みロックと同じく書き込むトランザクションを1つずつにする。
+"""
+import functools
+import itertools
+import re
+import sqlite3
+
+POSTGRES_SCHEMES = ("postgresql://", "postgres://")
+WRITE_LOCK_KEY = 5_741_921  # BEGIN IMMEDIATE の代わりに取る勧告ロックの番号
+
+
+def is_postgres(path):
+    return path.startswith(POSTGRES_SCHEMES)
+
+
+class SQLiteDialect:
+    """SQLite の SQL"""
+    name = "sqlite"
+    integrity_errors = (sqlite3.IntegrityError,)
+
+    def greatest(self, *args):
+        return f"MAX({', '.join(args)})"
+
+    def least(self, *args):
+        return f"MIN({', '.join(args)})"
+
+    def date_of(self, expr):
+        """'YYYY-MM-DD HH:MM:SS' の文字列の日付部分"""
+        return f"DATE({expr})"
+
+    def add_days(self, date_expr, days):
+        """'YYYY-MM-DD' の文字列に日数を足した日付（'YYYY-MM-DD'）"""
+        return f"DATE({date_expr}, '{int(days):+d} days')"
+
+    def local_day(self, epoch_expr):
+        """エポック秒のローカル時刻の日付（'YYYY-MM-DD'）"""
+        return f"DATE({epoch_expr}, 'unixepoch', 'localtime')"
+
+    def local_day_of_utc(self, expr):
+        """UTC の 'YYYY-MM-DD HH:MM:SS' の文字列のローカル時刻の日付（'YYYY-MM-DD'）"""
+        return f"DATE({expr}, 'localtime')"
+
+    def next_local_midnight(self, epoch_expr):
+        """エポック秒の次のローカル時刻の0時（エポック秒）"""
+        return f"CAST(STRFTIME('%s', DATE({epoch_expr}, 'unixepoch', 'localtime', '+1 day'), 'utc') AS INTEGER)"
+
+    def week_start(self, day_expr):
+        """'YYYY-MM-DD' の週の月曜日"""
+        return f"DATE({day_expr}, 'weekday 0', '-6 days')"
+
+    def now_epoch(self):
+        return "CAST(STRFTIME('%s', 'now') AS INTEGER)"
+
+    def has_relation(self, cursor, name):
+        """テーブルまたはビューがあるか"""
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type IN ('table', 'view') AND name = ?", (name,))
+        return cursor.fetchone() is not None
+
+    def streaming_cursor(self, conn):
+        """結果を少しずつ読むカーソル（sqlite3 のカーソルは fetchmany で必要な分だけ読む）"""
+        return conn.cursor()
+
+    def violates(self, error, constraint):
+        """integrity_errors の例外が constraint（制約・一意インデックスの名前）の違反か"""
+        return f"'{constraint}'" in str(error)
+
+
+class PostgresDialect:
+    """
+    PostgreSQL の SQL
+    - ローカル時刻はセッションのタイムゾーン（PGTZ 環境変数などで設定する）
+    """
+    name = "postgresql"
+
+    @property
+    def integrity_errors(self):
+        import psycopg
+        return (psycopg.IntegrityError,)
+
+    def greatest(self, *args):
+        return f"GREATEST({', '.join(args)})"
+
+    def least(self, *args):
+        return f"LEAST({', '.join(args)})"
+
+    def date_of(self, expr):
+        return f"SUBSTR({expr}, 1, 10)"
+
+    def add_days(self, date_expr, days):
+        return f"TO_CHAR(CAST({date_expr} AS DATE) + {int(days)}, 'YYYY-MM-DD')"
+
+    def local_day(self, epoch_expr):
+        return f"TO_CHAR(TO_TIMESTAMP({epoch_expr}), 'YYYY-MM-DD')"
+
+    def local_day_of_utc(self, expr):
+        return f"TO_CHAR(CAST({expr} AS TIMESTAMP) AT TIME ZONE 'UTC', 'YYYY-MM-DD')"
+
+    def next_local_midnight(self, epoch_expr):
+        return f"CAST(EXTRACT(EPOCH FROM DATE_TRUNC('day', TO_TIMESTAMP({epoch_expr})) + INTERVAL '1 day') AS BIGINT)"
+
+    def week_start(self, day_expr):
+        return f"TO_CHAR(DATE_TRUNC('week', CAST({day_expr} AS DATE)), 'YYYY-MM-DD')"
+
+    def now_epoch(self):
+        return "CAST(EXTRACT(EPOCH FROM NOW()) AS BIGINT)"
+
+    def has_relation(self, cursor, name):
+        cursor.execute("SELECT to_regclass(?) IS NOT NULL", (name,))
+        return bool(cursor.fetchone()[0])
+
+    def streaming_cursor(self, conn):
+        """
+        結果を少しずつ読むカーソル（サーバー側のカーソル）
+        psycopg の通常のカーソルは execute で結果をすべて受け取るので、エクスポートなどの件数の多いクエリに使う
+        """
+        return conn.cursor(server_side=True)
+
+    def violates(self, error, constraint):
+        return error.diag.constraint_name == constraint
+
+
+SQLITE = SQLiteDialect()
+POSTGRES = PostgresDialect()
+
+
+def redact(path):
+    """表示用に URL のパスワードを隠す"""
+    if not is_postgres(path):
+        return path
+    return re.sub(r"://([^:/@]+):[^@]*@", r"://\1:***@", path)
+
+
+def dialect_for(path):
+    return POSTGRES if is_postgres(path) else SQLITE
+
+
+@functools.lru_cache(maxsize=1024)
+def translate(sql):
+    """
+    ? / :name のプレースホルダーを psycopg の %s / %(name)s にする（文字列・コメントの中は変えない）
+    リテラルの % は %% にする
+    """
+    out = []
+    i = 0
+    length = len(sql)
+    while i < length:
+        char = sql[i]
+        if char in ("'", '"'):
+            end = sql.find(char, i + 1)
+            while end != -1 and sql[end + 1:end + 2] == char:
+                end = sql.find(char, end + 2)
+            end = length if end == -1 else end + 1
+            out.append(sql[i:end].replace('%', '%%'))
+            i = end
+        elif sql.startswith('--', i):
+            end = sql.find('\n', i)
+            end = length if end == -1 else end
+            out.append(sql[i:end].replace('%', '%%'))
+            i = end
+        elif char == '?':
+            out.append('%s')
+            i += 1
+        elif char == ':' and i + 1 < length and (sql[i + 1].isalpha() or sql[i + 1] == '_') and sql[i - 1:i] != ':':
+            j = i + 1
+            while j < length and (sql[j].isalnum() or sql[j] == '_'):
+                j += 1
+            out.append(f'%({sql[i + 1:j]})s')
+            i = j
+        elif char == '%':
+            out.append('%%')
+            i += 1
+        else:
+            out.append(char)
+            i += 1
+    return ''.join(out)
+
+
+_WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE')
+
+
+_cursor_names = itertools.count(1)
+
+
+class PostgresCursor:
+    """
+    psycopg のカーソルを sqlite3 のカーソルと同じように使うためのラッパー
+    - server_side=True の場合はサーバー側のカーソル（DECLARE）にして、fetchmany の分だけ受け取る。
+      サーバー側のカーソルはトランザクションの中でしか使えないので、execute の前に BEGIN する
+    """
+
+    def __init__(self, connection, server_side=False):
+        self.connection = connection
+        self.server_side = server_side
+        if server_side:
+            self._cursor = connection.raw.cursor(name=f"study_stream_{next(_cursor_names)}")
+        else:
+            self._cursor = connection.raw.cursor()
+
+    def execute(self, sql, params=None):
+        self.connection.prepare(sql)
+        if sql.strip().upper() in ('BEGIN', 'BEGIN IMMEDIATE'):
+            return self
+        if self.server_side and not self.connection.in_transaction:
+            self.connection.raw.execute('BEGIN')
+        if params:
+            self._cursor.execute(translate(sql), params)
+        else:
+            # パラメータがなければ psycopg はプレースホルダーを処理しないので、そのまま送る
+            self._cursor.execute(sql)
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        self.connection.prepare(sql)
+        self._cursor.executemany(translate(sql), list(seq_of_params))
+        return self
+
+    def fetchone(self):
+        return self._cursor.fetchone() if self._cursor.description else None
+
+    def fetchmany(self, size=None):
+        if not self._cursor.description:
+            return []
+        return self._cursor.fetchmany(size) if size else self._cursor.fetchmany()
+
+    def fetchall(self):
+        return self._cursor.fetchall() if self._cursor.description else []
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        # PostgreSQL では INSERT ... RETURNING id を使う
+        return None
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def close(self):
+        self._cursor.close()
+
+
+class PostgresConnection:
+    """
+    psycopg の接続（autocommit）を sqlite3 の接続と同じように使うためのラッパー
+    - INSERT / UPDATE / DELETE の前に、トランザクション中でなければ BEGIN する（sqlite3 の既定の動作と同じ）
+    - BEGIN IMMEDIATE は BEGIN と pg_advisory_xact_lock にする
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    @property
+    def in_transaction(self):
+        from psycopg import pq
+        return self.raw.info.transaction_status != pq.TransactionStatus.IDLE
+
+    def prepare(self, sql):
+        """文の種類に応じてトランザクションを始める"""
+        statement = sql.lstrip().upper()
+        if statement.startswith('BEGIN'):
+            if not self.in_transaction:
+                self.raw.execute('BEGIN')
+            if statement.startswith('BEGIN IMMEDIATE'):
+                self.raw.execute('SELECT pg_advisory_xact_lock(%s)', (WRITE_LOCK_KEY,))
+        elif statement.startswith(_WRITE_STATEMENTS) and not self.in_transaction:
+            self.raw.execute('BEGIN')
+
+    def cursor(self, server_side=False):
+        return PostgresCursor(self, server_side)
+
+    def execute(self, sql, params=None):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def commit(self):
+        if self.in_transaction:
+            self.raw.execute('COMMIT')
+
+    def rollback(self):
+        if self.in_transaction:
+            self.raw.execute('ROLLBACK')
+
+    def close(self):
+        self.raw.close()
+
+
+def connect_postgres(url):
+    """PostgreSQL に接続する（psycopg は使うときだけ読み込む）"""
+    try:
+        import psycopg
+        from psycopg.types.numeric import FloatLoader
+    except ImportError:
+        raise RuntimeError("PostgreSQL を使うには psycopg をインストールしてください（pip install -r requirements-postgres.txt）。") from None
+    raw = psycopg.connect(url, autocommit=True)
+    # SUM(...) / 60.0 などの numeric を sqlite3 と同じく float で返す
+    raw.adapters.register_loader("numeric", FloatLoader)
+    return PostgresConnection(raw)
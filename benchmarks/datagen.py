@@ -0,0 +1,143 @@
+# benchmarks/datagen.py
+"""
+計測用の study.db を作る（セッション・運動の記録を指定した件数だけ生成する）
+- スキーマは migrations.py で最新にしてから、executemany でまとめて追加する
+- セッションは重ならないよう新しい順にさかのぼって作り、最後に集計テーブルを作り直す
+- 同じ seed なら同じデータになる
+
+使い方:
+    python -m benchmarks.datagen bench.db --scale medium
+    python -m benchmarks.datagen bench.db --sessions 5000 --exercise-logs 20000 --materials 80
+"""
+import argparse
+import os
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+import db
+import migrations
+import rollup
+
+# 規模ごとの (セッション数, 運動の記録数)
+SCALES = {
+    "small": (1_000, 1_000),
+    "medium": (100_000, 100_000),
+    "large": (1_000_000, 1_000_000),
+}
+BATCH_SIZE = 10_000
+
+
+def _batches(rows, size=BATCH_SIZE):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _session_rows(count, material_ids, rng, now):
+    """新しい順にさかのぼりながら、重ならないセッションを作る（すべて終了済み）"""
+    end = now - 60 * 60
+    for _ in range(count):
+        duration = rng.randint(10 * 60, 3 * 60 * 60)
+        start = end - duration
+        yield rng.choice(material_ids), start, end
+        end = start - rng.randint(10 * 60, 12 * 60 * 60)
+
+
+def _exercise_rows(count, exercises, rng, now):
+    """直近から1件ずつさかのぼって運動の記録を作る（記録時刻は UTC の文字列）"""
+    record_time = datetime.fromtimestamp(now, timezone.utc)
+    for _ in range(count):
+        record_time -= timedelta(seconds=rng.randint(5 * 60, 6 * 60 * 60))
+        exercise_id, value_type = rng.choice(exercises)
+        value = rng.randint(5, 60) if value_type == "minutes" else rng.randint(5, 100)
+        yield exercise_id, value, value_type, record_time.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def generate(path, sessions, exercise_logs, materials=50, categories=8, exercises=30, seed=0):
+    """
+    計測用のデータベースを作る（path が既にある場合は作り直す）
+    :return: 作成にかかった秒数
+    """
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    db.configure(path=path)
+    rng = random.Random(seed)
+    now = int(time.time())
+    started = time.perf_counter()
+
+    with db.connect() as conn:
+        migrations.migrate(conn)
+
+    with db.transaction() as conn:
+        cursor = conn.cursor()
+        cursor.executemany(
+            'INSERT INTO categories (name, is_active) VALUES (?, 1)',
+            [(f"カテゴリ{i + 1}",) for i in range(categories)],
+        )
+        cursor.executemany(
+            'INSERT INTO materials (name, category_id, discord_image_key, is_active) VALUES (?, ?, ?, 1)',
+            [(f"教材{i + 1}", i % categories + 1, f"image{i % 5}") for i in range(materials)],
+        )
+        cursor.executemany(
+            'INSERT INTO exercise_categories (name) VALUES (?)',
+            [(name,) for name in ("胸", "背中", "脚", "肩", "腕", "体幹")],
+        )
+        exercise_rows = [
+            (f"運動{i + 1}", i % 6 + 1, "minutes" if i % 4 == 0 else "reps")
+            for i in range(exercises)
+        ]
+        cursor.executemany('INSERT INTO exercises (name, category_id, value_type) VALUES (?, ?, ?)', exercise_rows)
+
+    material_ids = list(range(1, materials + 1))
+    for batch in _batches(_session_rows(sessions, material_ids, rng, now)):
+        with db.transaction() as conn:
+            conn.executemany('INSERT INTO sessions (material_id, start_time, end_time) VALUES (?, ?, ?)', batch)
+
+    exercise_types = [(i + 1, row[2]) for i, row in enumerate(exercise_rows)]
+    for batch in _batches(_exercise_rows(exercise_logs, exercise_types, rng, now)):
+        with db.transaction() as conn:
+            conn.executemany(
+                'INSERT INTO exercise_sessions (exercise_id, value, value_type, record_time) VALUES (?, ?, ?, ?)', batch
+            )
+
+    with db.transaction() as conn:
+        rollup.rebuild(conn.cursor())
+        rollup.rebuild_exercise(conn.cursor())
+    with db.connect() as conn:
+        conn.execute('ANALYZE')
+    return time.perf_counter() - started
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="計測用の study.db を作る")
+    parser.add_argument("path")
+    parser.add_argument("--scale", choices=SCALES, default="small")
+    parser.add_argument("--sessions", type=int, help="セッション数（省略時は --scale の値）")
+    parser.add_argument("--exercise-logs", type=int, help="運動の記録数（省略時は --scale の値）")
+    parser.add_argument("--materials", type=int, default=50)
+    parser.add_argument("--categories", type=int, default=8)
+    parser.add_argument("--exercises", type=int, default=30)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    sessions, exercise_logs = SCALES[args.scale]
+    if args.sessions is not None:
+        sessions = args.sessions
+    if args.exercise_logs is not None:
+        exercise_logs = args.exercise_logs
+    elapsed = generate(
+        args.path, sessions, exercise_logs,
+        materials=args.materials, categories=args.categories, exercises=args.exercises, seed=args.seed,
+    )
+    print(f"{args.path}: セッション {sessions:,} 件、運動の記録 {exercise_logs:,} 件（{elapsed:.1f} 秒）")
+
+
+if __name__ == "__main__":
+    main()
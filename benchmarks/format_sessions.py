@@ -0,0 +1,72 @@
+# benchmarks/format_sessions.py
+"""
+セッション一覧の表示用フォーマットの速度を比較する（1秒あたりの行数）
+- before: 1行ごとに format_start_time / format_start_date / format_end_time を呼ぶ以前の方法
+- after: utils.format_sessions でまとめて変換する方法
+
+使い方:
+    python -m benchmarks.format_sessions [--rows 10000] [--repeat 5]
+"""
+import argparse
+import random
+import time
+from datetime import datetime
+
+from utils import format_duration, format_end_time, format_sessions, format_start_date, format_start_time
+
+
+def make_rows(count):
+    """1日に数件ずつ、新しい順に並んだセッションの行を作る"""
+    now = int(datetime.now().timestamp())
+    rows = []
+    start = now
+    for i in range(count):
+        start -= random.randint(30 * 60, 8 * 60 * 60)
+        end = start + random.randint(10 * 60, 3 * 60 * 60) if i else None  # 最新の1件は進行中
+        rows.append((count - i, f"教材{i % 20}", start, end))
+    return rows
+
+
+def format_per_row(sessions):
+    """以前の routes.py と同じ、1行ずつ関数を呼ぶ変換"""
+    enriched = []
+    for session_id, material_name, start_time, end_time in sessions:
+        formatted_start_time = format_start_time(start_time)
+        formatted_start_date = format_start_date(start_time)
+        if end_time is not None:
+            formatted_end_time = format_end_time(end_time)
+            duration = format_duration((end_time - start_time) / 60)
+        else:
+            formatted_end_time = "未終了"
+            duration = "進行中"
+        enriched.append((formatted_start_date, material_name, formatted_start_time, formatted_end_time, duration, session_id))
+    return enriched
+
+
+def measure(func, rows, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(rows)
+        best = min(best, time.perf_counter() - started)
+    return len(rows) / best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="セッション一覧のフォーマット速度を比較する")
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    rows = make_rows(args.rows)
+    assert format_per_row(rows) == format_sessions(rows), "変換結果が一致しません"
+
+    before = measure(format_per_row, rows, args.repeat)
+    after = measure(format_sessions, rows, args.repeat)
+    print(f"before (1行ずつ): {before:,.0f} 行/秒")
+    print(f"after  (まとめて): {after:,.0f} 行/秒")
+    print(f"{after / before:.2f} 倍")
+
+
+if __name__ == "__main__":
+    main()
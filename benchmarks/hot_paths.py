@@ -0,0 +1,209 @@
+# benchmarks/hot_paths.py
+"""
+主要なページ・処理の速度を計測する（Flask のテストクライアントで実行する）
+- 各シナリオについて p50 / p95 / 平均の所要時間、1回あたりのクエリ数、最大のメモリ使用量を測る
+- 結果は JSON で保存し、--compare で以前の結果と比べられる
+- --cold を付けると、毎回プロセス内のキャッシュ（参照データ・描画済みの断片・集計）を捨ててから実行する
+
+使い方:
+    python -m benchmarks.datagen bench.db --scale medium
+    python -m benchmarks.hot_paths bench.db --output results.json
+    python -m benchmarks.hot_paths bench.db --cold --compare results.json
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+os.environ.setdefault("PRESENCE_BACKEND", "null")
+os.environ.setdefault("STUDY_MAINTENANCE_HOURS", "0")  # 計測中に保管・VACUUM を実行しない
+
+import db  # noqa: E402
+
+MEMORY_ITERATIONS = 5  # メモリの計測は遅くなるので回数を減らす
+
+
+class QueryCounter:
+    """接続のトレースで実行された SQL 文を数える（トリガー内の文は数えない）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def __call__(self, statement):
+        if statement.startswith("--"):
+            return
+        with self._lock:
+            self.count += 1
+
+    def install(self, conn):
+        conn.set_trace_callback(self)
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def build_scenarios(client):
+    """(名前, 実行する関数) のリスト"""
+    import database
+
+    year_ago = (datetime.now() - timedelta(days=365)).strftime('%Y-%m-%d')
+
+    def get(url):
+        def run():
+            response = client.get(url)
+            assert response.status_code == 200, (url, response.status_code)
+        return run
+
+    def start_and_stop():
+        response = client.post('/start_session', data={'material_id': '1'})
+        assert response.status_code == 302, response.status_code
+        response = client.post('/stop_session')
+        assert response.status_code == 302, response.status_code
+
+    return [
+        ("GET /study", get('/study')),
+        ("GET /history", get('/history')),
+        ("GET /history?size=500", get('/history?size=500')),
+        ("GET /exercise", get('/exercise')),
+        ("GET /exercise_log", get('/exercise_log')),
+        ("GET /exercise_log?category_id=1", get('/exercise_log?category_id=1')),
+        ("GET /api/stats (1年・週・カテゴリ)", get(f'/api/stats?start={year_ago}&bucket=week&group=category')),
+        ("POST /start_session + /stop_session", start_and_stop),
+        ("get_material_totals", database.get_material_totals),
+        ("get_total_study_time", lambda: database.get_total_study_time(1)),
+        ("get_monthly_study_time", lambda: database.get_monthly_study_time(1)),
+        ("get_past_days_study_time", lambda: database.get_past_days_study_time(1)),
+        ("get_overall_past_days_study_time", database.get_overall_past_days_study_time),
+        ("get_material_presence_stats", lambda: database.get_material_presence_stats(1)),
+    ]
+
+
+def clear_caches():
+    import cache
+
+    cache.reference_cache.invalidate()
+    cache.fragment_cache.clear()
+    cache.stats_cache.clear()
+
+
+def measure(func, iterations, counter, cold):
+    """:return: 結果の辞書（所要時間はミリ秒）"""
+    func()  # 接続・テンプレートのコンパイルなどの初回の処理を除く
+    timings = []
+    queries_before = counter.count
+    for _ in range(iterations):
+        if cold:
+            clear_caches()
+        started = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started) * 1000)
+    queries = (counter.count - queries_before) / iterations
+
+    tracemalloc.start()
+    for _ in range(MEMORY_ITERATIONS):
+        if cold:
+            clear_caches()
+        func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "iterations": iterations,
+        "p50_ms": round(percentile(timings, 50), 3),
+        "p95_ms": round(percentile(timings, 95), 3),
+        "mean_ms": round(statistics.fmean(timings), 3),
+        "queries_per_call": round(queries, 2),
+        "peak_memory_kb": round(peak / 1024, 1),
+    }
+
+
+def database_size(path):
+    with sqlite3.connect(path) as conn:
+        sessions = conn.execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+        exercise_logs = conn.execute('SELECT COUNT(*) FROM exercise_sessions').fetchone()[0]
+    return sessions, exercise_logs
+
+
+def compare(results, previous):
+    """以前の結果と p50 / p95 を比べて表示する"""
+    print()
+    print(f"{'シナリオ':<40} {'p50 比':>8} {'p95 比':>8}")
+    for name, result in results.items():
+        old = previous.get("results", {}).get(name)
+        if not old:
+            continue
+        p50 = result["p50_ms"] / old["p50_ms"] if old["p50_ms"] else float("nan")
+        p95 = result["p95_ms"] / old["p95_ms"] if old["p95_ms"] else float("nan")
+        print(f"{name:<40} {p50:>7.2f}x {p95:>7.2f}x")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="主要なページ・処理の速度を計測する")
+    parser.add_argument("path", help="benchmarks.datagen で作ったデータベース")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--cold", action="store_true", help="毎回プロセス内のキャッシュを捨ててから実行する")
+    parser.add_argument("--only", help="名前にこの文字列を含むシナリオだけ実行する")
+    parser.add_argument("--output", help="結果を保存する JSON ファイル")
+    parser.add_argument("--compare", help="比較する以前の結果の JSON ファイル")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.path):
+        parser.error(f"{args.path} がありません（python -m benchmarks.datagen で作成してください）")
+
+    counter = QueryCounter()
+    db.add_connect_hook(counter.install)
+    db.configure(path=args.path)
+
+    from app import create_app
+
+    client = create_app().test_client()
+    sessions, exercise_logs = database_size(args.path)
+    print(f"{args.path}: セッション {sessions:,} 件、運動の記録 {exercise_logs:,} 件")
+
+    results = {}
+    for name, func in build_scenarios(client):
+        if args.only and args.only not in name:
+            continue
+        result = measure(func, args.iterations, counter, args.cold)
+        results[name] = result
+        print(
+            f"{name:<40} p50 {result['p50_ms']:>8.2f} ms  p95 {result['p95_ms']:>8.2f} ms  "
+            f"クエリ {result['queries_per_call']:>5.1f}  メモリ {result['peak_memory_kb']:>8.1f} KiB"
+        )
+
+    report = {
+        "meta": {
+            "database": os.path.abspath(args.path),
+            "sessions": sessions,
+            "exercise_logs": exercise_logs,
+            "cold": args.cold,
+            "iterations": args.iterations,
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"結果を {args.output} に保存しました。")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(results, json.load(f))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
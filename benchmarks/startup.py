@@ -0,0 +1,77 @@
+# benchmarks/startup.py
+"""
+起動時間の確認（wsgi.py の読み込み = import と create_app() にかかる時間）
+- 新しい Python プロセスで wsgi を読み込み、中央値が予算（STARTUP_BUDGET_MS）を超えたら終了コード 1 を返す
+- 空のデータベース（移行あり）と、移行済みのデータベースの両方を測る
+- 読み込み時に pypresence などの重いモジュールが読み込まれていないことも確認する
+
+使い方:
+    python -m benchmarks.startup [--runs 5] [--budget-ms 1500]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+STARTUP_BUDGET_MS = 1500
+DEFERRED_MODULES = ("pypresence",)  # 起動時には読み込まないモジュール
+
+CHILD = """
+import json, sys, time
+started = time.perf_counter()
+import wsgi
+elapsed = time.perf_counter() - started
+print(json.dumps({{"ms": elapsed * 1000, "loaded": [m for m in {deferred!r} if m in sys.modules]}}))
+"""
+
+
+def measure_once(db_path):
+    env = dict(
+        os.environ,
+        STUDY_DB_PATH=db_path,
+        STUDY_SECRET_KEY="startup-check",
+        PRESENCE_BACKEND="null",
+        STUDY_MAINTENANCE_HOURS="0",
+    )
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD.format(deferred=DEFERRED_MODULES)],
+        cwd=root, env=env, check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="起動時間が予算内か確認する")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=STARTUP_BUDGET_MS)
+    args = parser.parse_args(argv)
+
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp:
+        cold = []
+        warm = []
+        for i in range(args.runs):
+            # 空のデータベース（移行あり）
+            result = measure_once(os.path.join(tmp, f"cold{i}.db"))
+            cold.append(result["ms"])
+            if result["loaded"]:
+                print(f"起動時に読み込まれています: {', '.join(result['loaded'])}")
+                ok = False
+        for _ in range(args.runs):
+            # 移行済みのデータベース
+            warm.append(measure_once(os.path.join(tmp, "cold0.db"))["ms"])
+
+    for name, values in (("空のデータベース", cold), ("移行済み", warm)):
+        median = statistics.median(values)
+        status = "OK" if median <= args.budget_ms else "予算超過"
+        print(f"{name}: 中央値 {median:.0f} ms（最大 {max(values):.0f} ms、予算 {args.budget_ms:.0f} ms）{status}")
+        ok = ok and median <= args.budget_ms
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,243 @@
+# cache.py
+"""
+プロセス内のキャッシュ
+- reference_cache: カテゴリ・教材・運動メニューなど、管理画面でしか変わらない参照データ
+- fragment_cache: 描画済みのテンプレートの一部（累計時間の表・セッションの表）。
+  キーに data_version を含めるので、データが変わると古い断片は使われなくなり、LRU で追い出される
+- stats_cache: /api/stats の集計結果（期間・区切り・グループと data_version をキーにする）
+- ongoing_session: 進行中のセッション。data_version が変わらない限りデータベースを読まない
+
+参照データのバージョンは app_meta テーブルの reference_version に保存され、
+参照データのテーブルへの書き込みでトリガーが1増やす（migrations.py の v6）。
+キャッシュは取得時にこのバージョンを確認するので、他のワーカープロセスが書き込んだ場合も古い値を返さない。
+バージョンの確認はリクエストごとに1回だけ行う（flask.g に保存する）。
+複数ユーザーのモードでは、どのキャッシュも db.current_path()（ユーザーのファイル）ごとに分けて保持する。
+"""
+import functools
+import os
+import threading
+from collections import OrderedDict
+
+from flask import g, has_app_context
+from markupsafe import Markup
+
+from db import connect, current_path
+
+
+def read_meta(key):
+    """app_meta の値を読む（行がなければ 0）"""
+    with connect() as conn:
+        row = conn.execute('SELECT value FROM app_meta WHERE key = ?', (key,)).fetchone()
+    return row[0] if row else 0
+
+
+def reference_version():
+    """参照データのバージョン（リクエスト中は最初に読んだ値を使う）"""
+    if has_app_context():
+        if "reference_version" not in g:
+            g.reference_version = read_meta('reference_version')
+        return g.reference_version
+    return read_meta('reference_version')
+
+
+def data_version():
+    """
+    (data_version, data_updated_at) を読む（リクエスト中は最初に読んだ値を使う）
+    data_version は表示に使うテーブルへの書き込みでトリガーが1増やす（migrations.py の v7）
+    """
+    if has_app_context() and "data_version" in g:
+        return g.data_version
+    value = read_data_version()
+    if has_app_context():
+        g.data_version = value
+    return value
+
+
+def read_data_version():
+    """(data_version, data_updated_at) をデータベースから読む（書き込み中のトランザクションでは書き込み後の値）"""
+    with connect() as conn:
+        rows = dict(conn.execute(
+            "SELECT key, value FROM app_meta WHERE key IN ('data_version', 'data_updated_at')"
+        ).fetchall())
+    return rows.get('data_version', 0), rows.get('data_updated_at', 0)
+
+
+class ReferenceCache:
+    """
+    参照データのキャッシュ
+    - 値は読み込んだときのバージョンと一緒にデータベースのファイルごとに保持し、バージョンが変わったらそのファイルの分を捨てる
+    - hits / misses / invalidations を監視用に数える
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._databases = {}  # パス -> (バージョン, キー -> 値)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key, loader):
+        path = current_path()
+        version = reference_version()
+        with self._lock:
+            cached_version, entries = self._databases.get(path, (None, {}))
+            if version != cached_version:
+                if entries:
+                    self.invalidations += 1
+                entries = {}
+                self._databases[path] = (version, entries)
+            if key in entries:
+                self.hits += 1
+                return entries[key]
+            self.misses += 1
+        value = loader()
+        with self._lock:
+            if self._databases.get(path, (None,))[0] == version:
+                self._databases[path][1][key] = value
+        return value
+
+    def invalidate(self):
+        """このファイルのキャッシュを捨てる（書き込んだリクエストで、次の読み込みから新しい値を使うため）"""
+        with self._lock:
+            self._databases.pop(current_path(), None)
+            self.invalidations += 1
+        if has_app_context():
+            g.pop("reference_version", None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": sum(len(entries) for _, entries in self._databases.values()),
+                "version": self._databases.get(current_path(), (None,))[0],
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+            }
+
+
+reference_cache = ReferenceCache()
+
+
+def cached_reference(func):
+    """引数のない参照データの取得関数の結果をキャッシュするデコレーター"""
+    @functools.wraps(func)
+    def wrapper():
+        return reference_cache.get(func.__name__, func)
+    return wrapper
+
+
+def invalidate_reference_cache():
+    reference_cache.invalidate()
+
+
+class OngoingSessionTracker:
+    """
+    進行中のセッション (ID, 教材名, 開始時刻) をデータベースのファイル（ユーザー）ごとにプロセス内に保持する
+    - このプロセスでの開始・終了は set() で直接反映する
+    - 他のプロセスの書き込みは data_version の変化で検出し、次の get() で読み直す
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._states = {}  # パス -> (data_version, セッション)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, loader):
+        path = current_path()
+        version, _ = data_version()
+        with self._lock:
+            state = self._states.get(path)
+            if state is not None and state[0] == version:
+                self.hits += 1
+                return state[1]
+            self.misses += 1
+        session = loader()
+        self.set(session, version)
+        return session
+
+    def set(self, session, version):
+        """:param version: session を書き込んだ（または読んだ）トランザクションでの data_version"""
+        with self._lock:
+            self._states[current_path()] = (version, session)
+
+    def stats(self):
+        with self._lock:
+            version, session = self._states.get(current_path(), (None, None))
+            return {
+                "version": version,
+                "ongoing": session is not None,
+                "databases": len(self._states),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+ongoing_session = OngoingSessionTracker()
+
+
+FRAGMENT_CACHE_SIZE = int(os.getenv("STUDY_FRAGMENT_CACHE_SIZE", "128"))
+STATS_CACHE_SIZE = int(os.getenv("STUDY_STATS_CACHE_SIZE", "64"))
+
+
+class LRUCache:
+    """
+    件数に上限のある LRU キャッシュ
+    - キーにはデータベースのファイルを加えるので、ユーザーごとのファイルの値が混ざらない
+    - 上限を超えたら最も長く使われていない値を捨てる
+    - hits / misses / evictions を監視用に数える
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, loader):
+        key = (current_path(), key)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        value = loader()
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+fragment_cache = LRUCache(FRAGMENT_CACHE_SIZE)
+stats_cache = LRUCache(STATS_CACHE_SIZE)
+
+
+def cached_fragment(name, params, render):
+    """
+    描画済みの HTML の断片をキャッシュから返す（なければ render() で描画する）
+    :param name: 断片の名前
+    :param params: 断片の内容を決めるページのパラメータ（タプル）
+    :param render: 断片の HTML を返す関数（クエリもこの中で実行する）
+    """
+    version, _ = data_version()
+    return Markup(fragment_cache.get((name, version) + tuple(params), render))
@@ -1,43 +1,32 @@
 # database.py
-import sqlite3
-from datetime import datetime, timedelta
+import heapq
+
+import archive
+from db import connect, dialect
+from datetime import datetime, timedelta, timezone
+
+from cache import cached_reference
+import migrations
+import rollup
+from utils import to_epoch
 
 def init_db():
-    with sqlite3.connect('study.db') as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS categories (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS materials (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                category_id INTEGER,
-                FOREIGN KEY (category_id) REFERENCES categories(id)
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS sessions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                material_id INTEGER,
-                start_time TIMESTAMP,
-                end_time TIMESTAMP,
-                FOREIGN KEY (material_id) REFERENCES materials(id)
-            )
-        ''')
-        conn.commit()
+    """
+    テーブルとインデックスを最新のスキーマに移行する（詳細は migrations.py）
+    """
+    with connect() as conn:
+        migrations.migrate(conn)
 
+@cached_reference
 def get_categories():
-    with sqlite3.connect('study.db') as conn:
+    with connect() as conn:
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM categories')
         return cursor.fetchall()
 
+@cached_reference
 def get_materials():
-    with sqlite3.connect('study.db') as conn:
+    with connect() as conn:
         cursor = conn.cursor()
         cursor.execute('''
             SELECT materials.id, materials.name, categories.name
@@ -52,13 +41,14 @@ def get_sessions(session_id=None, order_by=None, start_date=None):
     - session_id: 指定された場合、そのIDのセッションを取得
     - order_by: ソート条件を指定（例: "start_time DESC"）
     - start_date: 指定された日付以降のセッションを取得
+    ID を指定した場合は保管したセッションも探す（直近のセッションは保管されないので、それ以外は sessions だけを読む）
     """
-    with sqlite3.connect('study.db') as conn:
+    with connect() as conn:
         cursor = conn.cursor()
 
-        query = '''
+        query = f'''
             SELECT sessions.id, materials.name, sessions.start_time, sessions.end_time
-            FROM sessions
+            FROM {'all_sessions' if session_id else 'sessions'} AS sessions
             JOIN materials ON sessions.material_id = materials.id
         '''
         params = []
@@ -71,7 +61,7 @@ def get_sessions(session_id=None, order_by=None, start_date=None):
         # 開始日でフィルタリング
         elif start_date:
             query += ' WHERE sessions.start_time >= ?'
-            params.append(start_date)
+            params.append(to_epoch(start_date))
 
         # ソート条件を追加
         if order_by:
@@ -84,77 +74,685 @@ def get_sessions(session_id=None, order_by=None, start_date=None):
             return cursor.fetchone()
         return cursor.fetchall()
 
+def _fetch_sessions_page(db_cursor, table, before, cursor, limit):
+    query = f'''
+        SELECT sessions.id, materials.name, sessions.start_time, sessions.end_time
+        FROM {table} AS sessions
+        JOIN materials ON sessions.material_id = materials.id
+        WHERE sessions.start_time < ?
+    '''
+    params = [to_epoch(before)]
+    if cursor:
+        query += ' AND (sessions.start_time, sessions.id) < (?, ?)'
+        params.extend(cursor)
+    # 次のページがあるか判定するために1件多く取得する
+    query += ' ORDER BY sessions.start_time DESC, sessions.id DESC LIMIT ?'
+    params.append(limit + 1)
+    db_cursor.execute(query, params)
+    return db_cursor.fetchall()
+
+def get_sessions_page(before, cursor=None, limit=50):
+    """
+    開始時刻の降順でセッションを1ページ分取得する（キーセットページング）
+    - before: この日時より前に開始したセッションのみを対象にする
+    - cursor: 前のページの最後の行の (start_time（エポック秒）, id)。指定した場合はそれより古いセッションを取得
+    - limit: 1ページの件数
+    ページが保管の境界より古いところまで届く場合は、保管したセッションも読んで合わせる
+    :return: (セッションのリスト, 次のページのカーソル。次のページがなければ None)
+    """
+    with connect() as conn:
+        db_cursor = conn.cursor()
+        rows = _fetch_sessions_page(db_cursor, 'sessions', before, cursor, limit)
+        boundary = archive.archived_before()
+        if boundary and (len(rows) <= limit or rows[-1][2] < boundary):
+            archived = _fetch_sessions_page(db_cursor, 'sessions_archive', before, cursor, limit)
+            rows = list(heapq.merge(rows, archived, key=lambda row: (row[2], row[0]), reverse=True))[:limit + 1]
+
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        return rows, (last[2], last[0])
+    return rows, None
+
+def iter_sessions(start=None, end=None, batch_size=500):
+    """
+    セッションを開始時刻の古い順に返すジェネレータ（エクスポート用）
+    - start / end: 開始時刻の範囲（start 以上 end 未満）。None の場合は制限しない
+    - カーソルから batch_size 件ずつ読むので、件数が多くてもメモリ使用量は一定
+    - sessions と保管したセッションをそれぞれ開始時刻順に読み、順番を保ったまま合わせる
+    :return: (id, 教材名, カテゴリ名, 開始時刻, 終了時刻, 勉強時間（秒）) を1行ずつ返す
+    """
+    query = '''
+        SELECT sessions.id, materials.name, categories.name,
+               sessions.start_time, sessions.end_time, sessions.duration_seconds
+        FROM {table} AS sessions
+        JOIN materials ON sessions.material_id = materials.id
+        LEFT JOIN categories ON materials.category_id = categories.id
+        WHERE sessions.start_time >= ? AND sessions.start_time < ?
+        ORDER BY sessions.start_time, sessions.id
+    '''
+    params = (
+        to_epoch(start) if start is not None else -2**63,
+        to_epoch(end) if end is not None else 2**63 - 1,
+    )
+    with connect() as conn:
+        yield from heapq.merge(
+            *(_iter_rows(conn, query.format(table=table), params, batch_size) for table in ('sessions', 'sessions_archive')),
+            key=lambda row: (row[3], row[0]),
+        )
+
+def _iter_rows(conn, query, params, batch_size):
+    """クエリの結果を batch_size 件ずつ読みながら1行ずつ返す（PostgreSQL ではサーバー側のカーソルで読む）"""
+    cursor = dialect().streaming_cursor(conn)
+    try:
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        cursor.close()
+
+def iter_exercise_logs(start=None, end=None, batch_size=500):
+    """
+    運動の記録を記録時刻の古い順に返すジェネレータ（エクスポート用）
+    - start / end: 記録日の範囲（'YYYY-MM-DD' 形式、start 以上 end 未満）。None の場合は制限しない
+    - exercise_sessions と保管した記録をそれぞれ記録時刻順に読み、順番を保ったまま合わせる
+    :return: (id, 記録時刻, 部位カテゴリ, 運動メニュー, 記録値, 記録タイプ) を1行ずつ返す
+    """
+    query = '''
+        SELECT exercise_sessions.id, exercise_sessions.record_time,
+               exercise_categories.name, exercises.name,
+               exercise_sessions.value, exercise_sessions.value_type
+        FROM {table} AS exercise_sessions
+        JOIN exercises ON exercise_sessions.exercise_id = exercises.id
+        LEFT JOIN exercise_categories ON exercises.category_id = exercise_categories.id
+    '''
+    conditions = []
+    params = []
+    if start is not None:
+        conditions.append('exercise_sessions.record_time >= ?')
+        params.append(start)
+    if end is not None:
+        conditions.append('exercise_sessions.record_time < ?')
+        params.append(end)
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY exercise_sessions.record_time, exercise_sessions.id'
+
+    with connect() as conn:
+        yield from heapq.merge(
+            *(_iter_rows(conn, query.format(table=table), params, batch_size)
+              for table in ('exercise_sessions', 'exercise_sessions_archive')),
+            key=lambda row: (row[1], row[0]),
+        )
+
+def get_session_months():
+    """
+    セッションのある月（YYYY-MM）を新しい順に取得（日別の集計テーブルから求める）
+    """
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT DISTINCT SUBSTR(day, 1, 7)
+            FROM daily_study_totals
+            ORDER BY 1 DESC
+        ''')
+        return [row[0] for row in cursor.fetchall()]
+
+@cached_reference
+def get_category_list():
+    """カテゴリ管理画面用に、無効なものも含めたカテゴリの一覧 (ID, 名前, 有効か) を取得"""
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, name, is_active FROM categories")
+        return cursor.fetchall()
+
+@cached_reference
+def get_active_categories():
+    """有効なカテゴリの一覧 (ID, 名前) を取得"""
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, name FROM categories WHERE is_active = 1")
+        return cursor.fetchall()
+
+@cached_reference
+def get_material_list():
+    """
+    教材管理画面用に、無効なものも含めた教材の一覧を取得
+    :return: (ID, 教材名, 有効か, Discord画像キー, カテゴリ名) のリスト
+    """
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT materials.id, materials.name, materials.is_active, materials.discord_image_key, categories.name AS category_name
+            FROM materials
+            JOIN categories ON materials.category_id = categories.id
+        """)
+        return cursor.fetchall()
+
+@cached_reference
+def get_exercise_menu():
+    """
+    有効な運動メニューの一覧を取得
+    :return: (ID, 運動名, 部位カテゴリ名, 記録タイプ) のリスト
+    """
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT exercises.id, exercises.name, exercise_categories.name, exercises.value_type
+            FROM exercises
+            JOIN exercise_categories ON exercises.category_id = exercise_categories.id
+            WHERE exercises.is_active = 1
+        ''')
+        return cursor.fetchall()
+
+@cached_reference
+def get_exercise_categories():
+    """有効な運動の部位カテゴリの一覧 (ID, 名前) を取得"""
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, name FROM exercise_categories WHERE is_active = 1")
+        return cursor.fetchall()
+
+@cached_reference
+def get_all_exercises():
+    """無効なものも含めた運動メニューの一覧 (ID, 運動名, 部位カテゴリ名) を取得"""
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT exercises.id, exercises.name, exercise_categories.name
+            FROM exercises
+            JOIN exercise_categories ON exercises.category_id = exercise_categories.id
+        """)
+        return cursor.fetchall()
+
+@cached_reference
+def get_all_exercise_categories():
+    """無効なものも含めた運動の部位カテゴリの一覧 (ID, 名前) を取得"""
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, name FROM exercise_categories")
+        return cursor.fetchall()
+
+def get_recent_exercise_logs(days=7):
+    """
+    直近N日間（今日を含む）の運動記録を新しい順に取得
+    - record_time は CURRENT_TIMESTAMP（UTC）で保存されるため、日付の区切りも UTC で求める
+    - 列を関数で包まずに範囲で比較するので record_time のインデックスが使える
+    :return: (日付, 部位カテゴリ, 運動メニュー, 記録値, 記録タイプ) のリスト
+    """
+    since = (datetime.now(timezone.utc).date() - timedelta(days=days - 1)).isoformat()
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT
+                {dialect().date_of('exercise_sessions.record_time')},  -- 記録時間（日付のみ）
+                exercise_categories.name,            -- 部位カテゴリ
+                exercises.name,                      -- 運動メニュー
+                exercise_sessions.value,             -- 記録値
+                exercise_sessions.value_type         -- 記録タイプ（回 or 分）
+            FROM exercise_sessions
+            JOIN exercises ON exercise_sessions.exercise_id = exercises.id
+            JOIN exercise_categories ON exercises.category_id = exercise_categories.id
+            WHERE exercise_sessions.record_time >= ?
+            ORDER BY exercise_sessions.record_time DESC
+        """, (since,))
+        return cursor.fetchall()
+
+def exercise_daily_total(sql):
+    """その日のその運動メニューの合計（保管した記録も含める）を求めるサブクエリ"""
+    day = sql.date_of('exercise_sessions.record_time')
+    return f'''
+        SELECT SUM(daily.value)
+        FROM all_exercise_sessions AS daily
+        WHERE daily.exercise_id = exercise_sessions.exercise_id
+          AND daily.record_time >= {day}
+          AND daily.record_time < {sql.add_days(day, 1)}
+    '''
+
+def _fetch_exercise_logs_page(db_cursor, table, category_id, exercise_id, start, end, cursor, limit):
+    sql = dialect()
+    query = f'''
+        SELECT
+            {sql.date_of('exercise_sessions.record_time')},
+            exercise_categories.name,
+            exercises.name,
+            exercise_sessions.value,
+            exercise_sessions.value_type,
+            exercise_sessions.id,
+            ({exercise_daily_total(sql)}),
+            exercise_sessions.record_time
+        FROM {table} AS exercise_sessions
+        JOIN exercises ON exercise_sessions.exercise_id = exercises.id
+        JOIN exercise_categories ON exercises.category_id = exercise_categories.id
+    '''
+    conditions = []
+    params = []
+    if category_id is not None:
+        conditions.append('exercises.category_id = ?')
+        params.append(category_id)
+    if exercise_id is not None:
+        conditions.append('exercise_sessions.exercise_id = ?')
+        params.append(exercise_id)
+    if start:
+        conditions.append('exercise_sessions.record_time >= ?')
+        params.append(start)
+    if end:
+        conditions.append('exercise_sessions.record_time < ?')
+        params.append(end)
+    if cursor:
+        conditions.append('(exercise_sessions.record_time, exercise_sessions.id) < (?, ?)')
+        params.extend(cursor)
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    # 次のページがあるか判定するために1件多く取得する
+    query += ' ORDER BY exercise_sessions.record_time DESC, exercise_sessions.id DESC LIMIT ?'
+    params.append(limit + 1)
+    db_cursor.execute(query, params)
+    return db_cursor.fetchall()
+
+def get_exercise_logs_page(category_id=None, exercise_id=None, start=None, end=None, cursor=None, limit=50):
+    """
+    運動の記録を記録時刻の降順で1ページ分取得する（キーセットページング）
+    - category_id / exercise_id: 部位カテゴリ・運動メニューで絞り込む
+    - start / end: 記録日の範囲（'YYYY-MM-DD'、start 以上 end 未満）
+    - cursor: 前のページの最後の行の (record_time, id)
+    ページが保管の境界より古いところまで届く場合は、保管した記録も読んで合わせる
+    :return: (記録のリスト, 次のページのカーソル。次のページがなければ None)
+             記録は (日付, 部位カテゴリ, 運動メニュー, 記録値, 記録タイプ, ID, その日のそのメニューの合計)
+    """
+    args = (category_id, exercise_id, start, end, cursor, limit)
+    with connect() as conn:
+        db_cursor = conn.cursor()
+        rows = _fetch_exercise_logs_page(db_cursor, 'exercise_sessions', *args)
+        boundary = archive.archived_before()
+        if boundary and (len(rows) <= limit or rows[-1][7] < archive.record_time_text(boundary)):
+            archived = _fetch_exercise_logs_page(db_cursor, 'exercise_sessions_archive', *args)
+            rows = list(heapq.merge(rows, archived, key=lambda row: (row[7], row[5]), reverse=True))[:limit + 1]
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = (rows[-1][7], rows[-1][5])
+    return [row[:7] for row in rows], next_cursor
+
 def add_category(name):
-    with sqlite3.connect('study.db') as conn:
+    with connect() as conn:
         cursor = conn.cursor()
         cursor.execute('INSERT INTO categories (name) VALUES (?)', (name,))
-        conn.commit()
 
-def add_material(name, category_id):
-    with sqlite3.connect('study.db') as conn:
+def update_category(category_id, name, is_active):
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('UPDATE categories SET name = ?, is_active = ? WHERE id = ?', (name, int(is_active), category_id))
+
+def delete_category(category_id):
+    """
+    カテゴリを削除する（教材に使用されている場合は削除しない。このカテゴリの目標も削除する）
+    :return: 削除したか
+    """
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT COUNT(*) FROM materials WHERE category_id = ?', (category_id,))
+        if cursor.fetchone()[0] > 0:
+            return False
+        cursor.execute('DELETE FROM categories WHERE id = ?', (category_id,))
+        cursor.execute("DELETE FROM goals WHERE scope = 'category' AND target_id = ?", (category_id,))
+        return True
+
+def add_material(name, category_id, discord_image_key=""):
+    with connect() as conn:
         cursor = conn.cursor()
-        cursor.execute('INSERT INTO materials (name, category_id) VALUES (?, ?)', (name, category_id))
-        conn.commit()
+        cursor.execute(
+            'INSERT INTO materials (name, category_id, discord_image_key) VALUES (?, ?, ?)',
+            (name, category_id, discord_image_key),
+        )
+
+def update_material(material_id, name, category_id, discord_image_key, is_active):
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            'UPDATE materials SET name = ?, category_id = ?, discord_image_key = ?, is_active = ? WHERE id = ?',
+            (name, category_id, discord_image_key, int(is_active), material_id),
+        )
+
+def delete_material(material_id):
+    """
+    教材を削除する（セッションに使用されている場合は削除しない。保管したセッションも含める。この教材の目標も削除する）
+    :return: 削除したか
+    """
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT COUNT(*) FROM all_sessions WHERE material_id = ?', (material_id,))
+        if cursor.fetchone()[0] > 0:
+            return False
+        cursor.execute('DELETE FROM materials WHERE id = ?', (material_id,))
+        cursor.execute("DELETE FROM goals WHERE scope = 'material' AND target_id = ?", (material_id,))
+        return True
+
+def add_exercise_category(name):
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('INSERT INTO exercise_categories (name) VALUES (?)', (name,))
+
+def get_exercise_category(category_id):
+    """運動の部位カテゴリ (ID, 名前) を取得（なければ None）"""
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT id, name FROM exercise_categories WHERE id = ?', (category_id,))
+        return cursor.fetchone()
+
+def update_exercise_category(category_id, name):
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('UPDATE exercise_categories SET name = ? WHERE id = ?', (name, category_id))
+
+def delete_exercise_category(category_id):
+    """
+    運動の部位カテゴリを削除する（運動メニューに使用されている場合は削除しない）
+    :return: 削除したか
+    """
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT COUNT(*) FROM exercises WHERE category_id = ?', (category_id,))
+        if cursor.fetchone()[0] > 0:
+            return False
+        cursor.execute('DELETE FROM exercise_categories WHERE id = ?', (category_id,))
+        return True
+
+def add_exercise(name, category_id, value_type):
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('INSERT INTO exercises (name, category_id, value_type) VALUES (?, ?, ?)', (name, category_id, value_type))
+
+def get_exercise(exercise_id):
+    """運動メニュー (ID, 運動名, 部位カテゴリID, 記録タイプ) を取得（なければ None）"""
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT id, name, category_id, value_type FROM exercises WHERE id = ?', (exercise_id,))
+        return cursor.fetchone()
+
+def update_exercise(exercise_id, name, category_id, value_type):
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            'UPDATE exercises SET name = ?, category_id = ?, value_type = ? WHERE id = ?',
+            (name, category_id, value_type, exercise_id),
+        )
+
+def delete_exercise(exercise_id):
+    """
+    運動メニューを削除する（このメニューの記録がある場合は削除しない。保管した記録も含める。このメニューの目標も削除する）
+    :return: 削除したか
+    """
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT COUNT(*) FROM all_exercise_sessions WHERE exercise_id = ?', (exercise_id,))
+        if cursor.fetchone()[0] > 0:
+            return False
+        cursor.execute('DELETE FROM exercises WHERE id = ?', (exercise_id,))
+        cursor.execute("DELETE FROM goals WHERE scope = 'exercise' AND target_id = ?", (exercise_id,))
+        return True
+
+def add_exercise_log(exercise_id, value, value_type):
+    """運動の記録を追加する（記録時刻は現在時刻（UTC））。:return: 追加した記録の ID"""
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            'INSERT INTO exercise_sessions (exercise_id, value, value_type) VALUES (?, ?, ?) RETURNING id',
+            (exercise_id, value, value_type),
+        )
+        log_id = cursor.fetchone()[0]
+        rollup.apply_exercise_log(cursor, log_id, 1)
+        return log_id
+
+def get_exercise_log(log_id):
+    """
+    編集用に運動の記録を取得（保管した記録も探す）
+    :return: (ID, 記録日（YYYY-MM-DD）, 運動メニューID, 記録値, 記録タイプ, 運動名, 部位カテゴリ名)。なければ None
+    """
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT
+                exercise_sessions.id,
+                {dialect().date_of('exercise_sessions.record_time')},
+                exercise_sessions.exercise_id,
+                exercise_sessions.value,
+                exercises.value_type,
+                exercises.name,
+                exercise_categories.name
+            FROM all_exercise_sessions AS exercise_sessions
+            JOIN exercises ON exercise_sessions.exercise_id = exercises.id
+            JOIN exercise_categories ON exercises.category_id = exercise_categories.id
+            WHERE exercise_sessions.id = ?
+        ''', (log_id,))
+        return cursor.fetchone()
+
+def update_exercise_log(log_id, record_time, exercise_id, value):
+    """運動の記録を更新する（保管した記録は元のテーブルに戻してから編集する）"""
+    with connect() as conn:
+        cursor = conn.cursor()
+        archive.unarchive_exercise_log(cursor, log_id)
+        rollup.apply_exercise_log(cursor, log_id, -1)
+        cursor.execute('''
+            UPDATE exercise_sessions
+            SET record_time = ?, exercise_id = ?, value = ?
+            WHERE id = ?
+        ''', (record_time, exercise_id, value, log_id))
+        rollup.apply_exercise_log(cursor, log_id, 1)
+
+def get_ongoing_session():
+    """進行中のセッション (ID, 教材名, 開始時刻) を取得（なければ None）"""
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT sessions.id, materials.name, sessions.start_time
+            FROM sessions
+            JOIN materials ON sessions.material_id = materials.id
+            WHERE sessions.end_time IS NULL
+            LIMIT 1
+        ''')
+        return cursor.fetchone()
 
 def start_session(material_id):
-    with sqlite3.connect('study.db') as conn:
+    """
+    セッションを開始する
+    進行中のセッションは1件だけ（idx_sessions_single_open）なので、既にある場合は
+    dialect().integrity_errors の例外（SQLite では sqlite3.IntegrityError）になる
+    :return: 追加したセッションの ID
+    """
+    with connect() as conn:
         cursor = conn.cursor()
-        cursor.execute('INSERT INTO sessions (material_id, start_time) VALUES (?, ?)', (material_id, datetime.now()))
-        conn.commit()
+        cursor.execute(
+            'INSERT INTO sessions (material_id, start_time) VALUES (?, ?) RETURNING id',
+            (material_id, to_epoch(datetime.now())),
+        )
+        session_id = cursor.fetchone()[0]
+        rollup.apply_session(cursor, session_id, 1)
+        return session_id
 
 def stop_session():
-    with sqlite3.connect('study.db') as conn:
+    """
+    進行中のセッションを終了する
+    :return: 終了したセッションの ID（進行中のセッションがなければ None）
+    """
+    with connect() as conn:
         cursor = conn.cursor()
         cursor.execute('SELECT id FROM sessions WHERE end_time IS NULL LIMIT 1')
         ongoing_session = cursor.fetchone()
-        if ongoing_session:
-            cursor.execute('UPDATE sessions SET end_time = ? WHERE id = ?', (datetime.now(), ongoing_session[0]))
-            conn.commit()
+        if ongoing_session is None:
+            return None
+        rollup.apply_session(cursor, ongoing_session[0], -1)
+        cursor.execute('UPDATE sessions SET end_time = ? WHERE id = ?', (to_epoch(datetime.now()), ongoing_session[0]))
+        rollup.apply_session(cursor, ongoing_session[0], 1)
+        return ongoing_session[0]
 
 def update_session(session_id, material_id, start_time, end_time):
-    with sqlite3.connect('study.db') as conn:
+    """
+    セッションを更新する（start_time / end_time は datetime・ISO 形式の文字列・エポック秒のいずれか）
+    """
+    with connect() as conn:
         cursor = conn.cursor()
+        # 保管したセッションは元のテーブルに戻してから編集する
+        archive.unarchive_session(cursor, session_id)
+        rollup.apply_session(cursor, session_id, -1)
         cursor.execute('''
             UPDATE sessions
             SET material_id = ?, start_time = ?, end_time = ?
             WHERE id = ?
-        ''', (material_id, start_time, end_time, session_id))
-        conn.commit()
+        ''', (material_id, to_epoch(start_time), to_epoch(end_time), session_id))
+        rollup.apply_session(cursor, session_id, 1)
 
 def delete_session(session_id):
-    with sqlite3.connect('study.db') as conn:
+    with connect() as conn:
         cursor = conn.cursor()
+        archive.unarchive_session(cursor, session_id)
+        rollup.apply_session(cursor, session_id, -1)
         cursor.execute('DELETE FROM sessions WHERE id = ?', (session_id,))
-        conn.commit()
 
 
+def get_session_contribution(session_id):
+    """
+    セッションが累計時間に足している分（変更の前後を比べてイベントで送る差分にする）
+    :return: (教材名, カテゴリ名, 分)。セッションがなければ None（未終了のセッションは0分）
+    """
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT materials.name, categories.name, COALESCE(sessions.duration_seconds, 0) / 60.0
+            FROM all_sessions AS sessions
+            JOIN materials ON sessions.material_id = materials.id
+            LEFT JOIN categories ON materials.category_id = categories.id
+            WHERE sessions.id = ?
+        ''', (session_id,))
+        return cursor.fetchone()
+
+
+def get_material_totals():
+    """
+    教材ごとの累計勉強時間（分）を集計テーブルから取得
+    :return: (教材名, 累計分) のリスト
+    """
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT materials.name, SUM(material_study_totals.total_seconds) / 60.0
+            FROM material_study_totals
+            JOIN materials ON material_study_totals.material_id = materials.id
+            GROUP BY materials.name
+        ''')
+        return cursor.fetchall()
+
+def get_category_totals():
+    """
+    カテゴリごとの累計勉強時間（分）を集計テーブルから取得
+    :return: (カテゴリ名, 累計分) のリスト
+    """
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT categories.name, SUM(material_study_totals.total_seconds) / 60.0
+            FROM material_study_totals
+            JOIN materials ON material_study_totals.material_id = materials.id
+            JOIN categories ON materials.category_id = categories.id
+            GROUP BY categories.name
+        ''')
+        return cursor.fetchall()
+
 def get_total_study_time(material_id):
     """
-    指定された教材の累計勉強時間を取得（分単位）
+    指定された教材の累計勉強時間を取得（分単位、保管したセッションを含む集計テーブルから読む）
     """
-    with sqlite3.connect("study.db") as conn:
+    with connect() as conn:
         cursor = conn.cursor()
         cursor.execute('''
-            SELECT SUM(
-                (JULIANDAY(end_time) - JULIANDAY(start_time)) * 24 * 60
-            ) AS total_minutes
-            FROM sessions
-            WHERE material_id = ? AND end_time IS NOT NULL
+            SELECT total_seconds / 60.0 FROM material_study_totals WHERE material_id = ?
         ''', (material_id,))
         result = cursor.fetchone()
-        return int(result[0]) if result[0] else 0
+        return int(result[0]) if result and result[0] else 0
+
+STATS_BUCKETS = {
+    # 日付（ローカル時刻の YYYY-MM-DD）から区切りのラベルを作る式（引数は SQL の方言）
+    "day": lambda sql: "day",
+    "week": lambda sql: sql.week_start("day"),  # その週の月曜日
+    "month": lambda sql: "SUBSTR(day, 1, 7)",
+}
+STATS_GROUPS = {
+    # (グループの ID, グループの名前, 必要な JOIN)
+    "material": ("materials.id", "materials.name", "JOIN materials ON materials.id = totals.material_id"),
+    "category": (
+        "categories.id", "categories.name",
+        "JOIN materials ON materials.id = totals.material_id JOIN categories ON categories.id = materials.category_id",
+    ),
+}
+
+def get_study_time_buckets(start, end, bucket="day", group="material"):
+    """
+    期間内の勉強時間を区切り（日・週・月）とグループ（教材・カテゴリ）ごとに集計（分単位）
+    - 日付をまたぐセッションはローカル時刻の0時で分割し、それぞれの日に数える
+    - 期間の境界をまたぐセッションは期間内の部分だけを数える
+    :param start: 期間の開始（datetime またはエポック秒、含む）
+    :param end: 期間の終了（datetime またはエポック秒、含まない）
+    :return: (区切りのラベル, グループの ID, グループの名前, 分) のリスト（区切り・グループ順）
+    """
+    sql = dialect()
+    bucket_expr = STATS_BUCKETS[bucket](sql)
+    group_id, group_name, join = STATS_GROUPS[group]
+    start, end = to_epoch(start), to_epoch(end)
+    # 次のローカル時刻の0時（エポック秒）
+    next_midnight = sql.next_local_midnight('piece_start')
+    with connect() as conn:
+        cursor = conn.cursor()
+        # 最も長いセッションの長さだけ開始時刻をさかのぼれば、期間にかかるセッションをすべて含む
+        # （duration_seconds のインデックスで MAX は1回の探索で求まる）
+        cursor.execute('SELECT ' + sql.greatest(
+            'COALESCE((SELECT MAX(duration_seconds) FROM sessions), 0)',
+            'COALESCE((SELECT MAX(duration_seconds) FROM sessions_archive), 0)',
+        ))
+        longest = cursor.fetchone()[0] or 0
+        cursor.execute(f'''
+            WITH RECURSIVE pieces(material_id, piece_start, session_end) AS (
+                SELECT material_id, {sql.greatest('start_time', ':start')}, {sql.least('end_time', ':end')}
+                FROM all_sessions
+                WHERE end_time IS NOT NULL
+                  AND start_time >= :lookback AND start_time < :end
+                  AND end_time > :start
+                UNION ALL
+                SELECT material_id, {next_midnight}, session_end
+                FROM pieces
+                WHERE {next_midnight} < session_end
+            ),
+            days AS (
+                SELECT material_id,
+                       {sql.local_day('piece_start')} AS day,
+                       {sql.least(next_midnight, 'session_end')} - piece_start AS seconds
+                FROM pieces
+            ),
+            totals AS (
+                SELECT material_id, {bucket_expr} AS label, SUM(seconds) AS seconds
+                FROM days
+                GROUP BY material_id, label
+            )
+            SELECT totals.label, {group_id}, {group_name}, SUM(totals.seconds) / 60.0
+            FROM totals
+            {join}
+            GROUP BY totals.label, {group_id}
+            ORDER BY totals.label, {group_id}
+        ''', {"start": start, "end": end, "lookback": start - longest})
+        return cursor.fetchall()
 
 def get_monthly_study_time(material_id):
     """
     指定された教材の今月の勉強時間を取得（分単位）
     """
-    current_month_start = datetime.now().replace(day=1).isoformat()  # 今月の初日
-    with sqlite3.connect("study.db") as conn:
+    current_month_start = to_epoch(datetime.now().replace(day=1))  # 今月の初日
+    with connect() as conn:
         cursor = conn.cursor()
         cursor.execute('''
-            SELECT SUM(
-                (JULIANDAY(end_time) - JULIANDAY(start_time)) * 24 * 60
-            ) AS total_minutes
+            SELECT SUM(duration_seconds) / 60.0 AS total_minutes
             FROM sessions
             WHERE material_id = ? AND end_time IS NOT NULL AND start_time >= ?
         ''', (material_id, current_month_start))
@@ -168,13 +766,11 @@ def get_past_days_study_time(material_id, days=30):
     :param days: 何日間の勉強時間を取得するか（デフォルト: 30日）
     :return: 指定期間内の合計勉強時間（分単位）
     """
-    past_days_start = (datetime.now() - timedelta(days=days)).isoformat()  # N日前の日時を取得
-    with sqlite3.connect("study.db") as conn:
+    past_days_start = to_epoch(datetime.now() - timedelta(days=days))  # N日前の日時を取得
+    with connect() as conn:
         cursor = conn.cursor()
         cursor.execute('''
-            SELECT SUM(
-                (JULIANDAY(end_time) - JULIANDAY(start_time)) * 24 * 60
-            ) AS total_minutes
+            SELECT SUM(duration_seconds) / 60.0 AS total_minutes
             FROM sessions
             WHERE material_id = ? AND end_time IS NOT NULL AND start_time >= ?
         ''', (material_id, past_days_start))
@@ -187,24 +783,64 @@ def get_overall_past_days_study_time(days=30):
     :param days: 何日間の勉強時間を取得するか（デフォルト: 30日）
     :return: 指定期間内の合計勉強時間（分単位）
     """
-    past_days_start = (datetime.now() - timedelta(days=days)).isoformat()  # N日前の日時を取得
-    with sqlite3.connect("study.db") as conn:
+    past_days_start = to_epoch(datetime.now() - timedelta(days=days))  # N日前の日時を取得
+    with connect() as conn:
         cursor = conn.cursor()
         cursor.execute('''
-            SELECT SUM(
-                (JULIANDAY(end_time) - JULIANDAY(start_time)) * 24 * 60
-            ) AS total_minutes
+            SELECT SUM(duration_seconds) / 60.0 AS total_minutes
             FROM sessions
             WHERE end_time IS NOT NULL AND start_time >= ?
         ''', (past_days_start, ))
         result = cursor.fetchone()
         return int(result[0]) if result[0] else 0
 
+def get_material_presence_stats(material_id, days=30):
+    """
+    セッション開始時（Discordステータス）に必要な教材の情報と勉強時間を1回のクエリで取得
+    :param material_id: 教材のID
+    :param days: 何日間の勉強時間を取得するか（デフォルト: 30日）
+    :return: name, image_key, total_minutes（累計）, recent_minutes（教材の過去N日間）,
+             overall_recent_minutes（全教材の過去N日間）を持つ辞書。教材がなければ None
+    """
+    past_days_start = to_epoch(datetime.now() - timedelta(days=days))
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT
+                materials.name,
+                materials.discord_image_key,
+                (
+                    SELECT total_seconds / 60.0 FROM material_study_totals
+                    WHERE material_study_totals.material_id = materials.id
+                ),
+                (
+                    SELECT SUM({rollup.SESSION_MINUTES}) FROM sessions
+                    WHERE material_id = materials.id AND end_time IS NOT NULL AND start_time >= :since
+                ),
+                (
+                    SELECT SUM({rollup.SESSION_MINUTES}) FROM sessions
+                    WHERE end_time IS NOT NULL AND start_time >= :since
+                )
+            FROM materials
+            WHERE materials.id = :material_id
+        ''', {"material_id": material_id, "since": past_days_start})
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    name, image_key, total, recent, overall_recent = row
+    return {
+        "name": name,
+        "image_key": image_key or "",
+        "total_minutes": int(total) if total else 0,
+        "recent_minutes": int(recent) if recent else 0,
+        "overall_recent_minutes": int(overall_recent) if overall_recent else 0,
+    }
+
 def get_material_image_key(material_id):
     """
     指定された教材のDiscord用画像キーを取得
     """
-    with sqlite3.connect("study.db") as conn:
+    with connect() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT discord_image_key FROM materials WHERE id = ?", (material_id,))
         result = cursor.fetchone()
@@ -0,0 +1,312 @@
+# db.py
+"""
+データベース接続のプール
+- 既定では STUDY_DB_PATH の1つのファイル（SQLite）を使う
+- STUDY_DATABASE_URL に postgresql://... を設定すると PostgreSQL を使う（backends.py を参照）
+- use_database() / set_database() で、このコンテキスト（スレッド・リクエスト）で使うファイルを切り替えられる
+  （複数ユーザーのモードでユーザーごとのファイルを使う。accounts.py を参照）
+- プールはファイルごとに作り、最近使った STUDY_SHARD_POOLS 個だけを開いておく
+"""
+import os
+import queue
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from backends import connect_postgres, dialect_for, is_postgres, redact
+
+DB_PATH = os.getenv("STUDY_DATABASE_URL") or os.getenv("STUDY_DB_PATH", "study.db")
+POOL_SIZE = int(os.getenv("STUDY_DB_POOL_SIZE", "5"))
+SHARD_POOLS = int(os.getenv("STUDY_SHARD_POOLS", "32"))  # 同時に開いておくファイルごとのプールの数
+POOL_TIMEOUT = 30  # プールが空いていない場合に待つ秒数
+STATEMENT_CACHE_SIZE = 256  # 接続ごとのプリペアドステートメントのキャッシュ数
+
+# 接続を開いたときに一度だけ設定するPRAGMA
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",  # 約16MB（負の値はKiB単位）
+    "PRAGMA mmap_size = 268435456",  # 256MB
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+)
+
+
+class ConnectionPool:
+    """
+    データベース接続のプール
+    - 接続は最大 size 本まで作成し、使い終わったら再利用する
+    - opened / reused で新規作成数と再利用数を数える
+    """
+
+    def __init__(self, path, size=POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._all = []
+        self.retired = False
+        self.opened = 0
+        self.reused = 0
+
+    def _open(self):
+        if is_postgres(self.path):
+            # PRAGMA・計測用のフック・接続クラスは SQLite だけ
+            return connect_postgres(self.path)
+        conn = sqlite3.connect(
+            self.path,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
+            factory=_connection_factory,
+        )
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        for hook in _connect_hooks:
+            hook(conn)
+        return conn
+
+    def acquire(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_open = len(self._all) < self.size
+                if can_open:
+                    # 上限を超えないよう、接続を開く前に枠を確保する
+                    self._all.append(None)
+            if can_open:
+                try:
+                    conn = self._open()
+                except BaseException:
+                    with self._lock:
+                        self._all.remove(None)
+                    raise
+                with self._lock:
+                    self._all[self._all.index(None)] = conn
+                    self.opened += 1
+                return conn
+            try:
+                conn = self._idle.get(timeout=POOL_TIMEOUT)
+            except queue.Empty:
+                raise RuntimeError("データベース接続の空きがありません。") from None
+        with self._lock:
+            self.reused += 1
+        return conn
+
+    def release(self, conn):
+        with self._lock:
+            owned = conn in self._all
+            if owned and self.retired:
+                self._all.remove(conn)
+        if not owned or self.retired:
+            # configure() でプールが作り直された・LRU から外された後に返却された接続
+            conn.close()
+            return
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    def retire(self):
+        """空いている接続を閉じ、使用中の接続は返却時に閉じる（LRU から外したプール）"""
+        with self._lock:
+            self.retired = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            with self._lock:
+                if conn in self._all:
+                    self._all.remove(conn)
+            conn.close()
+
+    def close_all(self):
+        with self._lock:
+            conns, self._all = self._all, []
+        for conn in conns:
+            if conn is not None:
+                conn.close()
+
+    def stats(self):
+        return {
+            "path": redact(self.path),
+            "size": self.size,
+            "open": len(self._all),
+            "idle": self._idle.qsize(),
+            "opened": self.opened,
+            "reused": self.reused,
+        }
+
+
+_pools = OrderedDict()  # パス -> ConnectionPool（最近使った順）
+_retired_counts = {"opened": 0, "reused": 0}  # LRU から外したプールの分（/metrics のカウンターを減らさない）
+_pool_lock = threading.Lock()
+_local = threading.local()
+_database = ContextVar("study_database", default=None)
+_connect_hooks = []
+_connection_factory = sqlite3.Connection
+
+
+def add_connect_hook(hook):
+    """
+    新しい接続を開いたときに hook(conn) を呼ぶ（計測用のトレースの設定など）
+    既に開いている接続には適用されないので、必要なら configure() でプールを作り直す
+    """
+    _connect_hooks.append(hook)
+
+
+def remove_connect_hook(hook):
+    _connect_hooks.remove(hook)
+
+
+def set_connection_factory(factory):
+    """
+    接続に使う sqlite3.Connection のサブクラスを設定する（instrumentation.py の計測用の接続など）
+    既に開いている接続は閉じ、次の接続から使う
+    """
+    global _connection_factory
+    _connection_factory = factory
+    configure()
+
+
+def configure(path=None, pool_size=None):
+    """
+    データベースのパスとプールサイズを設定する（既存のプールは閉じる）
+    """
+    global DB_PATH, POOL_SIZE
+    with _pool_lock:
+        if path is not None:
+            DB_PATH = path
+        if pool_size is not None:
+            POOL_SIZE = pool_size
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close_all()
+
+
+def current_path():
+    """このコンテキストで使うデータベースのファイル"""
+    return _database.get() or DB_PATH
+
+
+def dialect():
+    """このコンテキストのデータベースの SQL の方言（backends.SQLITE / backends.POSTGRES）"""
+    return dialect_for(current_path())
+
+
+def set_database(path):
+    """
+    このコンテキストで使うファイルを切り替える（None で既定の STUDY_DB_PATH に戻す）
+    :return: reset_database() に渡すトークン
+    """
+    return _database.set(path)
+
+
+def reset_database(token):
+    _database.reset(token)
+
+
+@contextmanager
+def use_database(path):
+    """ブロックの中だけ path のファイルを使う"""
+    token = set_database(path)
+    try:
+        yield
+    finally:
+        reset_database(token)
+
+
+def get_pool(path=None):
+    """ファイルのプールを返す（なければ作り、開いているプールが SHARD_POOLS を超えたら最も古いものを閉じる）"""
+    path = path or current_path()
+    with _pool_lock:
+        pool = _pools.get(path)
+        if pool is not None:
+            _pools.move_to_end(path)
+            return pool
+        pool = _pools[path] = ConnectionPool(path, POOL_SIZE)
+        evicted = []
+        while len(_pools) > max(SHARD_POOLS, 1):
+            old = _pools.popitem(last=False)[1]
+            _retired_counts["opened"] += old.opened
+            _retired_counts["reused"] += old.reused
+            evicted.append(old)
+    for old in evicted:
+        old.retire()
+    return pool
+
+
+@contextmanager
+def connect():
+    """
+    このコンテキストのファイルのプールから接続を借りる
+    - 同じスレッドで同じファイルに入れ子に呼ばれた場合は同じ接続を返す
+    - 一番外側のブロックを抜けるときにコミット（例外時はロールバック）してプールに戻す
+    """
+    path = current_path()
+    held = getattr(_local, "held", None)
+    if held is None:
+        held = _local.held = {}  # パス -> [接続, 入れ子の深さ]
+    entry = held.get(path)
+    if entry is not None:
+        entry[1] += 1
+        try:
+            yield entry[0]
+        finally:
+            entry[1] -= 1
+        return
+
+    pool = get_pool(path)
+    conn = pool.acquire()
+    held[path] = [conn, 1]
+    try:
+        yield conn
+        if conn.in_transaction:
+            conn.commit()
+    except BaseException:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+    finally:
+        del held[path]
+        pool.release(conn)
+
+
+@contextmanager
+def transaction(immediate=False):
+    """
+    接続を借りてトランザクションを開始する（コミットは connect() と同じく一番外側のブロックで行う）
+    - immediate=True の場合は BEGIN IMMEDIATE で最初に書き込みロックを取る
+    - 既にトランザクション中の場合は、そのトランザクションに参加する
+    """
+    with connect() as conn:
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        yield conn
+
+
+def stats():
+    """接続の作成数・再利用数などを返す（開いているすべてのプールの合計）"""
+    with _pool_lock:
+        pools = [pool.stats() for pool in _pools.values()]
+        totals = {
+            key: sum(pool[key] for pool in pools) + _retired_counts.get(key, 0)
+            for key in ("open", "idle", "opened", "reused")
+        }
+    return dict(path=redact(current_path()), size=POOL_SIZE, pools=len(pools), **totals)
+
+
+def _reset_after_fork():
+    """fork した子プロセスでは親プロセスの接続を使わない（閉じると親の接続に影響するので参照だけ捨てる）"""
+    global _pools, _pool_lock, _local, _retired_counts
+    _pools = OrderedDict()
+    _retired_counts = {"opened": 0, "reused": 0}
+    _pool_lock = threading.Lock()
+    _local = threading.local()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -1,22 +1,209 @@
 # discord_presence.py
+"""
+Discord Rich Presence の更新
+- リクエスト処理中は最新の状態を預けるだけで、Discord IPC との通信はバックグラウンドのスレッドで行う
+- 連続した開始・終了は最新の状態だけにまとめる（未送信の状態は新しい状態で上書きする）
+- Discord への接続は最初の送信時に行い、失敗した場合は指数バックオフで再接続する
+- PRESENCE_BACKEND=null または DISCORD_CLIENT_ID 未設定の場合は何もしないバックエンドを使う
+"""
+import asyncio
 import os
+import threading
 import time
-from pypresence import Presence
-from dotenv import load_dotenv
 
-load_dotenv()
+try:
+    from dotenv import load_dotenv
+except ImportError:
+    load_dotenv = None
+
+if load_dotenv:
+    load_dotenv()
 CLIENT_ID = os.getenv("DISCORD_CLIENT_ID")
+BACKEND = os.getenv("PRESENCE_BACKEND", "discord")  # "discord" or "null"
+
+RECONNECT_INITIAL_DELAY = 1  # 再接続までの最初の待ち時間（秒）
+RECONNECT_MAX_DELAY = 300  # 再接続までの最大の待ち時間（秒）
+
+
+class NullBackend:
+    """何もしないバックエンド（Discord クライアントがない環境やテスト用）"""
+
+    def __init__(self):
+        self.history = []  # 送信された状態（テストで確認する用）
+
+    def connect(self):
+        pass
+
+    def update(self, **kwargs):
+        self.history.append(("update", kwargs))
+
+    def clear(self):
+        self.history.append(("clear", None))
+
+    def close(self):
+        pass
+
+
+class DiscordBackend:
+    """pypresence で Discord IPC に接続するバックエンド"""
+
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.rpc = None
+
+    def connect(self):
+        from pypresence import Presence  # 使うときまで読み込まない
+
+        # ワーカースレッドにはイベントループがないので用意する
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        rpc = Presence(self.client_id)
+        rpc.connect()
+        self.rpc = rpc
+
+    def update(self, **kwargs):
+        self.rpc.update(**kwargs)
+
+    def clear(self):
+        self.rpc.clear()
+
+    def close(self):
+        if self.rpc is not None:
+            try:
+                self.rpc.close()
+            except Exception:
+                pass
+            self.rpc = None
+
+
+_EMPTY = object()
+
+
+class PresenceWorker:
+    """
+    最新の状態だけを保持する1件分のキューと、それを Discord に送るスレッド
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.connected = False
+        self.sent = 0  # 送信した状態の数
+        self.coalesced = 0  # 送信前に新しい状態で上書きされた数
+        self._pending = _EMPTY
+        self._busy = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def submit(self, action, kwargs=None):
+        """状態を預けてすぐに戻る（action は "update" または "clear"）"""
+        with self._cond:
+            if self._pending is not _EMPTY:
+                self.coalesced += 1
+            self._pending = (action, kwargs)
+            self._cond.notify_all()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="discord-presence", daemon=True)
+                self._thread.start()
+
+    def wait_idle(self, timeout=None):
+        """預けた状態がすべて処理されるまで待つ（テスト・終了処理用）"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending is not _EMPTY or self._busy:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _take(self):
+        state, self._pending = self._pending, _EMPTY
+        return state
+
+    def _send(self, state):
+        action, kwargs = state
+        if not self.connected:
+            self.backend.connect()
+            self.connected = True
+        if action == "update":
+            self.backend.update(**kwargs)
+        else:
+            self.backend.clear()
+        self.sent += 1
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is _EMPTY:
+                    self._busy = False
+                    self._cond.notify_all()
+                    self._cond.wait()
+                state = self._take()
+                self._busy = True
+
+            delay = RECONNECT_INITIAL_DELAY
+            while True:
+                try:
+                    self._send(state)
+                    break
+                except ImportError:
+                    print("pypresence が見つからないため、Discordステータスの更新を無効にします。")
+                    self.backend = NullBackend()
+                    self.connected = False
+                except Exception as e:
+                    print(f"Discordステータスを更新できませんでした（{delay}秒後に再試行）: {e}")
+                    self.backend.close()
+                    self.connected = False
+                    with self._cond:
+                        # 待っている間に新しい状態が来たら、そちらを送る
+                        self._cond.wait(delay)
+                        if self._pending is not _EMPTY:
+                            state = self._take()
+                    delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+
+def _create_backend():
+    if BACKEND == "null":
+        return NullBackend()
+    if not CLIENT_ID:
+        print("DISCORD_CLIENT_IDが設定されていないため、Discordステータスは更新しません。")
+        return NullBackend()
+    return DiscordBackend(CLIENT_ID)
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def get_worker():
+    global _worker
+    if _worker is None:
+        with _worker_lock:
+            if _worker is None:
+                _worker = PresenceWorker(_create_backend())
+    return _worker
+
+
+def _reset_after_fork():
+    """fork した子プロセスには送信スレッドが引き継がれないので、最初の送信時に作り直す"""
+    global _worker, _worker_lock
+    _worker = None
+    _worker_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
 
-if not CLIENT_ID:
-    raise ValueError("DISCORD_CLIENT_IDが設定されていません。")
+def set_backend(backend):
+    """バックエンドを差し替える（テスト用）"""
+    global _worker
+    with _worker_lock:
+        _worker = PresenceWorker(backend)
 
-# Discord Rich Presenceの初期化
-rpc = Presence(CLIENT_ID)
-rpc.connect()
 
 def update_status(material_name, material_total_time, material_recent_time, overall_recent_time, image_key):
     """
-    Discord のステータスを更新
+    Discord のステータスを更新（送信はバックグラウンドで行う）
     :param material_name: 教材名
     :param material_total_time: 教材ごとの累計時間（分単位）
     :param material_recent_time: 教材ごとの過去30日間の勉強時間（分単位）
@@ -26,16 +213,16 @@ def update_status(material_name, material_total_time, material_recent_time, over
     state_text = f"勉強中:{material_name}"
     details_text = f"{int(material_recent_time // 60)}時間/30日 ({int(material_total_time // 60)}時間/合計)"
 
-    rpc.update(
+    get_worker().submit("update", dict(
         state=state_text,
         details=details_text,
         large_image=image_key if image_key else "default_image",  # 画像キーが設定されていない場合はデフォルトを使用
         large_text=f"勉強中: {material_name}",
-        start=time.time()
-    )
-    print(f"Discordステータスを更新しました:\n{state_text}\n{details_text}\n画像: {image_key}")
+        start=time.time(),  # 送信時ではなく開始時の時刻
+    ))
+    print(f"Discordステータスを更新します:\n{state_text}\n{details_text}\n画像: {image_key}")
 
 def clear_status():
-    """Discordのステータスをクリア"""
-    rpc.clear()
-    print("Discordステータスをクリアしました")
\ No newline at end of file
+    """Discordのステータスをクリア（送信はバックグラウンドで行う）"""
+    get_worker().submit("clear")
+    print("Discordステータスをクリアします")
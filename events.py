@@ -0,0 +1,274 @@
+# events.py
+"""
+セッションの開始・終了・編集を Server-Sent Events（/events）で接続中のクライアントに送る
+- プロセスに1つの EventBroker が、クライアントごとのキューに配る。イベントは1回だけ文字列にして全員に同じものを入れる
+- 同じプロセスでの変更は routes が publish() で送る（進行中のセッションと累計時間の差分を含む）
+- 他のワーカー・CLI での変更は、ウォッチャーのスレッドが data_version を STUDY_EVENTS_POLL_SECONDS ごとに確認して
+  "changed" を送る（クライアント数に関係なく、購読中のクライアントがいるファイルごとに1つの軽いクエリだけ）
+- 再接続時は Last-Event-ID から直近のイベントを送り直す。送り直せない場合やキューがあふれた場合は "resync" を送る
+- 1つの接続はワーカーのスレッドを1つ使うので、STUDY_EVENTS_MAX_CLIENTS で数を制限し、
+  STUDY_EVENTS_MAX_SECONDS ごとに切断する（EventSource が自動で再接続する）
+- 複数ユーザーのモードでは、ブローカーをデータベースのファイル（ユーザー）ごとに作る（他のユーザーの変更は送らない）。
+  ウォッチャーのスレッドはプロセスに1つで、すべてのブローカーを順に確認する（ユーザーが増えてもスレッドは増えない）
+"""
+import itertools
+import json
+import os
+import queue
+import secrets
+import threading
+import time
+from collections import deque
+
+from backends import redact
+from cache import read_data_version
+from db import current_path, use_database
+from utils import from_epoch
+
+MAX_CLIENTS = int(os.getenv("STUDY_EVENTS_MAX_CLIENTS", "32"))
+POLL_SECONDS = float(os.getenv("STUDY_EVENTS_POLL_SECONDS", "2"))
+MAX_STREAM_SECONDS = int(os.getenv("STUDY_EVENTS_MAX_SECONDS", "300"))
+HEARTBEAT_SECONDS = 15  # プロキシに切断されないよう、イベントがない間もコメント行を送る間隔
+RETRY_MS = 3000  # 切断されたときにクライアントが再接続するまでの時間
+QUEUE_SIZE = 64  # クライアントごとに溜めておけるイベント数
+HISTORY_SIZE = 128  # 再接続時に送り直せるイベント数
+
+
+def format_event(event_id, event, data):
+    """SSE の1件分の文字列"""
+    return f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class Subscription:
+    """1つのクライアントへの接続"""
+
+    def __init__(self, replay):
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.replay = replay
+        self.overflowed = False
+
+
+class EventBroker:
+    """
+    イベントを購読中のクライアントに配る
+    - イベントの ID は「プロセスごとの識別子:連番」。別のプロセスの ID で再接続された場合は送り直さずに resync にする
+    """
+
+    def __init__(self, path, max_clients=MAX_CLIENTS):
+        self.path = path
+        self.max_clients = max_clients
+        self.token = secrets.token_hex(4)
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._history = deque(maxlen=HISTORY_SIZE)  # (連番, 文字列)
+        self._sequence = itertools.count(1)
+        self._last_id = 0
+        self.version = None  # 最後に送った（または確認した）data_version
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self, last_event_id=None):
+        """
+        購読を始める
+        :return: Subscription。接続数が上限に達していれば None
+        """
+        if self.version is None:
+            self.version, _ = read_data_version()
+        with self._lock:
+            if len(self._subscribers) >= self.max_clients:
+                return None
+            subscription = Subscription(self._replay(last_event_id))
+            self._subscribers.add(subscription)
+        _start_watcher()
+        return subscription
+
+    def _replay(self, last_event_id):
+        """Last-Event-ID より後のイベント（送り直せなければ resync だけ）"""
+        if not last_event_id:
+            return []
+        token, _, sequence = last_event_id.partition(":")
+        if token != self.token or not sequence.isdigit():
+            return [self._format("resync", {})]
+        sequence = int(sequence)
+        if sequence == self._last_id:
+            return []
+        if not self._history or self._history[0][0] > sequence + 1:
+            return [self._format("resync", {})]
+        return [message for event_id, message in self._history if event_id > sequence]
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def _format(self, event, data):
+        self._last_id = next(self._sequence)
+        return format_event(f"{self.token}:{self._last_id}", event, data)
+
+    def publish(self, event, data, version=None):
+        """
+        イベントを全員に送る
+        :param version: この変更の後の data_version（ウォッチャーが同じ変更を "changed" として送らないように）
+        """
+        with self._lock:
+            message = self._format(event, data)
+            self._history.append((self._last_id, message))
+            if version is not None:
+                self.version = max(self.version or 0, version)
+            subscribers = list(self._subscribers)
+            self.published += 1
+        for subscription in subscribers:
+            try:
+                subscription.queue.put_nowait(message)
+            except queue.Full:
+                # 読むのが遅いクライアントは古いイベントを捨てて、ページを読み直してもらう
+                subscription.overflowed = True
+                self.dropped += 1
+
+    def stream(self, subscription, max_seconds=MAX_STREAM_SECONDS):
+        """クライアントに送る文字列を順に返すジェネレーター（終わったら購読をやめる）"""
+        try:
+            yield f"retry: {RETRY_MS}\n\n"
+            yield from subscription.replay
+            deadline = time.monotonic() + max_seconds
+            while time.monotonic() < deadline:
+                try:
+                    message = subscription.queue.get(timeout=HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                if subscription.overflowed:
+                    while not subscription.queue.empty():
+                        subscription.queue.get_nowait()
+                    subscription.overflowed = False
+                    with self._lock:
+                        message = self._format("resync", {})
+                yield message
+        finally:
+            self.unsubscribe(subscription)
+
+    def check_version(self):
+        """data_version が変わっていれば（他のプロセスでの変更）"changed" を送る"""
+        with use_database(self.path):
+            version, updated_at = read_data_version()
+        with self._lock:
+            changed = self.version is not None and version > self.version
+            self.version = max(self.version or 0, version)
+        if changed:
+            self.publish("changed", {"version": version, "updated_at": updated_at})
+
+    def has_subscribers(self):
+        with self._lock:
+            return bool(self._subscribers)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "clients": len(self._subscribers),
+                "published": self.published,
+                "dropped": self.dropped,
+            }
+
+
+_brokers = {}  # データベースのファイル -> EventBroker
+_brokers_lock = threading.Lock()
+_watcher = None  # すべてのブローカーの data_version を確認するスレッド（最初の購読で始める）
+
+
+def _start_watcher():
+    global _watcher
+    with _brokers_lock:
+        if _watcher is not None or POLL_SECONDS <= 0:
+            return
+        _watcher = threading.Thread(target=_watch, name="events-watcher", daemon=True)
+    _watcher.start()
+
+
+def _watch():
+    """購読中のクライアントがいるブローカーだけ、data_version を確認する"""
+    while True:
+        time.sleep(POLL_SECONDS)
+        with _brokers_lock:
+            brokers = list(_brokers.values())
+        for broker in brokers:
+            if not broker.has_subscribers():
+                continue
+            try:
+                broker.check_version()
+            except Exception as e:
+                print(f"data_version の確認に失敗しました（{redact(broker.path)}）: {e}")
+
+
+def get_broker():
+    """このコンテキストのデータベースのファイルのブローカー"""
+    path = current_path()
+    with _brokers_lock:
+        broker = _brokers.get(path)
+        if broker is None:
+            broker = _brokers[path] = EventBroker(path)
+    return broker
+
+
+def publish(event, data, version=None):
+    get_broker().publish(event, data, version)
+
+
+def subscribe(last_event_id=None):
+    return get_broker().subscribe(last_event_id)
+
+
+def stream(subscription):
+    return get_broker().stream(subscription)
+
+
+def stats():
+    """すべてのブローカーの合計"""
+    with _brokers_lock:
+        brokers = list(_brokers.values())
+    totals = {"clients": 0, "published": 0, "dropped": 0}
+    for broker in brokers:
+        for key, value in broker.stats().items():
+            totals[key] += value
+    return totals
+
+
+def ongoing_payload(session):
+    """進行中のセッション (ID, 教材名, 開始時刻) をイベント用の辞書にする（なければ None）"""
+    if session is None:
+        return None
+    start = from_epoch(session[2])
+    return {
+        "id": session[0],
+        "material": session[1],
+        "start_time": start.isoformat(),
+        "started": start.strftime('%Y年%m月%d日 %H:%M'),
+    }
+
+
+def totals_delta(before, after):
+    """
+    get_session_contribution() の変更前・変更後から、累計時間の差分を作る
+    :return: {"materials": {教材名: 分}, "categories": {カテゴリ名: 分}}
+    """
+    delta = {"materials": {}, "categories": {}}
+    for contribution, sign in ((before, -1), (after, 1)):
+        if contribution is None:
+            continue
+        material, category, minutes = contribution
+        for key, name in (("materials", material), ("categories", category)):
+            if name is not None:
+                delta[key][name] = round(delta[key].get(name, 0) + sign * minutes, 4)
+    for key in delta:
+        delta[key] = {name: minutes for name, minutes in delta[key].items() if minutes}
+    return delta
+
+
+def _reset_after_fork():
+    """fork した子プロセスにはスレッド・接続が引き継がれないので、ブローカーを作り直す"""
+    global _brokers, _brokers_lock, _watcher
+    _brokers = {}
+    _brokers_lock = threading.Lock()
+    _watcher = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
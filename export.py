@@ -0,0 +1,104 @@
+# export.py
+"""
+セッション・運動の記録のエクスポート（CSV / NDJSON）
+- データベースのカーソルから読んだ行をその場で書き出すジェネレータを返す
+  （全件をリストにしないので、件数が多くてもメモリ使用量は一定で、すぐに送信が始まる）
+"""
+import csv
+import io
+import json
+
+from database import iter_exercise_logs, iter_sessions
+from utils import from_epoch
+
+MIMETYPES = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+CHUNK_ROWS = 200  # 何行ごとにまとめて送信するか
+
+SESSION_FIELDS = ["id", "material", "category", "start_time", "end_time", "duration_minutes"]
+EXERCISE_LOG_FIELDS = ["id", "record_time", "category", "exercise", "value", "value_type"]
+
+
+def _format_time(value):
+    return from_epoch(value).isoformat(timespec="seconds") if value is not None else None
+
+
+def _session_records(start, end):
+    for session_id, material, category, start_time, end_time, duration in iter_sessions(start, end):
+        yield {
+            "id": session_id,
+            "material": material,
+            "category": category,
+            "start_time": _format_time(start_time),
+            "end_time": _format_time(end_time),
+            "duration_minutes": round(duration / 60, 2) if duration is not None else None,
+        }
+
+
+def _exercise_log_records(start, end):
+    for log_id, record_time, category, exercise, value, value_type in iter_exercise_logs(start, end):
+        yield {
+            "id": log_id,
+            "record_time": record_time,
+            "category": category,
+            "exercise": exercise,
+            "value": value,
+            "value_type": value_type,
+        }
+
+
+def _stream_csv(records, fields):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields)
+    writer.writeheader()
+    # ヘッダーはすぐに送る
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    for count, record in enumerate(records, 1):
+        writer.writerow(record)
+        if count % CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def _stream_ndjson(records):
+    lines = []
+    for record in records:
+        lines.append(json.dumps(record, ensure_ascii=False) + "\n")
+        if len(lines) >= CHUNK_ROWS:
+            yield "".join(lines)
+            lines = []
+    if lines:
+        yield "".join(lines)
+
+
+def _stream(records, fields, fmt):
+    if fmt == "csv":
+        return _stream_csv(records, fields)
+    return _stream_ndjson(records)
+
+
+def stream_sessions(fmt, start=None, end=None):
+    """
+    セッションを書き出すジェネレータ
+    :param fmt: "csv" または "ndjson"
+    :param start: 開始時刻の下限（datetime またはエポック秒、この時刻を含む）
+    :param end: 開始時刻の上限（datetime またはエポック秒、この時刻を含まない）
+    """
+    return _stream(_session_records(start, end), SESSION_FIELDS, fmt)
+
+
+def stream_exercise_logs(fmt, start=None, end=None):
+    """
+    運動の記録を書き出すジェネレータ
+    :param fmt: "csv" または "ndjson"
+    :param start: 記録日の下限（'YYYY-MM-DD'、この日を含む）
+    :param end: 記録日の上限（'YYYY-MM-DD'、この日を含まない）
+    """
+    return _stream(_exercise_log_records(start, end), EXERCISE_LOG_FIELDS, fmt)
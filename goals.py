@@ -0,0 +1,191 @@
+# goals.py
+"""
+目標（教材・カテゴリごとの勉強時間、運動メニューごとの記録値の、毎日・毎週の目標）
+- 進捗・連続達成・見込みは日ごとの集計テーブル（rollup.py の daily_study_totals / daily_exercise_totals）だけを読んで求める
+  （集計テーブルはセッション・運動の記録を書き込むたびに更新されるので、sessions / exercise_sessions は読まない）
+- 目標ごとに読むのは、連続達成が途切れるところまでの日数ぶんの行だけ（教材・運動メニューと日付のインデックスを使う）
+- 描画した結果は data_version と日付ごとにキャッシュする（routes.py の cached_fragment）
+- 勉強・運動とも日付はローカル時刻で区切る（運動の記録時刻は UTC で保存しているが、集計テーブルの日付はローカル時刻）。週は月曜日から
+"""
+import math
+import time
+from datetime import date, timedelta
+
+from db import connect
+from utils import format_duration
+
+SCOPES = {"material": "教材", "category": "カテゴリ", "exercise": "運動メニュー"}
+PERIODS = {"day": "毎日", "week": "毎週"}
+STUDY_SCOPES = ("material", "category")
+EXERCISE_SCOPES = ("exercise",)
+
+PACE_DAYS = 28  # 見込みに使う1日あたりの平均を求める日数（今日を除く直近の日数）
+STREAK_WINDOW_DAYS = 63  # 連続達成を求めるときに最初に読む日数（途切れていなければ倍にして読み直す）
+MAX_STREAK_DAYS = 4000  # 連続達成を数える最大の日数
+TOLERANCE = 1e-6  # 秒を60で割った分を目標と比べるときの誤差
+
+# 対象ごとの日ごとの値（対象の ID と開始日 'YYYY-MM-DD' を渡す）
+DAILY_VALUES = {
+    "material": '''
+        SELECT day, total_seconds / 60.0 FROM daily_study_totals
+        WHERE material_id = ? AND day >= ?
+    ''',
+    "category": '''
+        SELECT totals.day, SUM(totals.total_seconds) / 60.0
+        FROM materials
+        JOIN daily_study_totals AS totals ON totals.material_id = materials.id
+        WHERE materials.category_id = ? AND totals.day >= ?
+        GROUP BY totals.day
+    ''',
+    "exercise": '''
+        SELECT day, total_value FROM daily_exercise_totals
+        WHERE exercise_id = ? AND day >= ?
+    ''',
+}
+
+
+def period_days(period):
+    return 7 if period == "week" else 1
+
+
+def period_start(period, day):
+    """day を含む期間の最初の日"""
+    return day - timedelta(days=day.weekday()) if period == "week" else day
+
+
+def add_goal(scope, target_id, period, target):
+    with connect() as conn:
+        conn.execute(
+            'INSERT INTO goals (scope, target_id, period, target, created_at) VALUES (?, ?, ?, ?, ?)',
+            (scope, target_id, period, target, int(time.time())),
+        )
+
+
+def delete_goal(goal_id):
+    with connect() as conn:
+        conn.execute('DELETE FROM goals WHERE id = ?', (goal_id,))
+
+
+def get_goals(scopes=None):
+    """
+    目標の一覧
+    :param scopes: 対象の種類で絞り込む（None ならすべて）
+    :return: (ID, 対象の種類, 対象の ID, 対象の名前, 期間, 目標値, 記録タイプ) のリスト。記録タイプは運動だけ
+    """
+    query = '''
+        SELECT goals.id, goals.scope, goals.target_id,
+               COALESCE(materials.name, categories.name, exercises.name),
+               goals.period, goals.target, exercises.value_type
+        FROM goals
+        LEFT JOIN materials ON goals.scope = 'material' AND materials.id = goals.target_id
+        LEFT JOIN categories ON goals.scope = 'category' AND categories.id = goals.target_id
+        LEFT JOIN exercises ON goals.scope = 'exercise' AND exercises.id = goals.target_id
+    '''
+    params = ()
+    if scopes:
+        query += f" WHERE goals.scope IN ({','.join('?' * len(scopes))})"
+        params = tuple(scopes)
+    query += ' ORDER BY goals.scope, goals.id'
+    with connect() as conn:
+        return conn.execute(query, params).fetchall()
+
+
+def _daily_values(cursor, scope, target_id, since):
+    """since 以降の日ごとの値（日付 -> 分または記録値）"""
+    cursor.execute(DAILY_VALUES[scope], (target_id, since.isoformat()))
+    return {date.fromisoformat(day): value or 0 for day, value in cursor.fetchall()}
+
+
+def _total(values, first, last):
+    """first から last までの日の値の合計"""
+    return sum(values.get(first + timedelta(days=i), 0) for i in range((last - first).days + 1))
+
+
+def _met(value, target):
+    return value + TOLERANCE >= target
+
+
+def _streak(cursor, goal, today, values, since):
+    """
+    連続して目標を達成した期間の数
+    - 今の期間は達成していれば数え、まだなら前の期間から数える
+    - 読んだ範囲の最初まで途切れていなければ、範囲を倍にして読み直す
+    """
+    _, scope, target_id, _, period, target, _ = goal
+    length = timedelta(days=period_days(period))
+    window = (today - since).days
+    while True:
+        streak = 0
+        start = period_start(period, today)
+        if not _met(_total(values, start, today), target):
+            start -= length
+        while start >= since:
+            if not _met(_total(values, start, start + length - timedelta(days=1)), target):
+                return streak
+            streak += 1
+            start -= length
+        if window >= MAX_STREAK_DAYS:
+            return streak
+        window *= 2
+        since = period_start(period, today - timedelta(days=window))
+        values = _daily_values(cursor, scope, target_id, since)
+
+
+def _format_value(goal, value):
+    if goal[1] in EXERCISE_SCOPES:
+        return f"{math.floor(value)}{'分' if goal[6] == 'minutes' else '回'}"
+    return format_duration(value)
+
+
+def goal_status(cursor, goal):
+    """
+    目標1件の今の期間の進捗・連続達成・見込み
+    - 見込みは今日より前の PACE_DAYS 日の1日あたりの平均で求める
+      （毎日の目標は今日の進捗と平均の大きい方、毎週の目標は今週の進捗に残りの日数ぶんの平均を足す）
+    """
+    goal_id, scope, _, name, period, target, _ = goal
+    today = date.today()
+    start = period_start(period, today)
+    end = start + timedelta(days=period_days(period) - 1)
+    since = min(period_start(period, today - timedelta(days=STREAK_WINDOW_DAYS)), today - timedelta(days=PACE_DAYS))
+    values = _daily_values(cursor, scope, goal[2], since)
+
+    progress = _total(values, start, today)
+    pace = _total(values, today - timedelta(days=PACE_DAYS), today - timedelta(days=1)) / PACE_DAYS
+    remaining_days = (end - today).days
+    if period == "week":
+        projected = progress + pace * remaining_days
+    else:
+        projected = max(progress, pace)
+
+    achieved = _met(progress, target)
+    completion_day = None
+    if not achieved and pace > 0 and period == "week":
+        # 平均のペースで達成する日（今週中に達成できる場合だけ）
+        days_needed = math.ceil((target - progress) / pace)
+        if days_needed <= remaining_days:
+            completion_day = today + timedelta(days=days_needed)
+
+    return {
+        "id": goal_id,
+        "scope": SCOPES[scope],
+        "name": name,
+        "period": PERIODS[period],
+        "target": _format_value(goal, target),
+        "progress": _format_value(goal, progress),
+        "percent": min(100, math.floor(progress / target * 100)),
+        "achieved": achieved,
+        "streak": _streak(cursor, goal, today, values, since),
+        "streak_unit": "週" if period == "week" else "日",
+        "projected": _format_value(goal, projected),
+        "on_track": _met(projected, target),
+        "completion_day": completion_day,
+    }
+
+
+def goal_statuses(scopes):
+    """対象の種類が scopes の目標すべての状況（goal_status() の辞書のリスト）"""
+    goals = get_goals(scopes)
+    with connect() as conn:
+        cursor = conn.cursor()
+        return [goal_status(cursor, goal) for goal in goals]
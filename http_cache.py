@@ -0,0 +1,86 @@
+# http_cache.py
+"""
+HTTP の条件付き GET（ETag / Last-Modified）
+- app_meta の data_version は、セッション・運動の記録・参照データへの書き込みでトリガーが1増やす（migrations.py の v7）
+- ETag は data_version・URL・時間の区切りから作るので、データが変わらない限り同じ値になる
+- If-None-Match が一致すれば、集計クエリやテンプレートの描画の前に 304 を返す
+  （Last-Modified も付けるが、秒単位で同じ秒の書き込みを区別できないので If-Modified-Since では 304 を返さない）
+- 複数ユーザーのモードでは ETag にユーザーのファイルも含め、Vary: Cookie を付ける（同じブラウザーで別のユーザーに切り替えた場合）
+"""
+import functools
+import hashlib
+import threading
+import time
+from email.utils import formatdate
+
+from flask import make_response, request, session
+
+from cache import data_version
+from db import current_path
+
+# 時間の区切り（「昨日以降」など現在時刻で内容が変わるページ用、秒）
+MINUTE = 60
+DAY = 24 * 60 * 60
+
+_lock = threading.Lock()
+counters = {"not_modified": 0, "rendered": 0}
+
+
+def _count(name):
+    with _lock:
+        counters[name] += 1
+
+
+def _bucket_start(bucket, now):
+    """現在時刻を含む区切りの開始（エポック秒、ローカル時刻の日付で区切る）"""
+    if bucket == DAY:
+        local = time.localtime(now)
+        return int(time.mktime((local.tm_year, local.tm_mon, local.tm_mday, 0, 0, 0, 0, 0, -1)))
+    return int(now // bucket * bucket)
+
+
+def make_etag(version, bucket_start=None):
+    key = f"{current_path()}|{request.full_path}|{bucket_start}"
+    return f"{version}-{hashlib.sha1(key.encode()).hexdigest()[:16]}"
+
+
+def stats():
+    with _lock:
+        return dict(counters)
+
+
+def conditional(bucket=None):
+    """
+    GET のビューに ETag / Last-Modified を付け、変わっていなければ 304 を返すデコレーター
+    :param bucket: 現在時刻で内容が変わるページの区切り（MINUTE / DAY、秒）。None なら時刻に依存しない
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            # フラッシュメッセージが残っている場合は毎回描画する
+            if request.method != 'GET' or '_flashes' in session:
+                return view(*args, **kwargs)
+
+            version, updated_at = data_version()
+            bucket_start = _bucket_start(bucket, time.time()) if bucket else None
+            etag = make_etag(version, bucket_start)
+            last_modified = max(updated_at, bucket_start or 0)
+
+            # 304 は ETag（data_version から作る）だけで判断する。Last-Modified は秒単位なので、
+            # 前回の GET と同じ秒に書き込まれると If-Modified-Since では変更を見落とす
+            if request.if_none_match.contains(etag):
+                _count("not_modified")
+                response = make_response("", 304)
+            else:
+                _count("rendered")
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.headers['Last-Modified'] = formatdate(last_modified, usegmt=True)
+            # ブラウザ・プロキシは毎回確認してから使う
+            response.cache_control.no_cache = True
+            response.vary.add('Cookie')
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,217 @@
+# importer.py
+"""
+セッション・運動の記録の一括インポート（CSV / NDJSON）
+- 教材・運動メニューはあらかじめメモリに読み込んだ対応表で確認する
+- 行は BATCH_SIZE 件ずつ executemany で追加し、1バッチを1トランザクションでコミットする
+- 列はエクスポート（export.py）と同じ
+    sessions:     material（教材名）または material_id, start_time, end_time
+    exercise_log: exercise（運動メニュー名）または exercise_id, record_time, value, value_type（省略時はメニューの設定）
+- 運動の記録時刻は UTC で保存する（タイムゾーンのない値は UTC とみなし、ある値は UTC に変換する）
+
+使い方:
+    python importer.py sessions sessions.csv
+    python importer.py exercise_log exercise_log.ndjson --format ndjson
+"""
+import argparse
+import csv
+import io
+import json
+import sys
+import time
+from datetime import datetime, timezone
+
+import rollup
+from db import connect, transaction
+from utils import to_epoch
+
+BATCH_SIZE = 5000
+KINDS = ("sessions", "exercise_log")
+FORMATS = ("csv", "ndjson")
+
+
+class ImportResult:
+    """インポートの結果（追加した件数・除外した行・所要時間）"""
+
+    def __init__(self):
+        self.inserted = 0
+        self.rejected = []  # (行番号, 理由)
+        self.elapsed = 0.0
+
+    @property
+    def rows_per_second(self):
+        return self.inserted / self.elapsed if self.elapsed else 0.0
+
+    def summary(self):
+        return (
+            f"{self.inserted} 件を追加、{len(self.rejected)} 件を除外しました"
+            f"（{self.elapsed:.2f} 秒、{self.rows_per_second:,.0f} 件/秒）"
+        )
+
+
+def read_records(stream, fmt):
+    """テキストのストリームから (行番号, 辞書) を1件ずつ返す"""
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for line_no, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield line_no, None
+            continue
+        yield line_no, record if isinstance(record, dict) else None
+
+
+def _lookup(cursor, table):
+    """名前とIDの対応表を作る"""
+    cursor.execute(f'SELECT id, name FROM {table}')
+    by_id = {}
+    by_name = {}
+    for row_id, name in cursor.fetchall():
+        by_id[row_id] = name
+        by_name.setdefault(name, row_id)
+    return by_id, by_name
+
+
+def _resolve(record, id_key, name_key, by_id, by_name):
+    """記録の ID 列または名前列から ID を求める（見つからなければ None）"""
+    value = record.get(id_key)
+    if value not in (None, ""):
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            return None
+        return value if value in by_id else None
+    return by_name.get(record.get(name_key))
+
+
+def _parse_session(record, materials):
+    material_id = _resolve(record, "material_id", "material", *materials)
+    if material_id is None:
+        return None, "教材が見つかりません"
+    try:
+        start_time = to_epoch(record.get("start_time"))
+        end_time = to_epoch(record.get("end_time"))
+    except (TypeError, ValueError):
+        return None, "日時の形式が正しくありません"
+    if start_time is None or end_time is None:
+        return None, "開始時刻または終了時刻がありません"
+    if end_time < start_time:
+        return None, "終了時刻が開始時刻より前です"
+    return (material_id, start_time, end_time), None
+
+
+def _parse_exercise_log(record, exercises, value_types):
+    exercise_id = _resolve(record, "exercise_id", "exercise", *exercises)
+    if exercise_id is None:
+        return None, "運動メニューが見つかりません"
+    try:
+        record_time = datetime.fromisoformat(str(record.get("record_time")))
+        value = int(record.get("value"))
+    except (TypeError, ValueError):
+        return None, "記録時刻または値の形式が正しくありません"
+    value_type = record.get("value_type") or value_types[exercise_id]
+    if value_type not in ("reps", "minutes"):
+        return None, "記録タイプが正しくありません"
+    if record_time.tzinfo is not None:
+        record_time = record_time.astimezone(timezone.utc)
+    return (exercise_id, value, value_type, record_time.strftime('%Y-%m-%d %H:%M:%S')), None
+
+
+def _insert_sessions(cursor, rows):
+    cursor.executemany(
+        'INSERT INTO sessions (material_id, start_time, end_time) VALUES (?, ?, ?)', rows
+    )
+    rollup.apply_new_sessions(cursor, rows)
+
+
+def _insert_exercise_logs(cursor, rows):
+    cursor.executemany(
+        'INSERT INTO exercise_sessions (exercise_id, value, value_type, record_time) VALUES (?, ?, ?, ?)', rows
+    )
+    rollup.apply_new_exercise_logs(cursor, rows)
+
+
+def import_records(kind, records, batch_size=BATCH_SIZE):
+    """
+    記録をまとめて追加する
+    :param kind: "sessions" または "exercise_log"
+    :param records: read_records() が返す (行番号, 辞書) の列
+    :return: ImportResult
+    """
+    result = ImportResult()
+    started = time.perf_counter()
+
+    with connect() as conn:
+        cursor = conn.cursor()
+        if kind == "sessions":
+            materials = _lookup(cursor, 'materials')
+            parse = lambda record: _parse_session(record, materials)
+            insert = _insert_sessions
+        else:
+            exercises = _lookup(cursor, 'exercises')
+            cursor.execute('SELECT id, value_type FROM exercises')
+            value_types = dict(cursor.fetchall())
+            parse = lambda record: _parse_exercise_log(record, exercises, value_types)
+            insert = _insert_exercise_logs
+
+    def flush(batch):
+        # 1バッチを1トランザクションで追加する
+        with transaction() as conn:
+            insert(conn.cursor(), batch)
+        result.inserted += len(batch)
+
+    batch = []
+    for line_no, record in records:
+        if record is None:
+            result.rejected.append((line_no, "行を読み取れません"))
+            continue
+        row, error = parse(record)
+        if error:
+            result.rejected.append((line_no, error))
+            continue
+        batch.append(row)
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+
+    result.elapsed = time.perf_counter() - started
+    return result
+
+
+def import_file(kind, stream, fmt="csv", batch_size=BATCH_SIZE):
+    """
+    ファイルから記録をまとめて追加する
+    :param stream: テキストまたはバイナリのファイルオブジェクト（バイナリは UTF-8 として読む）
+    """
+    if isinstance(stream, (io.RawIOBase, io.BufferedIOBase)) or "b" in getattr(stream, "mode", ""):
+        stream = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    return import_records(kind, read_records(stream, fmt), batch_size=batch_size)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="セッション・運動の記録を一括でインポートする")
+    parser.add_argument("kind", choices=KINDS)
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=FORMATS, help="省略時は拡張子（.ndjson / .jsonl なら ndjson）で判断")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    fmt = args.format or ("ndjson" if args.path.endswith((".ndjson", ".jsonl")) else "csv")
+    with open(args.path, encoding="utf-8-sig", newline="") as f:
+        result = import_file(args.kind, f, fmt, batch_size=args.batch_size)
+
+    for line_no, reason in result.rejected:
+        print(f"{line_no} 行目: {reason}")
+    print(result.summary())
+    return 0 if not result.rejected else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,204 @@
+# instrumentation.py
+"""
+データベースアクセスの計測
+- すべての接続を InstrumentedConnection で開き（db.set_connection_factory）、SQL 文ごとの所要時間を測る
+- リクエストごとにクエリ数・合計時間・文ごとの所要時間を flask.g に記録し、Server-Timing ヘッダーで返す
+- STUDY_SLOW_QUERY_MS（ミリ秒）以上かかった文は EXPLAIN QUERY PLAN と一緒に出力する
+- 集計したヒストグラムは render_metrics() で Prometheus のテキスト形式にする（/metrics）
+
+所要時間は execute / executemany の実行時間（SELECT は最初の行を返すまで）で、fetch の時間は含まない。
+"""
+import os
+import sqlite3
+import threading
+import time
+
+from flask import g, has_request_context, request
+
+from cache import LRUCache
+
+SLOW_QUERY_MS = float(os.getenv("STUDY_SLOW_QUERY_MS", "100"))
+EXPLAIN_CACHE_SIZE = 256  # 実行計画を覚えておく SQL 文の数
+
+# ヒストグラムの区切り（秒）
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+REQUEST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+QUERY_COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    """ラベルごとの累積ヒストグラム（Prometheus の histogram と同じ形）"""
+
+    def __init__(self, name, help_text, buckets, label):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.label = label
+        self._lock = threading.Lock()
+        self._series = {}  # ラベルの値 -> [区切りごとの件数..., 合計, 件数]
+
+    def observe(self, label_value, value):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((key, list(series)) for key, series in self._series.items())
+        for label_value, series in items:
+            label = f'{self.label}="{_escape(label_value)}"'
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {series[-1]}')
+            lines.append(f"{self.name}_sum{{{label}}} {series[-2]:.6f}")
+            lines.append(f"{self.name}_count{{{label}}} {series[-1]}")
+        return lines
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+query_duration = Histogram(
+    "study_db_query_duration_seconds", "SQL 文の実行時間", QUERY_BUCKETS, "operation",
+)
+request_db_duration = Histogram(
+    "study_request_db_duration_seconds", "リクエストごとのデータベースの合計時間", REQUEST_BUCKETS, "endpoint",
+)
+request_db_queries = Histogram(
+    "study_request_db_queries", "リクエストごとの SQL 文の数", QUERY_COUNT_BUCKETS, "endpoint",
+)
+request_duration = Histogram(
+    "study_http_request_duration_seconds", "リクエストの処理時間", REQUEST_BUCKETS, "endpoint",
+)
+HISTOGRAMS = (query_duration, request_db_duration, request_db_queries, request_duration)
+
+_slow_lock = threading.Lock()
+slow_queries = 0
+# SQL 文 -> 実行計画（同じ文の計画は一度だけ求める）。IN (...) の長さが違う文などで種類が増えるので件数に上限を設ける。
+# 読み込み用のスレッドからも使うので、ロックのある LRUCache に入れる
+_explained = LRUCache(EXPLAIN_CACHE_SIZE)
+
+
+def _operation(sql):
+    words = sql.split(None, 1)
+    word = words[0].upper() if words else ""
+    if word in ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "BEGIN", "COMMIT", "ROLLBACK"):
+        return word.lower()
+    return "other"
+
+
+def _query_plan(cursor, sql, parameters):
+    if parameters is None or _operation(sql) not in ("select", "with", "insert", "update", "delete"):
+        return []
+    try:
+        rows = cursor.connection.cursor(sqlite3.Cursor).execute(f"EXPLAIN QUERY PLAN {sql}", parameters).fetchall()
+    except sqlite3.Error:
+        return []
+    return [row[-1] for row in rows]
+
+
+def _explain(cursor, sql, parameters):
+    """EXPLAIN QUERY PLAN の結果を1行ずつの文字列にする（parameters が None の場合や求められなければ空のリスト）"""
+    return _explained.get(sql, lambda: _query_plan(cursor, sql, parameters))
+
+
+def _record(cursor, sql, parameters, elapsed):
+    global slow_queries
+    query_duration.observe(_operation(sql), elapsed)
+    if has_request_context():
+        queries = g.setdefault("db_queries", [])
+        queries.append((sql, elapsed))
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        with _slow_lock:
+            slow_queries += 1
+        plan = _explain(cursor, sql, parameters)
+        where = f" ({request.path})" if has_request_context() else ""
+        print(f"遅いクエリ {elapsed * 1000:.1f} ms{where}: {' '.join(sql.split())}")
+        for line in plan:
+            print(f"    {line}")
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _record(self, sql, parameters, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            # executemany の文はパラメータが1組に決まらないので実行計画は求めない
+            _record(self, sql, None, time.perf_counter() - started)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """cursor() / execute() / executemany() を InstrumentedCursor で実行する接続"""
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or InstrumentedCursor)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def _before_request():
+    g.request_started = time.perf_counter()
+    g.db_queries = []
+
+
+def _after_request(response):
+    started = g.get("request_started")
+    if started is None:
+        return response
+    endpoint = request.endpoint or "unknown"
+    queries = g.get("db_queries", [])
+    db_seconds = sum(elapsed for _, elapsed in queries)
+    request_duration.observe(endpoint, time.perf_counter() - started)
+    request_db_duration.observe(endpoint, db_seconds)
+    request_db_queries.observe(endpoint, len(queries))
+    response.headers.add(
+        "Server-Timing", f'db;dur={db_seconds * 1000:.2f};desc="{len(queries)} queries"'
+    )
+    return response
+
+
+def init_app(app):
+    """すべての接続を計測用の接続にし、リクエストごとの集計を登録する"""
+    import db
+
+    db.set_connection_factory(InstrumentedConnection)
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+
+
+def render_metrics(gauges=()):
+    """
+    ヒストグラムと追加の値を Prometheus のテキスト形式にする
+    :param gauges: (名前, 説明, 値) の列（接続プール・キャッシュの統計など、名前が _total で終わるものは counter）
+    """
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    lines.append("# HELP study_db_slow_queries_total STUDY_SLOW_QUERY_MS 以上かかった SQL 文の数")
+    lines.append("# TYPE study_db_slow_queries_total counter")
+    lines.append(f"study_db_slow_queries_total {slow_queries}")
+    for name, help_text, value in gauges:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {'counter' if name.endswith('_total') else 'gauge'}")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
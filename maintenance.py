@@ -0,0 +1,187 @@
+# maintenance.py
+"""
+定期メンテナンス（古い記録の保管・統計の更新・空き領域の回収）
+- archive.archive_old_records() で古い記録を保管用のテーブルに移す
+- PRAGMA optimize（必要なテーブルだけ ANALYZE）で実行計画用の統計を更新する
+- 空きページが全体の VACUUM_FREE_RATIO 以上になったら VACUUM でファイルを詰める
+  （PostgreSQL では ANALYZE だけを行い、空き領域の回収はサーバーの autovacuum に任せる）
+- create_app() がバックグラウンドのスレッドで STUDY_MAINTENANCE_HOURS 時間ごとに実行する（0 で無効）。
+  app_meta の last_maintenance を BEGIN IMMEDIATE の中で確認・更新するので、複数のワーカーがあっても1つだけが実行する
+- 複数ユーザーのモード（accounts.py）では、ユーザーごとのファイルを順にメンテナンスする
+
+使い方:
+    python maintenance.py run       # すぐに実行する
+    python maintenance.py status    # 各テーブルの行数・空きページ・前回の実行時刻を表示する
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+import accounts
+import archive
+from db import connect, dialect, transaction, use_database
+from utils import from_epoch
+
+INTERVAL_HOURS = float(os.getenv("STUDY_MAINTENANCE_HOURS", "24"))
+FIRST_DELAY = 60  # 起動直後の処理と重ならないよう、最初の確認までの秒数
+VACUUM_FREE_RATIO = 0.2
+
+
+def _page_counts(conn):
+    page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+    freelist_count = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    return page_count, freelist_count
+
+
+def compact(force=False):
+    """
+    統計を更新し、空きページが多ければ VACUUM する
+    :return: VACUUM したか
+    """
+    with connect() as conn:
+        if dialect().name == "postgresql":
+            conn.execute('ANALYZE')
+            return False
+        conn.execute('PRAGMA optimize')
+        page_count, freelist_count = _page_counts(conn)
+        if not force and (page_count == 0 or freelist_count / page_count < VACUUM_FREE_RATIO):
+            return False
+        if conn.in_transaction:
+            conn.commit()
+        # VACUUM はトランザクションの外で実行する（他の接続の書き込みは busy_timeout まで待つ）
+        conn.execute('VACUUM')
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    return True
+
+
+def run(days=archive.ARCHIVE_DAYS):
+    """メンテナンスを1回実行し、結果を表示する"""
+    started = time.perf_counter()
+    moved_sessions, moved_logs = archive.archive_old_records(days)
+    vacuumed = compact()
+    print(
+        f"メンテナンス: セッション {moved_sessions} 件・運動の記録 {moved_logs} 件を保管しました"
+        f"{'、VACUUM しました' if vacuumed else ''}（{time.perf_counter() - started:.1f} 秒）"
+    )
+    return moved_sessions, moved_logs, vacuumed
+
+
+def databases():
+    """メンテナンスするファイル（None は既定の STUDY_DB_PATH）"""
+    if accounts.enabled():
+        return accounts.user_database_paths()
+    return [None]
+
+
+def run_due(interval_seconds):
+    """前回の実行から interval_seconds 以上経ったファイルをメンテナンスする（1つが失敗しても他は続ける）"""
+    for path in databases():
+        with use_database(path):
+            try:
+                if claim(interval_seconds):
+                    run()
+            except Exception as e:
+                print(f"メンテナンスに失敗しました{f'（{path}）' if path else ''}: {e}")
+
+
+def claim(interval_seconds, now=None):
+    """
+    前回の実行から interval_seconds 以上経っていれば、実行する権利を取る（last_maintenance を更新する）
+    :return: 実行してよいか
+    """
+    now = int(now if now is not None else time.time())
+    with transaction(immediate=True) as conn:
+        row = conn.execute("SELECT value FROM app_meta WHERE key = 'last_maintenance'").fetchone()
+        if row and now - row[0] < interval_seconds:
+            return False
+        conn.execute('''
+            INSERT INTO app_meta (key, value) VALUES ('last_maintenance', ?)
+            ON CONFLICT (key) DO UPDATE SET value = excluded.value
+        ''', (now,))
+    return True
+
+
+class MaintenanceScheduler:
+    """一定間隔でメンテナンスを実行するバックグラウンドのスレッド"""
+
+    def __init__(self, interval_hours=INTERVAL_HOURS):
+        self.interval = interval_hours * 60 * 60
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="maintenance", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        delay = FIRST_DELAY
+        while not self._stop.wait(delay):
+            try:
+                run_due(self.interval)
+            except Exception as e:
+                print(f"メンテナンスに失敗しました: {e}")
+            # 他のワーカーが実行した場合も含めて、間隔の 1/10 ごとに確認する
+            delay = max(self.interval / 10, FIRST_DELAY)
+
+
+_scheduler = None
+
+
+def start_scheduler():
+    """プロセスごとに1つのスケジューラーを起動する（STUDY_MAINTENANCE_HOURS=0 の場合は何もしない）"""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = MaintenanceScheduler()
+        _scheduler.start()
+    return _scheduler
+
+
+def _reset_after_fork():
+    """fork した子プロセスにはスレッドが引き継がれないので、create_app() で作り直す"""
+    global _scheduler
+    _scheduler = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="古い記録の保管と統計の更新・空き領域の回収")
+    parser.add_argument("command", choices=["run", "status"])
+    parser.add_argument("--days", type=int, default=archive.ARCHIVE_DAYS, help="この日数より前の記録を保管する")
+    parser.add_argument("--vacuum", action="store_true", help="空きページが少なくても VACUUM する")
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        for path in databases():
+            with use_database(path):
+                if path is not None:
+                    print(f"{path}:")
+                run(args.days)
+                if args.vacuum:
+                    compact(force=True)
+        return 0
+
+    for table, count in archive.counts().items():
+        print(f"{table}: {count:,} 行")
+    with connect() as conn:
+        page_counts = _page_counts(conn) if dialect().name == "sqlite" else None
+        last = conn.execute("SELECT value FROM app_meta WHERE key = 'last_maintenance'").fetchone()
+    if page_counts:
+        print(f"ページ数: {page_counts[0]:,}（空き {page_counts[1]:,}）")
+    boundary = archive.archived_before()
+    print(f"保管の境界: {from_epoch(boundary) if boundary else 'なし'}")
+    print(f"前回の実行: {from_epoch(last[0]) if last and last[0] else 'なし'}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,779 @@
+# migrations.py
+"""
+データベースのスキーマ移行
+- スキーマのバージョンは PRAGMA user_version に保存する
+- MIGRATIONS の各ステップは何度実行しても同じ結果になるように書く（既存のデータベースにも適用できるように）
+- PostgreSQL（backends.py）では、最新のスキーマ（POSTGRES_SCHEMA）を直接作り、バージョンを app_meta の schema_version に保存する
+
+使い方:
+    python migrations.py              # 最新のスキーマに移行する
+    python migrations.py status       # 現在のバージョンを表示する
+    python migrations.py check-plans  # 主要なクエリがインデックスを使っているか確認する
+"""
+import argparse
+import sys
+
+import rollup
+from db import connect, dialect
+
+
+def _columns(cursor, table):
+    cursor.execute(f'PRAGMA table_info({table})')
+    return {row[1] for row in cursor.fetchall()}
+
+
+def _add_column_if_missing(cursor, table, column, definition):
+    if column not in _columns(cursor, table):
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
+def _create_base_schema(cursor):
+    """勉強・運動の全テーブルを作成し、古いデータベースに足りない列を追加する"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS categories (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            is_active INTEGER NOT NULL DEFAULT 1
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS materials (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            category_id INTEGER,
+            discord_image_key TEXT NOT NULL DEFAULT '',
+            is_active INTEGER NOT NULL DEFAULT 1,
+            FOREIGN KEY (category_id) REFERENCES categories(id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            material_id INTEGER,
+            start_time TIMESTAMP,
+            end_time TIMESTAMP,
+            FOREIGN KEY (material_id) REFERENCES materials(id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS exercise_categories (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            is_active INTEGER NOT NULL DEFAULT 1
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS exercises (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            category_id INTEGER,
+            value_type TEXT NOT NULL DEFAULT 'reps',  -- 'reps' or 'minutes'
+            is_active INTEGER NOT NULL DEFAULT 1,
+            FOREIGN KEY (category_id) REFERENCES exercise_categories(id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS exercise_sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            exercise_id INTEGER,
+            value INTEGER,
+            value_type TEXT,
+            record_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (exercise_id) REFERENCES exercises(id)
+        )
+    ''')
+
+    # init_db() だけで作られた古いデータベースには以下の列がない
+    _add_column_if_missing(cursor, 'categories', 'is_active', 'INTEGER NOT NULL DEFAULT 1')
+    _add_column_if_missing(cursor, 'materials', 'discord_image_key', "TEXT NOT NULL DEFAULT ''")
+    _add_column_if_missing(cursor, 'materials', 'is_active', 'INTEGER NOT NULL DEFAULT 1')
+
+
+def _create_indexes(cursor):
+    """集計・進行中セッションの確認・履歴・運動記録で使うインデックス"""
+    # 教材ごとの集計（期間指定あり）を、テーブルを読まずにインデックスだけで計算する
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_sessions_material_start
+        ON sessions (material_id, start_time, end_time)
+    ''')
+    # 全教材の期間集計と、履歴ページの start_time 順の読み出し
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_sessions_start
+        ON sessions (start_time, end_time)
+    ''')
+    # 進行中のセッション（end_time IS NULL）だけを含む部分インデックス
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_sessions_open
+        ON sessions (id) WHERE end_time IS NULL
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_exercise_sessions_record_time
+        ON exercise_sessions (record_time)
+    ''')
+    # 運動メニュー・教材・カテゴリを削除する前の使用中チェック
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_exercise_sessions_exercise
+        ON exercise_sessions (exercise_id)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_materials_category
+        ON materials (category_id)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_exercises_category
+        ON exercises (category_id)
+    ''')
+
+
+def _create_rollups(cursor):
+    """集計テーブルを作成する（既存のセッションの集計は v4 の移行で行う）"""
+    rollup.create_tables(cursor)
+
+
+def _convert_times_to_epoch(cursor):
+    """
+    sessions の start_time / end_time を ISO 形式の文字列からエポック秒（整数）に変換し、
+    勉強時間（秒）を求める生成列 duration_seconds を追加する
+    - 文字列はローカル時刻として解釈する（datetime.now() で保存していたため）
+    - 変換後の時刻から集計テーブルを作り直す
+    """
+    for column in ('start_time', 'end_time'):
+        cursor.execute(f'''
+            UPDATE sessions
+            SET {column} = CAST(STRFTIME('%s', {column}, 'utc') AS INTEGER)
+            WHERE TYPEOF({column}) = 'text'
+        ''')
+    _add_column_if_missing(
+        cursor, 'sessions', 'duration_seconds',
+        'INTEGER GENERATED ALWAYS AS (end_time - start_time) VIRTUAL',
+    )
+    # 整数化した後は (start_time, end_time) のインデックスが選ばれてしまうため、
+    # 進行中のセッションの部分インデックスを end_time = NULL で検索できる形に作り直す
+    cursor.execute('DROP INDEX IF EXISTS idx_sessions_open')
+    cursor.execute('''
+        CREATE INDEX idx_sessions_open
+        ON sessions (end_time) WHERE end_time IS NULL
+    ''')
+    rollup.rebuild(cursor)
+
+
+def _index_exercise_logs_by_exercise_and_time(cursor):
+    """運動メニューごと・日ごとの合計と、メニューでの絞り込みに使うインデックス"""
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_exercise_sessions_exercise_time
+        ON exercise_sessions (exercise_id, record_time)
+    ''')
+    # (exercise_id) だけのインデックスは上のインデックスで代用できる
+    cursor.execute('DROP INDEX IF EXISTS idx_exercise_sessions_exercise')
+
+
+REFERENCE_TABLES = ('categories', 'materials', 'exercise_categories', 'exercises')
+
+
+def _create_meta_and_reference_version(cursor):
+    """
+    app_meta（アプリ全体の値）を作成し、参照データのテーブルへの書き込みで
+    reference_version を1増やすトリガーを作る（cache.py のキャッシュの無効化に使う）
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS app_meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO app_meta (key, value) VALUES ('reference_version', 0)")
+    for table in REFERENCE_TABLES:
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_reference_version
+                AFTER {event} ON {table}
+                BEGIN
+                    UPDATE app_meta SET value = value + 1 WHERE key = 'reference_version';
+                END
+            ''')
+
+
+DATA_TABLES = ('sessions', 'exercise_sessions') + REFERENCE_TABLES
+
+
+def _create_data_version(cursor):
+    """
+    表示に使うテーブルへの書き込みで data_version を1増やし、data_updated_at（エポック秒）を
+    更新するトリガーを作る（http_cache.py の ETag / Last-Modified に使う）
+    """
+    cursor.execute("INSERT OR IGNORE INTO app_meta (key, value) VALUES ('data_version', 0)")
+    cursor.execute("INSERT OR IGNORE INTO app_meta (key, value) VALUES ('data_updated_at', CAST(STRFTIME('%s', 'now') AS INTEGER))")
+    for table in DATA_TABLES:
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_data_version
+                AFTER {event} ON {table}
+                BEGIN
+                    UPDATE app_meta SET value = value + 1 WHERE key = 'data_version';
+                    UPDATE app_meta SET value = CAST(STRFTIME('%s', 'now') AS INTEGER) WHERE key = 'data_updated_at';
+                END
+            ''')
+
+
+def _index_session_duration(cursor):
+    """
+    セッションの長さのインデックス（期間の集計で、最も長いセッションの長さを1回の探索で求めるため）
+    """
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_duration ON sessions (duration_seconds)')
+
+
+def _enforce_single_open_session(cursor):
+    """
+    進行中のセッション（end_time が NULL）を1件までにする一意の部分インデックス
+    - 既に複数ある場合は最も新しいもの以外を、最も新しいものの開始時刻で終了させてから作る
+    """
+    cursor.execute('''
+        UPDATE sessions
+        SET end_time = (SELECT MAX(start_time) FROM sessions WHERE end_time IS NULL)
+        WHERE end_time IS NULL
+          AND id != (SELECT id FROM sessions WHERE end_time IS NULL ORDER BY start_time DESC, id DESC LIMIT 1)
+    ''')
+    if cursor.rowcount > 0:
+        print(f"進行中のセッションが複数あったため、{cursor.rowcount} 件を終了しました。")
+        rollup.rebuild(cursor)
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_sessions_single_open
+        ON sessions ((end_time IS NULL)) WHERE end_time IS NULL
+    ''')
+
+
+def _create_archive_tables(cursor):
+    """
+    古いセッション・運動の記録を移す保管用のテーブル（archive.py）と、両方を合わせたビュー
+    - 列は元のテーブルと同じで、ID もそのまま保つ（編集時に元のテーブルへ戻せるように）
+    - 集計テーブルは保管したセッションも含めたまま保つので、累計は変わらない
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sessions_archive (
+            id INTEGER PRIMARY KEY,
+            material_id INTEGER,
+            start_time INTEGER,
+            end_time INTEGER,
+            duration_seconds INTEGER GENERATED ALWAYS AS (end_time - start_time) VIRTUAL,
+            FOREIGN KEY (material_id) REFERENCES materials(id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS exercise_sessions_archive (
+            id INTEGER PRIMARY KEY,
+            exercise_id INTEGER,
+            value INTEGER,
+            value_type TEXT,
+            record_time TIMESTAMP,
+            FOREIGN KEY (exercise_id) REFERENCES exercises(id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_archive_start ON sessions_archive (start_time, end_time)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_archive_material_start ON sessions_archive (material_id, start_time)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_archive_duration ON sessions_archive (duration_seconds)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_exercise_sessions_archive_record_time ON exercise_sessions_archive (record_time)')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_exercise_sessions_archive_exercise_time
+        ON exercise_sessions_archive (exercise_id, record_time)
+    ''')
+    cursor.execute('''
+        CREATE VIEW IF NOT EXISTS all_sessions AS
+        SELECT id, material_id, start_time, end_time, duration_seconds FROM sessions
+        UNION ALL
+        SELECT id, material_id, start_time, end_time, duration_seconds FROM sessions_archive
+    ''')
+    cursor.execute('''
+        CREATE VIEW IF NOT EXISTS all_exercise_sessions AS
+        SELECT id, exercise_id, value, value_type, record_time FROM exercise_sessions
+        UNION ALL
+        SELECT id, exercise_id, value, value_type, record_time FROM exercise_sessions_archive
+    ''')
+    # 保管したテーブルへの書き込みも表示に影響する（編集時に戻す・削除する）
+    for table in ('sessions_archive', 'exercise_sessions_archive'):
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_data_version
+                AFTER {event} ON {table}
+                BEGIN
+                    UPDATE app_meta SET value = value + 1 WHERE key = 'data_version';
+                    UPDATE app_meta SET value = CAST(STRFTIME('%s', 'now') AS INTEGER) WHERE key = 'data_updated_at';
+                END
+            ''')
+    cursor.execute("INSERT OR IGNORE INTO app_meta (key, value) VALUES ('archived_before', 0)")
+    cursor.execute("INSERT OR IGNORE INTO app_meta (key, value) VALUES ('last_maintenance', 0)")
+
+
+def _postgres_version_triggers(tables, function):
+    """PostgreSQL で、テーブルへの書き込みで function を呼ぶトリガー（文ごとに1回）"""
+    statements = []
+    for table in tables:
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            name = f'trg_{table}_{event.lower()}_{function}'
+            statements.append(f'DROP TRIGGER IF EXISTS {name} ON {table}')
+            statements.append(
+                f'CREATE TRIGGER {name} AFTER {event} ON {table} FOR EACH STATEMENT EXECUTE FUNCTION {function}()'
+            )
+    return statements
+
+
+def _create_goals_and_exercise_buckets(cursor):
+    """
+    目標（goals.py）のテーブルと、運動の記録の日ごとの集計テーブルを作る
+    - 目標の進捗・連続達成日数は日ごとの集計テーブル（教材は daily_study_totals）だけを読んで求める
+    - 目標の変更も表示に影響するので data_version を増やす
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS goals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            scope TEXT NOT NULL,  -- 'material' / 'category' / 'exercise'
+            target_id INTEGER NOT NULL,
+            period TEXT NOT NULL,  -- 'day' / 'week'
+            target INTEGER NOT NULL,  -- 分（勉強）または記録値（運動）
+            created_at INTEGER NOT NULL
+        )
+    ''')
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_goals_{event.lower()}_data_version
+            AFTER {event} ON goals
+            BEGIN
+                UPDATE app_meta SET value = value + 1 WHERE key = 'data_version';
+                UPDATE app_meta SET value = CAST(STRFTIME('%s', 'now') AS INTEGER) WHERE key = 'data_updated_at';
+            END
+        ''')
+    # 教材・運動メニューごとに日付の範囲を読む（主キーは日付が先なので別に作る）
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_daily_study_totals_material_day ON daily_study_totals (material_id, day)')
+    rollup.rebuild_exercise(cursor)
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_daily_exercise_totals_exercise_day
+        ON daily_exercise_totals (exercise_id, day)
+    ''')
+
+
+def _store_rollup_seconds(cursor):
+    """
+    勉強時間の集計テーブルを分（REAL）から秒（INTEGER）にする
+    - 分の小数を足し引きし続けると誤差がたまり、rollup.py verify が一致しなくなるため
+    - テーブルを作り直して sessions から集計し直す
+    """
+    cursor.execute('DROP TABLE IF EXISTS material_study_totals')
+    cursor.execute('DROP TABLE IF EXISTS daily_study_totals')
+    rollup.rebuild(cursor)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_daily_study_totals_material_day ON daily_study_totals (material_id, day)')
+
+
+def _bucket_exercise_by_local_day(cursor):
+    """
+    運動の集計テーブルの日付を UTC からローカル時刻にする
+    - 勉強の目標と同じ「今日」で運動の目標を区切るため
+    - exercise_sessions から集計し直す
+    """
+    rollup.rebuild_exercise(cursor)
+
+
+# PostgreSQL の最新のスキーマ（SQLite の MIGRATIONS をすべて適用した後と同じテーブル・インデックス・ビュー）
+# - 時刻はエポック秒（BIGINT）、運動の記録時刻は SQLite と同じく UTC の 'YYYY-MM-DD HH:MM:SS' の文字列
+# - 集計テーブルの分は DOUBLE PRECISION（PostgreSQL の REAL は単精度のため）
+POSTGRES_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS categories (
+        id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        name TEXT NOT NULL,
+        is_active INTEGER NOT NULL DEFAULT 1
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS materials (
+        id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        name TEXT NOT NULL,
+        category_id INTEGER REFERENCES categories(id),
+        discord_image_key TEXT NOT NULL DEFAULT '',
+        is_active INTEGER NOT NULL DEFAULT 1
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS sessions (
+        id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        material_id INTEGER REFERENCES materials(id),
+        start_time BIGINT,
+        end_time BIGINT,
+        duration_seconds BIGINT GENERATED ALWAYS AS (end_time - start_time) STORED
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS exercise_categories (
+        id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        name TEXT NOT NULL,
+        is_active INTEGER NOT NULL DEFAULT 1
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS exercises (
+        id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        name TEXT NOT NULL,
+        category_id INTEGER REFERENCES exercise_categories(id),
+        value_type TEXT NOT NULL DEFAULT 'reps',
+        is_active INTEGER NOT NULL DEFAULT 1
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS exercise_sessions (
+        id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        exercise_id INTEGER REFERENCES exercises(id),
+        value INTEGER,
+        value_type TEXT,
+        record_time TEXT DEFAULT TO_CHAR(NOW() AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS')
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS sessions_archive (
+        id INTEGER PRIMARY KEY,
+        material_id INTEGER REFERENCES materials(id),
+        start_time BIGINT,
+        end_time BIGINT,
+        duration_seconds BIGINT GENERATED ALWAYS AS (end_time - start_time) STORED
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS exercise_sessions_archive (
+        id INTEGER PRIMARY KEY,
+        exercise_id INTEGER REFERENCES exercises(id),
+        value INTEGER,
+        value_type TEXT,
+        record_time TEXT
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS material_study_totals (
+        material_id INTEGER PRIMARY KEY,
+        total_seconds BIGINT NOT NULL DEFAULT 0,
+        session_count INTEGER NOT NULL DEFAULT 0
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS daily_study_totals (
+        day TEXT NOT NULL,
+        material_id INTEGER NOT NULL,
+        total_seconds BIGINT NOT NULL DEFAULT 0,
+        session_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, material_id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS daily_exercise_totals (
+        day TEXT NOT NULL,
+        exercise_id INTEGER NOT NULL,
+        total_value BIGINT NOT NULL DEFAULT 0,
+        log_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, exercise_id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS goals (
+        id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        scope TEXT NOT NULL,
+        target_id INTEGER NOT NULL,
+        period TEXT NOT NULL,
+        target INTEGER NOT NULL,
+        created_at BIGINT NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS app_meta (
+        key TEXT PRIMARY KEY,
+        value BIGINT NOT NULL DEFAULT 0
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_sessions_material_start ON sessions (material_id, start_time, end_time)',
+    'CREATE INDEX IF NOT EXISTS idx_sessions_start ON sessions (start_time, end_time)',
+    'CREATE INDEX IF NOT EXISTS idx_sessions_open ON sessions (end_time) WHERE end_time IS NULL',
+    'CREATE INDEX IF NOT EXISTS idx_sessions_duration ON sessions (duration_seconds)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_sessions_single_open ON sessions ((end_time IS NULL)) WHERE end_time IS NULL',
+    'CREATE INDEX IF NOT EXISTS idx_exercise_sessions_record_time ON exercise_sessions (record_time)',
+    'CREATE INDEX IF NOT EXISTS idx_exercise_sessions_exercise_time ON exercise_sessions (exercise_id, record_time)',
+    'CREATE INDEX IF NOT EXISTS idx_materials_category ON materials (category_id)',
+    'CREATE INDEX IF NOT EXISTS idx_exercises_category ON exercises (category_id)',
+    'CREATE INDEX IF NOT EXISTS idx_daily_study_totals_material_day ON daily_study_totals (material_id, day)',
+    'CREATE INDEX IF NOT EXISTS idx_daily_exercise_totals_exercise_day ON daily_exercise_totals (exercise_id, day)',
+    'CREATE INDEX IF NOT EXISTS idx_sessions_archive_start ON sessions_archive (start_time, end_time)',
+    'CREATE INDEX IF NOT EXISTS idx_sessions_archive_material_start ON sessions_archive (material_id, start_time)',
+    'CREATE INDEX IF NOT EXISTS idx_sessions_archive_duration ON sessions_archive (duration_seconds)',
+    'CREATE INDEX IF NOT EXISTS idx_exercise_sessions_archive_record_time ON exercise_sessions_archive (record_time)',
+    '''
+    CREATE INDEX IF NOT EXISTS idx_exercise_sessions_archive_exercise_time
+    ON exercise_sessions_archive (exercise_id, record_time)
+    ''',
+    '''
+    CREATE OR REPLACE VIEW all_sessions AS
+    SELECT id, material_id, start_time, end_time, duration_seconds FROM sessions
+    UNION ALL
+    SELECT id, material_id, start_time, end_time, duration_seconds FROM sessions_archive
+    ''',
+    '''
+    CREATE OR REPLACE VIEW all_exercise_sessions AS
+    SELECT id, exercise_id, value, value_type, record_time FROM exercise_sessions
+    UNION ALL
+    SELECT id, exercise_id, value, value_type, record_time FROM exercise_sessions_archive
+    ''',
+    '''
+    INSERT INTO app_meta (key, value) VALUES
+        ('reference_version', 0),
+        ('data_version', 0),
+        ('data_updated_at', CAST(EXTRACT(EPOCH FROM NOW()) AS BIGINT)),
+        ('archived_before', 0),
+        ('last_maintenance', 0),
+        ('schema_version', 0)
+    ON CONFLICT (key) DO NOTHING
+    ''',
+    # cache.py の reference_version と http_cache.py の data_version を増やすトリガー（SQLite の v6 / v7 / v10 と同じ）
+    '''
+    CREATE OR REPLACE FUNCTION bump_reference_version() RETURNS trigger AS $$
+    BEGIN
+        UPDATE app_meta SET value = value + 1 WHERE key = 'reference_version';
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    ''',
+    '''
+    CREATE OR REPLACE FUNCTION bump_data_version() RETURNS trigger AS $$
+    BEGIN
+        UPDATE app_meta SET value = value + 1 WHERE key = 'data_version';
+        UPDATE app_meta SET value = CAST(EXTRACT(EPOCH FROM NOW()) AS BIGINT) WHERE key = 'data_updated_at';
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    ''',
+    *_postgres_version_triggers(REFERENCE_TABLES, 'bump_reference_version'),
+    *_postgres_version_triggers(
+        DATA_TABLES + ('sessions_archive', 'exercise_sessions_archive', 'goals'), 'bump_data_version'
+    ),
+]
+
+
+# バージョン N へのステップは MIGRATIONS[N - 1]
+MIGRATIONS = [
+    _create_base_schema,
+    _create_indexes,
+    _create_rollups,
+    _convert_times_to_epoch,
+    _index_exercise_logs_by_exercise_and_time,
+    _create_meta_and_reference_version,
+    _create_data_version,
+    _index_session_duration,
+    _enforce_single_open_session,
+    _create_archive_tables,
+    _create_goals_and_exercise_buckets,
+    _store_rollup_seconds,
+    _bucket_exercise_by_local_day,
+]
+
+LATEST_VERSION = len(MIGRATIONS)
+
+# 既存の PostgreSQL のデータベースを移行するときに POSTGRES_SCHEMA の前に実行する文
+# (この文が必要になったバージョン, 文)。作り直したテーブルは POSTGRES_SCHEMA で作り、集計し直す
+POSTGRES_UPGRADES = [
+    (12, 'DROP TABLE IF EXISTS material_study_totals, daily_study_totals'),  # 集計の時間を秒（整数）にする
+    (13, 'DROP TABLE IF EXISTS daily_exercise_totals'),  # 運動の集計の日付をローカル時刻にする
+]
+
+
+def get_version(cursor):
+    if dialect().name == "postgresql":
+        if not dialect().has_relation(cursor, 'app_meta'):
+            return 0
+        cursor.execute("SELECT value FROM app_meta WHERE key = 'schema_version'")
+        row = cursor.fetchone()
+        return row[0] if row else 0
+    cursor.execute('PRAGMA user_version')
+    return cursor.fetchone()[0]
+
+
+def migrate_postgres(conn):
+    """
+    PostgreSQL に最新のスキーマを作る（BEGIN IMMEDIATE は勧告ロックになるので、複数のプロセスが同時に起動しても1つずつ実行する）
+    - これから MIGRATIONS にステップを足す場合は、PostgreSQL 用の変更もここに足す
+    :return: 移行後のバージョン
+    """
+    cursor = conn.cursor()
+    if conn.in_transaction:
+        conn.commit()
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        version = get_version(cursor)
+        if version < LATEST_VERSION:
+            upgrades = [statement for needed, statement in POSTGRES_UPGRADES if 0 < version < needed]
+            for statement in upgrades:
+                cursor.execute(statement)
+            for statement in POSTGRES_SCHEMA:
+                cursor.execute(statement)
+            if upgrades:
+                rollup.rebuild(cursor)
+                rollup.rebuild_exercise(cursor)
+            cursor.execute("UPDATE app_meta SET value = ? WHERE key = 'schema_version'", (LATEST_VERSION,))
+            version = LATEST_VERSION
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return version
+
+
+def migrate(conn):
+    """
+    未適用のステップを順に実行する
+    - 各ステップは BEGIN IMMEDIATE で書き込みロックを取ってから実行するので、
+      複数のプロセスが同時に起動しても同じステップを二重に実行しない
+    :return: 移行後のバージョン
+    """
+    if dialect().name == "postgresql":
+        return migrate_postgres(conn)
+    cursor = conn.cursor()
+    if conn.in_transaction:
+        conn.commit()
+    while True:
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            version = get_version(cursor)
+            if version >= LATEST_VERSION:
+                conn.rollback()
+                return version
+            MIGRATIONS[version](cursor)
+            cursor.execute(f'PRAGMA user_version = {version + 1}')
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+
+# (説明, クエリ, パラメータ, 使われるべきインデックス)
+QUERY_PLAN_CHECKS = [
+    (
+        "教材ごとの期間集計",
+        '''
+        SELECT SUM(duration_seconds) / 60.0
+        FROM sessions
+        WHERE material_id = ? AND end_time IS NOT NULL AND start_time >= ?
+        ''',
+        (1, 0),
+        'idx_sessions_material_start',
+    ),
+    (
+        "全教材の期間集計",
+        '''
+        SELECT SUM(duration_seconds) / 60.0
+        FROM sessions
+        WHERE end_time IS NOT NULL AND start_time >= ?
+        ''',
+        (0,),
+        'idx_sessions_start',
+    ),
+    (
+        "最も長いセッション",
+        'SELECT MAX(duration_seconds) FROM sessions',
+        (),
+        'idx_sessions_duration',
+    ),
+    (
+        "期間にかかるセッション（グラフ用の集計）",
+        '''
+        SELECT material_id, start_time, end_time
+        FROM sessions
+        WHERE end_time IS NOT NULL AND start_time >= ? AND start_time < ? AND end_time > ?
+        ''',
+        (0, 1, 0),
+        'idx_sessions_start',
+    ),
+    (
+        "進行中のセッションの確認",
+        'SELECT id FROM sessions WHERE end_time IS NULL LIMIT 1',
+        (),
+        'idx_sessions_open',
+    ),
+    (
+        "履歴ページ",
+        '''
+        SELECT sessions.id, materials.name, sessions.start_time, sessions.end_time
+        FROM sessions
+        JOIN materials ON sessions.material_id = materials.id
+        WHERE sessions.start_time < ?
+        ORDER BY sessions.start_time DESC, sessions.id DESC LIMIT ?
+        ''',
+        (4102444800, 50),
+        'idx_sessions_start',
+    ),
+    (
+        "直近の運動記録",
+        '''
+        SELECT id FROM exercise_sessions
+        WHERE record_time >= ?
+        ORDER BY record_time DESC
+        ''',
+        ('2000-01-01',),
+        'idx_exercise_sessions_record_time',
+    ),
+    (
+        "運動メニューごとの1日の合計",
+        '''
+        SELECT SUM(value) FROM exercise_sessions
+        WHERE exercise_id = ? AND record_time >= ? AND record_time < ?
+        ''',
+        (1, '2000-01-01', '2000-01-02'),
+        'idx_exercise_sessions_exercise_time',
+    ),
+    (
+        "教材の目標の日ごとの値",
+        'SELECT day, total_seconds / 60.0 FROM daily_study_totals WHERE material_id = ? AND day >= ?',
+        (1, '2000-01-01'),
+        'idx_daily_study_totals_material_day',
+    ),
+    (
+        "運動の目標の日ごとの値",
+        'SELECT day, total_value FROM daily_exercise_totals WHERE exercise_id = ? AND day >= ?',
+        (1, '2000-01-01'),
+        'idx_daily_exercise_totals_exercise_day',
+    ),
+]
+
+
+def check_query_plans(cursor):
+    """
+    EXPLAIN QUERY PLAN で主要なクエリが想定したインデックスを使っているか確認する
+    :return: (説明, 想定したインデックス, 実際のプラン) のリスト（問題がなければ空）
+    """
+    failures = []
+    for description, query, params, index in QUERY_PLAN_CHECKS:
+        cursor.execute('EXPLAIN QUERY PLAN ' + query, params)
+        plan = [row[-1] for row in cursor.fetchall()]
+        if not any(index in detail for detail in plan):
+            failures.append((description, index, plan))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="データベースのスキーマを移行する")
+    parser.add_argument("command", nargs="?", default="upgrade", choices=["upgrade", "status", "check-plans"])
+    args = parser.parse_args(argv)
+
+    with connect() as conn:
+        if args.command == "status":
+            print(f"スキーマバージョン: {get_version(conn.cursor())} / {LATEST_VERSION}")
+            return 0
+        version = migrate(conn)
+        if args.command == "upgrade":
+            print(f"スキーマバージョン {version} に移行しました。")
+            return 0
+        if dialect().name != "sqlite":
+            print("check-plans は SQLite だけで使えます。")
+            return 1
+        failures = check_query_plans(conn.cursor())
+
+    for description, index, plan in failures:
+        print(f"{description}: {index} が使われていません -> {plan}")
+    if failures:
+        return 1
+    print("すべてのクエリがインデックスを使っています。")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
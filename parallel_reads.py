@@ -0,0 +1,75 @@
+# parallel_reads.py
+"""
+独立した読み込みを読み込み用のスレッドプールで同時に実行する
+- WAL なので読み込みは同時に実行できる。タスクはスレッドごとに db のプールから別の接続を借りる
+- 各タスクは呼び出し元の contextvars（Flask のアプリ・リクエストのコンテキスト）のコピーで実行するので、
+  flask.g・render_template・キャッシュのバージョン確認がそのまま使える
+- スレッド数は STUDY_READ_WORKERS（既定 4）で制限する。db の STUDY_DB_POOL_SIZE はこれより大きくする
+- STUDY_READ_WORKERS=0 の場合は呼び出し元のスレッドで順に実行する
+
+gather() は connect() のブロックの中や、gather() のタスクの中から呼ばない
+（接続やスレッドを持ったまま待つと、プールが空かずに止まることがある）。
+"""
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+READ_WORKERS = int(os.getenv("STUDY_READ_WORKERS", "4"))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=READ_WORKERS, thread_name_prefix="read")
+    return _executor
+
+
+def gather(**tasks):
+    """
+    引数のない関数を同時に実行し、すべての結果を返す
+    - 最初のタスクは呼び出し元のスレッドで実行する（待っている間のスレッドを無駄にしない）
+    - タスクが例外を送出した場合は、すべてのタスクが終わってから最初の例外を送出する
+    :param tasks: 名前 -> 関数
+    :return: 名前 -> 結果 の辞書
+    """
+    items = list(tasks.items())
+    if READ_WORKERS <= 0 or len(items) <= 1:
+        return {name: func() for name, func in items}
+
+    executor = get_executor()
+    futures = [
+        (name, executor.submit(contextvars.copy_context().run, func))
+        for name, func in items[1:]
+    ]
+    results = {}
+    error = None
+    first_name, first_func = items[0]
+    try:
+        results[first_name] = first_func()
+    except Exception as e:
+        error = e
+    for name, future in futures:
+        try:
+            results[name] = future.result()
+        except Exception as e:
+            error = error or e
+    if error is not None:
+        raise error
+    return results
+
+
+def _reset_after_fork():
+    """fork した子プロセスにはスレッドが引き継がれないので、最初の呼び出しで作り直す"""
+    global _executor, _executor_lock
+    _executor = None
+    _executor_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
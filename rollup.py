@@ -0,0 +1,312 @@
+# rollup.py
+"""
+勉強時間の集計テーブル（ロールアップ）
+- material_study_totals: 教材ごとの累計時間（秒）とセッション数
+- daily_study_totals: 開始日・教材ごとの勉強時間（秒）とセッション数
+時間は整数の秒で持つ（分の小数を足し引きすると誤差がたまるため）。読むときに60で割って分にする
+- daily_exercise_totals: 記録日（ローカル時刻）・運動メニューごとの記録値の合計と記録数（goals.py の目標に使う）
+保管したセッション・運動の記録（archive.py）も含めて集計するので、保管しても累計は変わらない
+カテゴリごとの累計は material_study_totals を materials と結合して求める（教材数ぶんの行だけを読む）
+
+使い方:
+    python rollup.py rebuild   # sessions・exercise_sessions から集計し直す
+    python rollup.py verify    # 集計テーブルと sessions・exercise_sessions の集計結果を比較する
+"""
+import argparse
+import sys
+from datetime import datetime, timezone
+
+from db import connect, dialect
+from utils import from_epoch
+
+ROLLUP_TABLES = (
+    '''
+    CREATE TABLE IF NOT EXISTS material_study_totals (
+        material_id INTEGER PRIMARY KEY,
+        total_seconds INTEGER NOT NULL DEFAULT 0,
+        session_count INTEGER NOT NULL DEFAULT 0
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS daily_study_totals (
+        day TEXT NOT NULL,
+        material_id INTEGER NOT NULL,
+        total_seconds INTEGER NOT NULL DEFAULT 0,
+        session_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, material_id)
+    )
+    ''',
+)
+
+EXERCISE_ROLLUP_TABLES = (
+    '''
+    CREATE TABLE IF NOT EXISTS daily_exercise_totals (
+        day TEXT NOT NULL,
+        exercise_id INTEGER NOT NULL,
+        total_value INTEGER NOT NULL DEFAULT 0,
+        log_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, exercise_id)
+    )
+    ''',
+)
+
+# セッション1件あたりの勉強時間（秒・分）。未終了のセッションは0として数える
+SESSION_SECONDS = 'COALESCE(duration_seconds, 0)'
+SESSION_MINUTES = f'{SESSION_SECONDS} / 60.0'
+
+
+def session_day():
+    """セッションの開始日（ローカル時刻の YYYY-MM-DD）を求める式"""
+    return dialect().local_day('start_time')
+
+
+def exercise_day():
+    """
+    運動の記録日（ローカル時刻の YYYY-MM-DD）を求める式
+    記録時刻は UTC で保存しているが、勉強の日付と同じくローカル時刻で区切る
+    """
+    return dialect().local_day_of_utc('record_time')
+
+
+def _local_day(record_time):
+    """記録時刻（UTC の 'YYYY-MM-DD HH:MM:SS'）のローカル時刻の日付（exercise_day() と同じ）"""
+    return datetime.fromisoformat(record_time).replace(tzinfo=timezone.utc).astimezone().strftime('%Y-%m-%d')
+
+
+def create_tables(cursor):
+    for statement in ROLLUP_TABLES:
+        cursor.execute(statement)
+
+
+def create_exercise_tables(cursor):
+    for statement in EXERCISE_ROLLUP_TABLES:
+        cursor.execute(statement)
+
+
+def _add(cursor, material_rows, daily_rows):
+    """(教材ID, 秒, 件数) と (日, 教材ID, 秒, 件数) を集計テーブルに足し込む"""
+    cursor.executemany('''
+        INSERT INTO material_study_totals (material_id, total_seconds, session_count)
+        VALUES (?, ?, ?)
+        ON CONFLICT (material_id) DO UPDATE SET
+            total_seconds = material_study_totals.total_seconds + excluded.total_seconds,
+            session_count = material_study_totals.session_count + excluded.session_count
+    ''', material_rows)
+    cursor.executemany('''
+        INSERT INTO daily_study_totals (day, material_id, total_seconds, session_count)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (day, material_id) DO UPDATE SET
+            total_seconds = daily_study_totals.total_seconds + excluded.total_seconds,
+            session_count = daily_study_totals.session_count + excluded.session_count
+    ''', daily_rows)
+
+
+def apply_new_sessions(cursor, sessions):
+    """
+    まとめて追加したセッションの時間を集計テーブルに足す（一括インポート用）
+    :param sessions: (教材ID, 開始時刻, 終了時刻)（エポック秒）のリスト
+    """
+    materials = {}
+    days = {}
+    for material_id, start_time, end_time in sessions:
+        seconds = end_time - start_time if end_time is not None else 0
+        day = from_epoch(start_time).strftime('%Y-%m-%d')
+        total = materials.setdefault(material_id, [0, 0])
+        total[0] += seconds
+        total[1] += 1
+        total = days.setdefault((day, material_id), [0, 0])
+        total[0] += seconds
+        total[1] += 1
+    _add(
+        cursor,
+        [(material_id, seconds, count) for material_id, (seconds, count) in materials.items()],
+        [(day, material_id, seconds, count) for (day, material_id), (seconds, count) in days.items()],
+    )
+
+
+def apply_session(cursor, session_id, sign):
+    """
+    セッション1件ぶんの時間を集計テーブルに足す（sign=1）または引く（sign=-1）
+    セッションを書き換える前に -1、書き換えた後に +1 で呼ぶ
+    """
+    cursor.execute(f'''
+        SELECT material_id, {session_day()}, {SESSION_SECONDS}
+        FROM sessions
+        WHERE id = ?
+    ''', (session_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return
+    material_id, day, seconds = row
+    _add(cursor, [(material_id, sign * seconds, sign)], [(day, material_id, sign * seconds, sign)])
+
+    if sign < 0:
+        # セッションがなくなった行は削除する（元の集計と同じく、セッションのない教材は表示しない）
+        cursor.execute('DELETE FROM material_study_totals WHERE material_id = ? AND session_count <= 0', (material_id,))
+        cursor.execute('DELETE FROM daily_study_totals WHERE day = ? AND material_id = ? AND session_count <= 0', (day, material_id))
+
+
+def _add_exercise(cursor, rows):
+    """(日, 運動メニューID, 記録値, 件数) を運動の集計テーブルに足し込む"""
+    cursor.executemany('''
+        INSERT INTO daily_exercise_totals (day, exercise_id, total_value, log_count)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (day, exercise_id) DO UPDATE SET
+            total_value = daily_exercise_totals.total_value + excluded.total_value,
+            log_count = daily_exercise_totals.log_count + excluded.log_count
+    ''', rows)
+
+
+def apply_new_exercise_logs(cursor, logs):
+    """
+    まとめて追加した運動の記録を集計テーブルに足す（一括インポート用）
+    :param logs: (運動メニューID, 記録値, 記録タイプ, 記録時刻（'YYYY-MM-DD HH:MM:SS'）) のリスト
+    """
+    days = {}
+    for exercise_id, value, _, record_time in logs:
+        total = days.setdefault((_local_day(record_time), exercise_id), [0, 0])
+        total[0] += value or 0
+        total[1] += 1
+    _add_exercise(cursor, [(day, exercise_id, value, count) for (day, exercise_id), (value, count) in days.items()])
+
+
+def apply_exercise_log(cursor, log_id, sign):
+    """
+    運動の記録1件ぶんを集計テーブルに足す（sign=1）または引く（sign=-1）
+    記録を書き換える前に -1、書き換えた後に +1 で呼ぶ
+    """
+    cursor.execute(f'''
+        SELECT exercise_id, {exercise_day()}, COALESCE(value, 0)
+        FROM exercise_sessions
+        WHERE id = ?
+    ''', (log_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return
+    exercise_id, day, value = row
+    _add_exercise(cursor, [(day, exercise_id, sign * value, sign)])
+    if sign < 0:
+        cursor.execute(
+            'DELETE FROM daily_exercise_totals WHERE day = ? AND exercise_id = ? AND log_count <= 0', (day, exercise_id)
+        )
+
+
+def _source(cursor):
+    """集計の元になるテーブル（保管したセッションを含むビューがあればそれを使う）"""
+    return 'all_sessions' if dialect().has_relation(cursor, 'all_sessions') else 'sessions'
+
+
+def _exercise_source(cursor):
+    return 'all_exercise_sessions' if dialect().has_relation(cursor, 'all_exercise_sessions') else 'exercise_sessions'
+
+
+def _aggregate_material(cursor):
+    cursor.execute(f'''
+        SELECT material_id, SUM({SESSION_SECONDS}), COUNT(*)
+        FROM {_source(cursor)}
+        GROUP BY material_id
+    ''')
+    return cursor.fetchall()
+
+
+def _aggregate_daily(cursor):
+    cursor.execute(f'''
+        SELECT {session_day()}, material_id, SUM({SESSION_SECONDS}), COUNT(*)
+        FROM {_source(cursor)}
+        GROUP BY 1, material_id
+    ''')
+    return cursor.fetchall()
+
+
+def _aggregate_exercise_daily(cursor):
+    cursor.execute(f'''
+        SELECT {exercise_day()}, exercise_id, SUM(COALESCE(value, 0)), COUNT(*)
+        FROM {_exercise_source(cursor)}
+        GROUP BY 1, exercise_id
+    ''')
+    return cursor.fetchall()
+
+
+def rebuild(cursor):
+    """集計テーブルを sessions から作り直す"""
+    create_tables(cursor)
+    cursor.execute('DELETE FROM material_study_totals')
+    cursor.execute('DELETE FROM daily_study_totals')
+    cursor.executemany(
+        'INSERT INTO material_study_totals (material_id, total_seconds, session_count) VALUES (?, ?, ?)',
+        _aggregate_material(cursor),
+    )
+    cursor.executemany(
+        'INSERT INTO daily_study_totals (day, material_id, total_seconds, session_count) VALUES (?, ?, ?, ?)',
+        _aggregate_daily(cursor),
+    )
+
+
+def rebuild_exercise(cursor):
+    """運動の集計テーブルを exercise_sessions から作り直す"""
+    create_exercise_tables(cursor)
+    cursor.execute('DELETE FROM daily_exercise_totals')
+    cursor.executemany(
+        'INSERT INTO daily_exercise_totals (day, exercise_id, total_value, log_count) VALUES (?, ?, ?, ?)',
+        _aggregate_exercise_daily(cursor),
+    )
+
+
+def _diff(expected, actual):
+    """(キー..., 秒または記録値, 件数) の行リスト同士を比較し、食い違うキーを返す（どちらも整数なので完全に一致させる）"""
+    expected = {row[:-2]: row[-2:] for row in expected}
+    actual = {row[:-2]: row[-2:] for row in actual}
+    mismatches = []
+    for key in sorted(expected.keys() | actual.keys(), key=str):
+        want = expected.get(key, (0, 0))
+        got = actual.get(key, (0, 0))
+        if want != got:
+            mismatches.append((key, want, got))
+    return mismatches
+
+
+def verify(cursor):
+    """
+    集計テーブルが sessions と一致しているか確認する
+    :return: (テーブル名, キー, 正しい値, 集計テーブルの値) のリスト（一致していれば空）
+    """
+    cursor.execute('SELECT material_id, total_seconds, session_count FROM material_study_totals')
+    material_rows = cursor.fetchall()
+    cursor.execute('SELECT day, material_id, total_seconds, session_count FROM daily_study_totals')
+    daily_rows = cursor.fetchall()
+    cursor.execute('SELECT day, exercise_id, total_value, log_count FROM daily_exercise_totals')
+    exercise_rows = cursor.fetchall()
+    return (
+        [('material_study_totals',) + m for m in _diff(_aggregate_material(cursor), material_rows)]
+        + [('daily_study_totals',) + m for m in _diff(_aggregate_daily(cursor), daily_rows)]
+        + [('daily_exercise_totals',) + m for m in _diff(_aggregate_exercise_daily(cursor), exercise_rows)]
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="勉強時間・運動の記録の集計テーブルを管理する")
+    parser.add_argument("command", choices=["rebuild", "verify"])
+    args = parser.parse_args(argv)
+
+    with connect() as conn:
+        cursor = conn.cursor()
+        create_tables(cursor)
+        create_exercise_tables(cursor)
+        if args.command == "rebuild":
+            rebuild(cursor)
+            rebuild_exercise(cursor)
+            print("集計テーブルを再構築しました。")
+            return 0
+
+        mismatches = verify(cursor)
+    for table, key, want, got in mismatches:
+        print(f"{table} {key}: 期待値 {want} / 実際 {got}")
+    if mismatches:
+        print(f"{len(mismatches)} 件の不一致があります。`python rollup.py rebuild` で再構築してください。")
+        return 1
+    print("集計テーブルは sessions・exercise_sessions と一致しています。")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
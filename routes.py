@@ -1,151 +1,376 @@
-import sqlite3
-from datetime import datetime, timedelta
-
-from flask import render_template, request, redirect, flash
+import accounts
+import db
+import events
+import goals
+
+from cache import cached_fragment, data_version, fragment_cache, invalidate_reference_cache, ongoing_session, read_data_version, reference_cache, stats_cache
+import http_cache
+import instrumentation
+from parallel_reads import gather
+from http_cache import conditional
+from db import transaction
+from datetime import date, datetime, timedelta
+
+from flask import render_template, request, redirect, flash, url_for, jsonify, Response, stream_with_context, session as login_session
 from database import (
     get_categories,
     get_materials,
     get_sessions,
+    get_sessions_page,
+    get_session_months,
+    get_study_time_buckets,
+    STATS_BUCKETS,
+    STATS_GROUPS,
     add_category,
+    update_category,
+    delete_category,
     add_material,
+    update_material,
+    delete_material,
+    add_exercise_category,
+    get_exercise_category,
+    update_exercise_category,
+    delete_exercise_category,
+    add_exercise,
+    get_exercise,
+    update_exercise,
+    delete_exercise,
+    add_exercise_log,
+    get_exercise_log,
+    update_exercise_log,
     start_session,
     stop_session,
     update_session,
     delete_session,
-    get_total_study_time,
-    get_monthly_study_time,
-    get_overall_past_days_study_time,
-    get_past_days_study_time
+    get_material_totals,
+    get_category_totals,
+    get_material_presence_stats,
+    get_ongoing_session,
+    get_session_contribution,
+    get_category_list,
+    get_active_categories,
+    get_material_list,
+    get_exercise_menu,
+    get_exercise_categories,
+    get_all_exercises,
+    get_all_exercise_categories,
+    get_recent_exercise_logs,
+    get_exercise_logs_page,
 )
-from utils import format_duration, format_start_time, format_start_date, format_end_time
-from utils import format_datetime_for_input
+from utils import format_duration, format_sessions
+from utils import format_datetime_for_input, to_epoch
 from discord_presence import update_status, clear_status
+from export import MIMETYPES, stream_sessions, stream_exercise_logs
+from importer import KINDS as IMPORT_KINDS, FORMATS as IMPORT_FORMATS, import_file
+
+def parse_export_args():
+    """
+    エクスポートの形式と期間（?format=csv|ndjson&from=YYYY-MM-DD&to=YYYY-MM-DD）を取得
+    :return: (形式, 開始日の datetime, 終了日の翌日の datetime)。不正な値の場合は ValueError（翌日が 9999年を超える場合は OverflowError）
+    """
+    fmt = request.args.get('format', 'csv')
+    if fmt not in MIMETYPES:
+        raise ValueError(fmt)
+    start = request.args.get('from')
+    end = request.args.get('to')
+    start = datetime.strptime(start, '%Y-%m-%d') if start else None
+    # 終了日はその日を含める
+    end = datetime.strptime(end, '%Y-%m-%d') + timedelta(days=1) if end else None
+    return fmt, start, end
+
+def export_response(chunks, fmt, name):
+    return Response(
+        stream_with_context(chunks),
+        mimetype=MIMETYPES[fmt],
+        headers={"Content-Disposition": f"attachment; filename={name}.{fmt}"},
+    )
+
+def render_session_row(row):
+    """イベントで送るセッション一覧の1行分の HTML（row は get_sessions(session_id=...) の結果）"""
+    if row is None:
+        return None
+    return render_template('session_row.html', session=format_sessions([row])[0])
+
+def goals_panel(scopes):
+    """目標の表の HTML（data_version と「今日」ごとにキャッシュする）"""
+    return cached_fragment(
+        'goals', (scopes, date.today()),
+        lambda: render_template('goals_panel.html', goals=goals.goal_statuses(scopes)),
+    )
+
+HISTORY_PAGE_SIZE = 50  # 履歴ページの1ページあたりの件数
+HISTORY_MAX_PAGE_SIZE = 500
+
+def safe_next_page(default='/'):
+    """ログイン後の移動先（同じサイトのパスだけを使う）"""
+    next_page = request.args.get('next') or default
+    if not next_page.startswith('/') or next_page.startswith('//'):
+        return default
+    return next_page
 
 def configure_routes(app):
     @app.route('/')
     def home():
         return redirect('/study') # デフォルトは勉強ページ
 
-    @app.route('/study')
-    def index():
-        categories = get_categories()
-        materials = get_materials()
-        sessions = get_sessions()
-
-        # 累計時間の計算
-        with sqlite3.connect('study.db') as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT materials.name, SUM(
-                    CASE 
-                        WHEN sessions.end_time IS NOT NULL THEN 
-                            (julianday(sessions.end_time) - julianday(sessions.start_time)) * 24 * 60
-                        ELSE 0
-                    END
-                ) AS total_minutes
-                FROM sessions
-                JOIN materials ON sessions.material_id = materials.id
-                GROUP BY materials.name
-            ''')
-            material_totals = cursor.fetchall()
-
-            cursor.execute('''
-                SELECT categories.name, SUM(
-                    CASE 
-                        WHEN sessions.end_time IS NOT NULL THEN 
-                            (julianday(sessions.end_time) - julianday(sessions.start_time)) * 24 * 60
-                        ELSE 0
-                    END
-                ) AS total_minutes
-                FROM sessions
-                JOIN materials ON sessions.material_id = materials.id
-                JOIN categories ON materials.category_id = categories.id
-                GROUP BY categories.name
-            ''')
-            category_totals = cursor.fetchall()
-
-        # フォーマット済み累計時間
-        formatted_material_totals = [
-            (material, format_duration(total)) for material, total in material_totals
-        ]
-        formatted_category_totals = [
-            (category, format_duration(total)) for category, total in category_totals
-        ]
-        # 進行中のセッションを取得
-        with sqlite3.connect('study.db') as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT sessions.id, materials.name, sessions.start_time FROM sessions JOIN materials ON sessions.material_id = materials.id WHERE sessions.end_time IS NULL LIMIT 1')
-            ongoing_session = cursor.fetchone()
-
-        # 昨日の日付を取得
-        yesterday = datetime.now() - timedelta(days=1)
-
-        # 昨日以降のセッションを取得（降順でソート）
-        all_sessions = get_sessions(order_by="start_time DESC")
-        recent_sessions = [
-            session for session in all_sessions
-            if datetime.fromisoformat(session[2]) >= yesterday
-        ]
+    @app.route('/login', methods=['GET', 'POST'])
+    def login():
+        """複数ユーザーのモードのログイン（accounts.py）"""
+        if not accounts.enabled():
+            return redirect('/')
+        if request.method == 'POST':
+            user_id = accounts.authenticate(request.form['name'], request.form['password'])
+            if user_id is None:
+                flash("名前またはパスワードが正しくありません。")
+                return redirect(url_for('login', next=request.args.get('next')))
+            login_session.clear()
+            login_session['user_id'] = user_id
+            login_session['user_name'] = request.form['name']
+            return redirect(safe_next_page())
+        return render_template(
+            'login.html',
+            next_page=request.args.get('next', ''),
+            allow_signup=accounts.ALLOW_SIGNUP,
+            min_password_length=accounts.MIN_PASSWORD_LENGTH,
+        )
 
-        enriched_sessions = []
-        for session in recent_sessions:
-            session_id, material_name, start_time, end_time = session
-            formatted_start_time = format_start_time(start_time)
-            formatted_start_date = format_start_date(start_time)
-            if end_time:
-                formatted_end_time = format_end_time(end_time)
-                duration = format_duration(
-                    (datetime.fromisoformat(end_time) - datetime.fromisoformat(start_time)).total_seconds() / 60
-                )
-            else:
-                formatted_end_time = "未終了"
-                duration = "進行中"
+    @app.route('/register', methods=['POST'])
+    def register():
+        if not accounts.enabled() or not accounts.ALLOW_SIGNUP:
+            return "新規登録は受け付けていません。", 403
+        name = request.form['name'].strip()
+        password = request.form['password']
+        if not name or len(password) < accounts.MIN_PASSWORD_LENGTH:
+            return f"名前と{accounts.MIN_PASSWORD_LENGTH}文字以上のパスワードを入力してください。", 400
+        user_id = accounts.create_user(name, password)
+        if user_id is None:
+            return "この名前は既に使われています。", 400
+        login_session.clear()
+        login_session['user_id'] = user_id
+        login_session['user_name'] = name
+        return redirect('/')
 
-            enriched_sessions.append((formatted_start_date, material_name, formatted_start_time, formatted_end_time, duration, session_id))
+    @app.route('/logout', methods=['POST'])
+    def logout():
+        login_session.clear()
+        return redirect(url_for('login') if accounts.enabled() else '/')
 
-        return render_template(
-            'study.html',
-            active_page='study',
-            categories=categories,
-            materials=materials,
-            sessions=enriched_sessions,
-            material_totals=formatted_material_totals,
-            category_totals=formatted_category_totals,
-            ongoing_session=ongoing_session,
+    @app.route('/study')
+    @conditional(bucket=http_cache.MINUTE)
+    def index():
+        def render_totals():
+            # 累計時間の計算（集計テーブルから教材数ぶんの行だけを読む）
+            material_totals = get_material_totals()
+            category_totals = get_category_totals()
+
+            # フォーマット済み累計時間（/events の差分を足せるよう分も渡す）
+            formatted_material_totals = [
+                (material, format_duration(total), total) for material, total in material_totals
+            ]
+            formatted_category_totals = [
+                (category, format_duration(total), total) for category, total in category_totals
+            ]
+            return render_template(
+                'totals_tables.html',
+                material_totals=formatted_material_totals,
+                category_totals=formatted_category_totals,
+            )
+
+        # 昨日の日付を取得（描画済みの表を使い回せるよう分単位に切り捨てる）
+        yesterday = datetime.now().replace(second=0, microsecond=0) - timedelta(days=1)
+
+        def render_sessions():
+            # 昨日以降のセッションを取得（降順でソート）
+            recent_sessions = get_sessions(order_by="start_time DESC", start_date=yesterday)
+            return render_template('session_table.html', sessions=format_sessions(recent_sessions))
+
+        # 互いに依存しない読み込みを読み込み用のスレッドで同時に実行する
+        reads = gather(
+            sessions_table=lambda: cached_fragment('recent_sessions', (yesterday,), render_sessions),
+            totals_tables=lambda: cached_fragment('totals', (), render_totals),
+            goals_panel=lambda: goals_panel(goals.STUDY_SCOPES),
+            # 進行中のセッション（データが変わっていなければデータベースを読まない）
+            ongoing_session=lambda: ongoing_session.get(get_ongoing_session),
+            categories=get_categories,
+            materials=get_materials,
         )
+        return render_template('study.html', active_page='study', **reads)
 
     @app.route('/history')
+    @conditional(bucket=http_cache.MINUTE)
     def history():
-        # 昨日より前のセッションを取得（降順でソート）
-        yesterday = datetime.now() - timedelta(days=1)
-        all_sessions = get_sessions(order_by="start_time DESC")
-        old_sessions = [
-            session for session in all_sessions
-            if datetime.fromisoformat(session[2]) < yesterday
-        ]
-
-        enriched_sessions = []
-        for session in old_sessions:
-            session_id, material_name, start_time, end_time = session
-            formatted_start_time = format_start_time(start_time)
-            formatted_start_date = format_start_date(start_time)
-            if end_time:
-                formatted_end_time = format_end_time(end_time)
-                duration = format_duration(
-                    (datetime.fromisoformat(end_time) - datetime.fromisoformat(start_time)).total_seconds() / 60
+        # 昨日より前のセッションを取得（降順でソート、描画済みの表を使い回せるよう分単位に切り捨てる）
+        before = datetime.now().replace(second=0, microsecond=0) - timedelta(days=1)
+
+        # 月へのジャンプ（その月の末日以前のセッションから表示）
+        month = request.args.get('month')
+        if month:
+            try:
+                month_start = datetime.strptime(month, '%Y-%m')
+                # 翌月の1日（9999年12月の翌月は作れないので ValueError）
+                next_month_start = month_start.replace(year=month_start.year + month_start.month // 12, month=month_start.month % 12 + 1)
+            except ValueError:
+                return "月の指定が正しくありません。", 400
+            before = min(before, next_month_start)
+
+        # 前のページの最後の行（開始時刻, ID）から続きを取得
+        cursor = None
+        cursor_time = request.args.get('cursor_time', type=int)
+        cursor_id = request.args.get('cursor_id', type=int)
+        if cursor_time is not None and cursor_id is not None:
+            cursor = (cursor_time, cursor_id)
+
+        page_size = min(max(request.args.get('size', HISTORY_PAGE_SIZE, type=int), 1), HISTORY_MAX_PAGE_SIZE)
+
+        def render_sessions():
+            old_sessions, next_cursor = get_sessions_page(before, cursor=cursor, limit=page_size)
+
+            next_page_url = None
+            if next_cursor:
+                next_page_url = url_for(
+                    'history', month=month, size=page_size,
+                    cursor_time=next_cursor[0], cursor_id=next_cursor[1],
                 )
-            else:
-                formatted_end_time = "未終了"
-                duration = "進行中"
+            return render_template(
+                'session_table.html',
+                sessions=format_sessions(old_sessions),
+                edit_next='/history',
+                next_page_url=next_page_url,
+            )
+
+        reads = gather(
+            sessions_table=lambda: cached_fragment('history', (before, month, cursor, page_size), render_sessions),
+            months=get_session_months,
+        )
+        return render_template(
+            'history.html',
+            current_month=month,
+            active_page='history',
+            **reads,
+        )
+
+    @app.route('/export/sessions')
+    def export_sessions():
+        """セッションを CSV / NDJSON でエクスポート"""
+        try:
+            fmt, start, end = parse_export_args()
+            # エポック秒にできない日付は送信を始める前に弾く
+            start, end = to_epoch(start), to_epoch(end)
+        except (ValueError, OverflowError):
+            return "エクスポートの形式または期間の指定が正しくありません。", 400
+        return export_response(stream_sessions(fmt, start, end), fmt, "sessions")
+
+    @app.route('/import', methods=['GET', 'POST'])
+    def import_data():
+        """セッション・運動の記録を CSV / NDJSON ファイルから一括でインポート"""
+        result = None
+        if request.method == 'POST':
+            kind = request.form['kind']
+            fmt = request.form['format']
+            upload = request.files.get('file')
+            if kind not in IMPORT_KINDS or fmt not in IMPORT_FORMATS or not upload:
+                return "インポートの種類・形式・ファイルを指定してください。", 400
+            result = import_file(kind, upload.stream, fmt)
+        return render_template('import.html', result=result, active_page='import')
+
+    @app.route('/api/stats')
+    @conditional(bucket=http_cache.DAY)
+    def api_stats():
+        """
+        期間内の勉強時間を区切り・グループごとに集計した JSON（グラフ・ヒートマップ用）
+        - start / end: YYYY-MM-DD（end を含む、省略時は今日までの30日間）
+        - bucket: day / week / month（省略時は day）
+        - group: material / category（省略時は material）
+        """
+        bucket = request.args.get('bucket', 'day')
+        group = request.args.get('group', 'material')
+        if bucket not in STATS_BUCKETS or group not in STATS_GROUPS:
+            return "bucket または group の指定が正しくありません。", 400
+        try:
+            end = datetime.strptime(request.args['end'], '%Y-%m-%d') if request.args.get('end') else datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+            start = datetime.strptime(request.args['start'], '%Y-%m-%d') if request.args.get('start') else end - timedelta(days=29)
+            # 集計する範囲のエポック秒（終了日はその日を含める。エポック秒にできない日付はここで弾く）
+            since, until = to_epoch(start), to_epoch(end + timedelta(days=1))
+        except (ValueError, OverflowError):
+            return "期間の指定が正しくありません。", 400
+        if start > end:
+            return "開始日が終了日より後です。", 400
+
+        def load():
+            rows = get_study_time_buckets(since, until, bucket, group)
+            series = {}
+            for label, key, name, minutes in rows:
+                entry = series.setdefault(key, {"id": key, "name": name, "total_minutes": 0.0, "points": []})
+                entry["points"].append({"bucket": label, "minutes": round(minutes, 2)})
+                entry["total_minutes"] += minutes
+            for entry in series.values():
+                entry["total_minutes"] = round(entry["total_minutes"], 2)
+            return {
+                "start": start.strftime('%Y-%m-%d'),
+                "end": end.strftime('%Y-%m-%d'),
+                "bucket": bucket,
+                "group": group,
+                "buckets": sorted({row[0] for row in rows}),
+                "series": list(series.values()),
+                "total_minutes": round(sum(row[3] for row in rows), 2),
+            }
+
+        version, _ = data_version()
+        return jsonify(stats_cache.get((version, start, end, bucket, group), load))
+
+    @app.route('/events')
+    def events_stream():
+        """セッションの開始・終了・編集と累計時間の差分を Server-Sent Events で送る（events.py）"""
+        subscription = events.subscribe(request.headers.get('Last-Event-ID'))
+        if subscription is None:
+            return "接続数が上限に達しています。", 503
+        return Response(
+            events.stream(subscription),
+            mimetype='text/event-stream',
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
 
-            enriched_sessions.append((formatted_start_date, material_name, formatted_start_time, formatted_end_time, duration, session_id))
+    @app.route('/internal/stats')
+    def internal_stats():
+        """監視用: データベース接続とキャッシュの統計"""
+        return jsonify(
+            db_pool=db.stats(),
+            reference_cache=reference_cache.stats(),
+            fragment_cache=fragment_cache.stats(),
+            stats_cache=stats_cache.stats(),
+            ongoing_session=ongoing_session.stats(),
+            conditional_get=http_cache.stats(),
+            events=events.stats(),
+        )
 
-        return render_template('history.html', sessions=enriched_sessions, active_page='history')
+    @app.route('/metrics')
+    def metrics():
+        """監視用: Prometheus のテキスト形式の統計"""
+        pool = db.stats()
+        gauges = [
+            ("study_db_pool_open", "開いている接続の数", pool["open"]),
+            ("study_db_pool_idle", "空いている接続の数", pool["idle"]),
+            ("study_db_pool_opened_total", "作成した接続の数", pool["opened"]),
+            ("study_db_pool_reused_total", "再利用した接続の数", pool["reused"]),
+        ]
+        for name, cache in (("reference", reference_cache), ("fragment", fragment_cache), ("stats", stats_cache)):
+            values = cache.stats()
+            gauges.append((f"study_{name}_cache_entries", f"{name} キャッシュの件数", values["entries"]))
+            gauges.append((f"study_{name}_cache_hits_total", f"{name} キャッシュのヒット数", values["hits"]))
+            gauges.append((f"study_{name}_cache_misses_total", f"{name} キャッシュのミス数", values["misses"]))
+        conditional_get = http_cache.stats()
+        gauges.append(("study_http_not_modified_total", "304 を返した数", conditional_get["not_modified"]))
+        event_stats = events.stats()
+        gauges.append(("study_events_clients", "/events に接続中のクライアント数", event_stats["clients"]))
+        gauges.append(("study_events_published_total", "送ったイベントの数", event_stats["published"]))
+        gauges.append(("study_events_dropped_total", "キューがあふれて捨てたイベントの数", event_stats["dropped"]))
+        return Response(instrumentation.render_metrics(gauges), mimetype='text/plain; version=0.0.4')
 
     @app.route('/add_category', methods=['POST'])
     def add_category_route():
         name = request.form['name']
         add_category(name)
+        invalidate_reference_cache()
         return redirect('/')
 
     @app.route('/add_material', methods=['POST'])
@@ -153,41 +378,65 @@ def configure_routes(app):
         name = request.form['name']
         category_id = request.form['category_id']
         add_material(name, category_id)
+        invalidate_reference_cache()
         return redirect('/')
 
     @app.route('/start_session', methods=['POST'])
     def start_session_route():
         material_id = request.form['material_id']
-        with sqlite3.connect('study.db') as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT id FROM sessions WHERE end_time IS NULL LIMIT 1')
-            ongoing_session = cursor.fetchone()
-            if ongoing_session:
-                return "進行中のセッションが既に存在します。", 400
-            cursor.execute("SELECT name, discord_image_key FROM materials WHERE id = ?", (material_id,))
-            material = cursor.fetchone()
-            material_name = material[0]
-            image_key = material[1] if material[1] else "image"  # 画像キーが設定されていない場合はデフォルトを使用
-        # 過去30日の勉強時間を取得
-        overall_recent_time = get_overall_past_days_study_time(days=30)
-        # 教材ごとの累計時間と過去30日間の時間を取得
-        material_total_time = get_total_study_time(material_id)
-        material_recent_time = get_past_days_study_time(material_id, days=30)
-        # セッション開始
-        start_session(material_id)
+        # 確認・集計・セッション開始を1つのトランザクションで行う
+        # （BEGIN IMMEDIATE で書き込みロックを先に取り、同時に開始されても2件目は待ってから確認する）
+        try:
+            with transaction(immediate=True):
+                if get_ongoing_session():
+                    return "進行中のセッションが既に存在します。", 400
+                # 教材名・画像キー・累計時間・過去30日の勉強時間をまとめて取得
+                stats = get_material_presence_stats(material_id, days=30)
+                if stats is None:
+                    return "教材が見つかりません。", 400
+                # セッション開始
+                session_id = start_session(material_id)
+                current_session = get_ongoing_session()
+                row = get_sessions(session_id=session_id)
+                version, _ = read_data_version()
+        except db.dialect().integrity_errors:
+            # 他のプロセスが先に開始した（idx_sessions_single_open）
+            return "進行中のセッションが既に存在します。", 400
+        ongoing_session.set(current_session, version)
+        events.publish('session_started', {
+            "id": session_id,
+            "ongoing": events.ongoing_payload(current_session),
+            "row": render_session_row(row),
+        }, version)
+        image_key = stats["image_key"] or "image"  # 画像キーが設定されていない場合はデフォルトを使用
         # Discordステータスを更新
-        update_status(material_name, material_total_time, material_recent_time, overall_recent_time, image_key)
+        update_status(
+            stats["name"],
+            stats["total_minutes"],
+            stats["recent_minutes"],
+            stats["overall_recent_minutes"],
+            image_key,
+        )
         return redirect('/')
 
     @app.route('/stop_session', methods=['POST'])
     def stop_session_route():
-        with sqlite3.connect('study.db') as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT id FROM sessions WHERE end_time IS NULL LIMIT 1')
-            ongoing_session = cursor.fetchone()
-            if not ongoing_session:
+        with transaction(immediate=True):
+            session_id = stop_session()
+            if session_id is None:
                 return "進行中のセッションがありません。", 400
-            stop_session()
+            row = get_sessions(session_id=session_id)
+            contribution = get_session_contribution(session_id)
+            version, _ = read_data_version()
+        ongoing_session.set(None, version)
+        # 進行中のセッションは0分として数えているので、終了した分だけ累計が増える
+        events.publish('session_stopped', {
+            "id": session_id,
+            "ongoing": None,
+            "row": render_session_row(row),
+            "totals": events.totals_delta(None, contribution),
+            "goals": goals_panel(goals.STUDY_SCOPES),
+        }, version)
         clear_status()
         return redirect('/')
 
@@ -199,41 +448,82 @@ def configure_routes(app):
             "id": session[0],  # ID
             "material": session[1],  # 教材名
             "start_time": format_datetime_for_input(session[2]),  # 開始時刻
-            "end_time": format_datetime_for_input(session[3]) if session[3] else None,  # 終了時刻
+            "end_time": format_datetime_for_input(session[3]),  # 終了時刻
         }
         return render_template('edit_session.html', session=session, materials=materials)
     
     @app.route('/update_session', methods=['POST'])
     def update_session_route():
-        session_id = request.form['session_id']
+        session_id = request.form.get('session_id', type=int)
+        if session_id is None:
+            return "セッションの指定が正しくありません。", 400
         material_id = request.form['material_id']
-        start_time = request.form['start_time']
-        end_time = request.form['end_time'] or None  # 空の場合はNoneに設定
-        update_session(session_id, material_id, start_time, end_time)
+        # 日時はトランザクションの前にエポック秒にする（end_time が空の場合は None）
+        try:
+            start_time = to_epoch(request.form['start_time'])
+            end_time = to_epoch(request.form['end_time'])
+        except (ValueError, OverflowError):
+            return "日時の形式が正しくありません。", 400
+        if start_time is None:
+            return "開始時刻がありません。", 400
+        if end_time is not None and end_time < start_time:
+            return "終了時刻が開始時刻より前です。", 400
+        # 変更前後の累計時間への寄与を同じトランザクションで読み、差分をイベントで送る
+        try:
+            with transaction(immediate=True):
+                before = get_session_contribution(session_id)
+                update_session(session_id, material_id, start_time, end_time)
+                after = get_session_contribution(session_id)
+                row = get_sessions(session_id=session_id)
+                current_session = get_ongoing_session()
+                version, _ = read_data_version()
+        except db.dialect().integrity_errors as error:
+            # 終了時刻を空にしたが、他に進行中のセッションがある（idx_sessions_single_open）
+            if not db.dialect().violates(error, 'idx_sessions_single_open'):
+                raise
+            return "進行中のセッションが既に存在します。", 400
+        ongoing_session.set(current_session, version)
+        events.publish('session_updated', {
+            "id": session_id,
+            "ongoing": events.ongoing_payload(current_session),
+            "row": render_session_row(row),
+            "totals": events.totals_delta(before, after),
+            "goals": goals_panel(goals.STUDY_SCOPES),
+        }, version)
         next_page = request.args.get('next') or '/'
         return redirect(next_page)
 
     @app.route('/delete_session', methods=['POST'])
     def delete_session_route():
-        session_id = request.form['session_id']
-        delete_session(session_id)
+        session_id = request.form.get('session_id', type=int)
+        if session_id is None:
+            return "セッションの指定が正しくありません。", 400
+        with transaction(immediate=True):
+            before = get_session_contribution(session_id)
+            delete_session(session_id)
+            current_session = get_ongoing_session()
+            version, _ = read_data_version()
+        ongoing_session.set(current_session, version)
+        events.publish('session_deleted', {
+            "id": session_id,
+            "ongoing": events.ongoing_payload(current_session),
+            "row": None,
+            "totals": events.totals_delta(before, None),
+            "goals": goals_panel(goals.STUDY_SCOPES),
+        }, version)
         next_page = request.args.get('next') or '/'
         return redirect(next_page)
 
     @app.route('/categories', methods=['GET', 'POST'])
     def manage_categories():
-        with sqlite3.connect("study.db") as conn:
-            cursor = conn.cursor()
-
-            # POSTリクエストでカテゴリを追加
-            if request.method == 'POST':
-                name = request.form['name']
-                cursor.execute("INSERT INTO categories (name, is_active) VALUES (?, 1)", (name,))
-                conn.commit()
-            
-            # カテゴリの一覧を取得
-            cursor.execute("SELECT id, name, is_active FROM categories")
-            categories = cursor.fetchall()
+        # POSTリクエストでカテゴリを追加
+        if request.method == 'POST':
+            name = request.form['name']
+            add_category(name)
+            invalidate_reference_cache()
+
+        # カテゴリの一覧を取得
+        categories = get_category_list()
 
         return render_template('categories.html', categories=categories, active_page='categories')
 
@@ -241,50 +531,35 @@ def configure_routes(app):
     def edit_category(category_id):
         name = request.form['name']
         is_active = request.form.get('is_active', '0') == '1'
-        with sqlite3.connect("study.db") as conn:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE categories SET name = ?, is_active = ? WHERE id = ?", (name, int(is_active), category_id))
-            conn.commit()
+        update_category(category_id, name, is_active)
+        invalidate_reference_cache()
         return redirect('/categories')
 
     @app.route('/categories/delete/<int:category_id>', methods=['POST'])
-    def delete_category(category_id):
-        with sqlite3.connect("study.db") as conn:
-            cursor = conn.cursor()
-            # 該当カテゴリが教材に使用されているか確認
-            cursor.execute("SELECT COUNT(*) FROM materials WHERE category_id = ?", (category_id,))
-            if cursor.fetchone()[0] == 0:
-                cursor.execute("DELETE FROM categories WHERE id = ?", (category_id,))
-                conn.commit()
-                flash("カテゴリを削除しました。", "success")
-            else:
-                flash("このカテゴリは教材に使用されているため削除できません。")
+    def delete_category_route(category_id):
+        # 該当カテゴリが教材に使用されている場合は削除しない
+        if delete_category(category_id):
+            flash("カテゴリを削除しました。", "success")
+        else:
+            flash("このカテゴリは教材に使用されているため削除できません。")
+        invalidate_reference_cache()
         return redirect('/categories')
 
     @app.route('/materials', methods=['GET', 'POST'])
     def manage_materials():
-        with sqlite3.connect("study.db") as conn:
-            cursor = conn.cursor()
-
-            # POSTリクエストで教材を追加
-            if request.method == 'POST':
-                name = request.form['name']
-                category_id = request.form['category_id']
-                discord_image_key = request.form['discord_image_key'] if 'discord_image_key' in request.form else ""
-                cursor.execute("INSERT INTO materials (name, category_id, discord_image_key, is_active) VALUES (?, ?, ?, 1)", (name, category_id, discord_image_key))
-                conn.commit()
-
-            # 教材の一覧を取得
-            cursor.execute("""
-                SELECT materials.id, materials.name, materials.is_active, materials.discord_image_key, categories.name AS category_name
-                FROM materials
-                JOIN categories ON materials.category_id = categories.id
-            """)
-            materials = cursor.fetchall()
-
-            # カテゴリの一覧を取得（教材追加用）
-            cursor.execute("SELECT id, name FROM categories WHERE is_active = 1")
-            categories = cursor.fetchall()
+        # POSTリクエストで教材を追加
+        if request.method == 'POST':
+            name = request.form['name']
+            category_id = request.form['category_id']
+            discord_image_key = request.form['discord_image_key'] if 'discord_image_key' in request.form else ""
+            add_material(name, category_id, discord_image_key)
+            invalidate_reference_cache()
+
+        # 教材の一覧を取得
+        materials = get_material_list()
+
+        # カテゴリの一覧を取得（教材追加用）
+        categories = get_active_categories()
 
         return render_template('materials.html', materials=materials, categories=categories, active_page='materials')
 
@@ -294,268 +569,238 @@ def configure_routes(app):
         category_id = request.form['category_id']
         discord_image_key = request.form['discord_image_key']
         is_active = request.form.get('is_active', '0') == '1'
-        with sqlite3.connect("study.db") as conn:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE materials SET name = ?, category_id = ?, discord_image_key = ?, is_active = ? WHERE id = ?", (name, category_id, discord_image_key, int(is_active), material_id))
-            conn.commit()
+        update_material(material_id, name, category_id, discord_image_key, is_active)
+        invalidate_reference_cache()
         return redirect('/materials')
 
     @app.route('/materials/delete/<int:material_id>', methods=['POST'])
-    def delete_material(material_id):
-        with sqlite3.connect("study.db") as conn:
-            cursor = conn.cursor()
-            # 該当教材がセッションに使用されているか確認
-            cursor.execute("SELECT COUNT(*) FROM sessions WHERE material_id = ?", (material_id,))
-            if cursor.fetchone()[0] == 0:
-                cursor.execute("DELETE FROM materials WHERE id = ?", (material_id,))
-                conn.commit()
-                flash("教材を削除しました。", "success")
-            else:
-                flash("この教材はセッションに使用されているため削除できません。")
+    def delete_material_route(material_id):
+        # 該当教材がセッションに使用されている場合は削除しない（保管したセッションも含める）
+        if delete_material(material_id):
+            flash("教材を削除しました。", "success")
+        else:
+            flash("この教材はセッションに使用されているため削除できません。")
+        invalidate_reference_cache()
         return redirect('/materials')
 
+    @app.route('/goals', methods=['GET', 'POST'])
+    def manage_goals():
+        """目標の一覧と追加（勉強は教材・カテゴリごとの分、運動はメニューごとの記録値）"""
+        if request.method == 'POST':
+            scope, _, target_id = request.form.get('target', '').partition(':')
+            period = request.form.get('period')
+            target = request.form.get('target_value', type=int)
+            if scope not in goals.SCOPES or not target_id.isdigit():
+                return "目標の対象の指定が正しくありません。", 400
+            if period not in goals.PERIODS:
+                return "期間の指定が正しくありません。", 400
+            if target is None or target < 1:
+                return "目標の値の指定が正しくありません。", 400
+            goals.add_goal(scope, int(target_id), period, target)
+            flash("目標を追加しました。", "success")
+            return redirect('/goals')
+
+        return render_template(
+            'goals.html',
+            goals=goals.get_goals(),
+            scopes=goals.SCOPES,
+            periods=goals.PERIODS,
+            materials=get_materials(),
+            categories=get_category_list(),
+            exercises=get_exercise_menu(),
+            active_page='goals',
+        )
+
+    @app.route('/goals/delete/<int:goal_id>', methods=['POST'])
+    def delete_goal_route(goal_id):
+        goals.delete_goal(goal_id)
+        flash("目標を削除しました。", "success")
+        return redirect('/goals')
+
     @app.route('/exercise')
+    @conditional(bucket=http_cache.DAY)
     def exercise_page():
-        """運動の記録ページ（直近 7 日の記録を含む）"""
-        with sqlite3.connect("study.db") as conn:
-            cursor = conn.cursor()
-            
-            # 運動メニュー一覧を取得
-            cursor.execute('''
-                SELECT exercises.id, exercises.name, exercise_categories.name, exercises.value_type
-                FROM exercises
-                JOIN exercise_categories ON exercises.category_id = exercise_categories.id
-                WHERE exercises.is_active = 1
-            ''')
-            exercises = cursor.fetchall()
-
+        """運動の記録ページ（直近 7 日の記録と運動の目標を含む）"""
+        reads = gather(
             # 直近 7 日間の運動記録を取得
-            cursor.execute("""
-                SELECT 
-                    DATE(exercise_sessions.record_time),  -- 記録時間（日付のみ）
-                    exercise_categories.name,            -- 部位カテゴリ
-                    exercises.name,                      -- 運動メニュー
-                    exercise_sessions.value,             -- 記録値
-                    exercise_sessions.value_type         -- 記録タイプ（回 or 分）
-                FROM exercise_sessions
-                JOIN exercises ON exercise_sessions.exercise_id = exercises.id
-                JOIN exercise_categories ON exercises.category_id = exercise_categories.id
-                WHERE DATE(exercise_sessions.record_time) >= DATE('now', '-6 days')  -- 直近7日間
-                ORDER BY exercise_sessions.record_time DESC
-            """)
-            recent_logs = cursor.fetchall()
-
-        return render_template("exercise.html", exercises=exercises, recent_logs=recent_logs, active_page="exercise")
+            recent_logs=lambda: get_recent_exercise_logs(days=7),
+            # 運動メニュー一覧を取得
+            exercises=get_exercise_menu,
+            goals_panel=lambda: goals_panel(goals.EXERCISE_SCOPES),
+        )
+        return render_template("exercise.html", active_page="exercise", **reads)
 
     @app.route('/exercises')
     def exercises():
         """運動メニュー一覧を表示"""
-        with sqlite3.connect("study.db") as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT exercises.id, exercises.name, exercise_categories.name, exercises.value_type
-                FROM exercises
-                JOIN exercise_categories ON exercises.category_id = exercise_categories.id
-                WHERE exercises.is_active = 1
-            ''')
-            exercises = cursor.fetchall()
-
-            cursor.execute("SELECT id, name FROM exercise_categories WHERE is_active = 1")
-            categories = cursor.fetchall()
-
+        exercises = get_exercise_menu()
+        categories = get_exercise_categories()
         return render_template("exercises.html", exercises=exercises, categories=categories, active_page="exercises")
 
     @app.route('/add_exercise', methods=['POST'])
-    def add_exercise():
+    def add_exercise_route():
         """新しい運動メニューを追加"""
         name = request.form['name']
         category_id = request.form['category_id']
         value_type = request.form['value_type']  # 'reps' or 'minutes'
 
-        with sqlite3.connect("study.db") as conn:
-            cursor = conn.cursor()
-            cursor.execute("INSERT INTO exercises (name, category_id, value_type) VALUES (?, ?, ?)", (name, category_id, value_type))
-            conn.commit()
+        add_exercise(name, category_id, value_type)
+        invalidate_reference_cache()
 
         return redirect('/exercises')
 
     @app.route('/exercise_categories')
     def exercise_categories():
         """運動の部位カテゴリ一覧を表示"""
-        with sqlite3.connect("study.db") as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT id, name FROM exercise_categories WHERE is_active = 1")
-            categories = cursor.fetchall()
+        categories = get_exercise_categories()
         return render_template("exercise_categories.html", categories=categories, active_page="exercise_categories")
 
     @app.route('/add_exercise_category', methods=['POST'])
-    def add_exercise_category():
+    def add_exercise_category_route():
         """新しい部位カテゴリを追加"""
         name = request.form['name']
-        with sqlite3.connect("study.db") as conn:
-            cursor = conn.cursor()
-            cursor.execute("INSERT INTO exercise_categories (name) VALUES (?)", (name,))
-            conn.commit()
+        add_exercise_category(name)
+        invalidate_reference_cache()
         return redirect('/exercise_categories')
 
     @app.route('/log_exercise', methods=['POST'])
     def log_exercise():
         """運動の記録を追加"""
         exercise_id = request.form['exercise_id']
-        value = request.form['value']
+        value = request.form.get('value', type=int)
         value_type = request.form['value_type']
+        if value is None:
+            return "値の指定が正しくありません。", 400
 
-        with sqlite3.connect("study.db") as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO exercise_sessions (exercise_id, value, value_type)
-                VALUES (?, ?, ?)
-            """, (exercise_id, value, value_type))
-            conn.commit()
+        add_exercise_log(exercise_id, value, value_type)
 
         return redirect('/exercise')
 
     @app.route('/exercise_log')
+    @conditional()
     def exercise_log():
-        """運動の記録一覧を表示"""
-        with sqlite3.connect("study.db") as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT 
-                    DATE(exercise_sessions.record_time),  -- 記録時間（日付のみ）
-                    exercise_categories.name,            -- 部位カテゴリ
-                    exercises.name,                      -- 運動メニュー
-                    exercise_sessions.value,             -- 記録値
-                    exercise_sessions.value_type,        -- 記録タイプ（回 or 分）
-                    exercise_sessions.id                 -- 運動の記録 ID（編集用）
-                FROM exercise_sessions
-                JOIN exercises ON exercise_sessions.exercise_id = exercises.id
-                JOIN exercise_categories ON exercises.category_id = exercise_categories.id
-                ORDER BY exercise_sessions.record_time DESC
-            """)
-            logs = cursor.fetchall()
-        return render_template("exercise_log.html", logs=logs, active_page="exercise_log")
+        """運動の記録一覧を表示（部位カテゴリ・運動メニュー・期間で絞り込み、キーセットでページ送り）"""
+        category_id = request.args.get('category_id', type=int)
+        exercise_id = request.args.get('exercise_id', type=int)
+        date_from = request.args.get('from') or None
+        date_to = request.args.get('to') or None
+        try:
+            start = datetime.strptime(date_from, '%Y-%m-%d').strftime('%Y-%m-%d') if date_from else None
+            # 終了日はその日を含める
+            end = (datetime.strptime(date_to, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d') if date_to else None
+        except (ValueError, OverflowError):
+            return "期間の指定が正しくありません。", 400
+
+        cursor = None
+        cursor_time = request.args.get('cursor_time')
+        cursor_id = request.args.get('cursor_id', type=int)
+        if cursor_time and cursor_id is not None:
+            cursor = (cursor_time, cursor_id)
+
+        page_size = min(max(request.args.get('size', HISTORY_PAGE_SIZE, type=int), 1), HISTORY_MAX_PAGE_SIZE)
+        logs, next_cursor = get_exercise_logs_page(
+            category_id=category_id, exercise_id=exercise_id,
+            start=start, end=end, cursor=cursor, limit=page_size,
+        )
+
+        next_page_url = None
+        if next_cursor:
+            next_page_url = url_for(
+                'exercise_log', category_id=category_id, exercise_id=exercise_id,
+                size=page_size, cursor_time=next_cursor[0], cursor_id=next_cursor[1],
+                **{'from': date_from, 'to': date_to},
+            )
+
+        return render_template(
+            "exercise_log.html",
+            logs=logs,
+            categories=get_exercise_categories(),
+            exercises=get_exercise_menu(),
+            filters={'category_id': category_id, 'exercise_id': exercise_id, 'from': date_from, 'to': date_to},
+            next_page_url=next_page_url,
+            active_page="exercise_log",
+        )
+
+    @app.route('/export/exercise_log')
+    def export_exercise_log():
+        """運動の記録を CSV / NDJSON でエクスポート"""
+        try:
+            fmt, start, end = parse_export_args()
+        except (ValueError, OverflowError):
+            return "エクスポートの形式または期間の指定が正しくありません。", 400
+        start = start.strftime('%Y-%m-%d') if start else None
+        end = end.strftime('%Y-%m-%d') if end else None
+        return export_response(stream_exercise_logs(fmt, start, end), fmt, "exercise_log")
 
     @app.route('/edit_exercise_log/<int:log_id>', methods=['GET', 'POST'])
     def edit_exercise_log(log_id):
         """運動の記録を編集"""
-        with sqlite3.connect("study.db") as conn:
-            cursor = conn.cursor()
-            
-            if request.method == 'POST':
-                new_date = request.form['record_date']
-                new_exercise_id = request.form['exercise_id']
-                new_value = request.form['value']
-                
-                cursor.execute("""
-                    UPDATE exercise_sessions
-                    SET record_time = ?, exercise_id = ?, value = ?
-                    WHERE id = ?
-                """, (new_date, new_exercise_id, new_value, log_id))
-                conn.commit()
-                
-                return redirect('/exercise_log')
-
-            else:
-                # 編集する記録を取得（記録日を YYYY-MM-DD 形式に変換）
-                cursor.execute("""
-                    SELECT 
-                        exercise_sessions.id, 
-                        STRFTIME('%Y-%m-%d', exercise_sessions.record_time),  -- 日付を YYYY-MM-DD 形式で取得
-                        exercise_sessions.exercise_id, 
-                        exercise_sessions.value, 
-                        exercises.value_type,
-                        exercises.name, 
-                        exercise_categories.name  -- カテゴリ名も取得
-                    FROM exercise_sessions
-                    JOIN exercises ON exercise_sessions.exercise_id = exercises.id
-                    JOIN exercise_categories ON exercises.category_id = exercise_categories.id
-                    WHERE exercise_sessions.id = ?
-                """, (log_id,))
-                log = cursor.fetchone()
-
-                # データが取得できなかった場合のエラーハンドリング
-                if log is None:
-                    flash("指定された記録が見つかりません。", "error")
-                    return redirect('/exercise_log')
-
-                # 運動メニューのリストを取得
-                cursor.execute("""
-                    SELECT exercises.id, exercises.name, exercise_categories.name
-                    FROM exercises
-                    JOIN exercise_categories ON exercises.category_id = exercise_categories.id
-                """)
-                exercises = cursor.fetchall()
+        if request.method == 'POST':
+            new_date = request.form['record_date']
+            new_exercise_id = request.form['exercise_id']
+            new_value = request.form.get('value', type=int)
+            if new_value is None:
+                return "値の指定が正しくありません。", 400
+
+            # 保管した記録は元のテーブルに戻してから編集する
+            with transaction(immediate=True):
+                update_exercise_log(log_id, new_date, new_exercise_id, new_value)
+
+            return redirect('/exercise_log')
+
+        # 編集する記録を取得（記録日は YYYY-MM-DD 形式）
+        log = get_exercise_log(log_id)
+
+        # データが取得できなかった場合のエラーハンドリング
+        if log is None:
+            flash("指定された記録が見つかりません。", "error")
+            return redirect('/exercise_log')
+
+        # 運動メニューのリストを取得
+        exercises = get_all_exercises()
 
         return render_template("edit_exercise_log.html", log=log, exercises=exercises)
 
     @app.route('/edit_exercise_category/<int:category_id>', methods=['GET', 'POST'])
     def edit_exercise_category(category_id):
         """運動カテゴリの編集"""
-        with sqlite3.connect("study.db") as conn:
-            cursor = conn.cursor()
-            if request.method == 'POST':
-                new_name = request.form['name']
-                cursor.execute("UPDATE exercise_categories SET name = ? WHERE id = ?", (new_name, category_id))
-                conn.commit()
-                return redirect('/exercise_categories')
-            else:
-                cursor.execute("SELECT id, name FROM exercise_categories WHERE id = ?", (category_id,))
-                category = cursor.fetchone()
+        if request.method == 'POST':
+            new_name = request.form['name']
+            update_exercise_category(category_id, new_name)
+            invalidate_reference_cache()
+            return redirect('/exercise_categories')
+        category = get_exercise_category(category_id)
         return render_template("edit_exercise_category.html", category=category)
 
     @app.route('/delete_exercise_category/<int:category_id>', methods=['POST'])
-    def delete_exercise_category(category_id):
+    def delete_exercise_category_route(category_id):
         """運動カテゴリの削除（カテゴリを使用しているメニューがある場合は削除不可）"""
-        with sqlite3.connect("study.db") as conn:
-            cursor = conn.cursor()
-            # 関連する運動メニューがあるか確認
-            cursor.execute("SELECT COUNT(*) FROM exercises WHERE category_id = ?", (category_id,))
-            count = cursor.fetchone()[0]
-
-            if count > 0:
-                flash("このカテゴリを使用している運動メニューがあるため削除できません。", "error")
-            else:
-                cursor.execute("DELETE FROM exercise_categories WHERE id = ?", (category_id,))
-                conn.commit()
+        if not delete_exercise_category(category_id):
+            flash("このカテゴリを使用している運動メニューがあるため削除できません。", "error")
+        invalidate_reference_cache()
 
         return redirect('/exercise_categories')
 
     @app.route('/edit_exercise/<int:exercise_id>', methods=['GET', 'POST'])
     def edit_exercise(exercise_id):
         """運動メニューの編集"""
-        with sqlite3.connect("study.db") as conn:
-            cursor = conn.cursor()
-            if request.method == 'POST':
-                new_name = request.form['name']
-                category_id = request.form['category_id']
-                value_type = request.form['value_type']
-                cursor.execute("UPDATE exercises SET name = ?, category_id = ?, value_type = ? WHERE id = ?", 
-                            (new_name, category_id, value_type, exercise_id))
-                conn.commit()
-                return redirect('/exercises')
-            else:
-                cursor.execute("SELECT id, name, category_id, value_type FROM exercises WHERE id = ?", (exercise_id,))
-                exercise = cursor.fetchone()
-
-                cursor.execute("SELECT id, name FROM exercise_categories")
-                categories = cursor.fetchall()
+        if request.method == 'POST':
+            new_name = request.form['name']
+            category_id = request.form['category_id']
+            value_type = request.form['value_type']
+            update_exercise(exercise_id, new_name, category_id, value_type)
+            invalidate_reference_cache()
+            return redirect('/exercises')
+        exercise = get_exercise(exercise_id)
+        categories = get_all_exercise_categories()
 
         return render_template("edit_exercise.html", exercise=exercise, categories=categories)
 
     @app.route('/delete_exercise/<int:exercise_id>', methods=['POST'])
-    def delete_exercise(exercise_id):
+    def delete_exercise_route(exercise_id):
         """運動メニューの削除（このメニューを記録しているセッションがある場合は削除不可）"""
-        with sqlite3.connect("study.db") as conn:
-            cursor = conn.cursor()
-            # 関連するセッションがあるか確認
-            cursor.execute("SELECT COUNT(*) FROM exercise_sessions WHERE exercise_id = ?", (exercise_id,))
-            count = cursor.fetchone()[0]
-
-            if count > 0:
-                flash("この運動メニューを使用している記録があるため削除できません。", "error")
-            else:
-                cursor.execute("DELETE FROM exercises WHERE id = ?", (exercise_id,))
-                conn.commit()
+        if not delete_exercise(exercise_id):
+            flash("この運動メニューを使用している記録があるため削除できません。", "error")
+        invalidate_reference_cache()
 
         return redirect('/exercises')
\ No newline at end of file
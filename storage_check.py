@@ -0,0 +1,351 @@
+# storage_check.py
+"""
+database.py の読み書きが、設定したデータベース（SQLite / PostgreSQL）で同じように動くか確認する
+- 空のデータベースに移行し、カテゴリ・教材・トランザクション・セッション・運動の記録・保管・集計・目標を順に操作して結果を確かめる
+- 引数を省略すると一時的な SQLite のファイルで確認する
+- PostgreSQL では空のデータベースを指定する（確認用のデータを書き込むため、データがあれば中止する）
+
+使い方:
+    python storage_check.py
+    python storage_check.py postgresql://user@localhost/study_check
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import archive
+import db
+import goals
+import rollup
+from backends import redact
+from cache import read_data_version, read_meta
+from database import (
+    add_category,
+    add_exercise,
+    add_exercise_category,
+    add_exercise_log,
+    add_material,
+    delete_category,
+    delete_exercise,
+    delete_exercise_category,
+    delete_material,
+    delete_session,
+    get_category_list,
+    get_category_totals,
+    get_exercise,
+    get_exercise_log,
+    get_exercise_logs_page,
+    get_material_presence_stats,
+    get_material_totals,
+    get_ongoing_session,
+    get_recent_exercise_logs,
+    get_session_contribution,
+    get_sessions,
+    get_sessions_page,
+    get_study_time_buckets,
+    init_db,
+    iter_sessions,
+    start_session,
+    stop_session,
+    update_category,
+    update_exercise,
+    update_exercise_log,
+    update_material,
+    update_session,
+)
+from migrations import LATEST_VERSION, get_version
+
+
+class CheckFailed(Exception):
+    pass
+
+
+def expect(condition, message):
+    if not condition:
+        raise CheckFailed(message)
+
+
+def _id_by_name(rows, name):
+    return next(row[0] for row in rows if row[1] == name)
+
+
+def check_schema(state):
+    init_db()
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        expect(get_version(cursor) == LATEST_VERSION, "スキーマが最新のバージョンになっていません")
+        cursor.execute('SELECT COUNT(*) FROM categories')
+        if cursor.fetchone()[0]:
+            raise SystemExit("データがあるデータベースです。空のデータベースを指定してください。")
+
+
+def check_reference_data(state):
+    version = read_meta('reference_version')
+    add_category("数学")
+    add_category("英語")
+    categories = get_category_list()
+    expect(sorted(row[1] for row in categories) == ["数学", "英語"], f"カテゴリの一覧が違います: {categories}")
+    expect(read_meta('reference_version') > version, "reference_version が増えていません")
+
+    math_id = _id_by_name(categories, "数学")
+    english_id = _id_by_name(categories, "英語")
+    update_category(english_id, "English", False)
+    expect((english_id, "English", 0) in get_category_list(), "カテゴリを更新できません")
+
+    add_material("線形代数", math_id, "linear")
+    add_material("単語帳", english_id)
+    with db.connect() as conn:
+        materials = conn.execute('SELECT id, name, discord_image_key FROM materials ORDER BY id').fetchall()
+    expect([tuple(row[1:]) for row in materials] == [("線形代数", "linear"), ("単語帳", "")], f"教材が違います: {materials}")
+    update_material(materials[1][0], "単語帳2", english_id, "words", True)
+    expect(get_material_presence_stats(materials[1][0])["image_key"] == "words", "教材を更新できません")
+    state.update(category_id=math_id, material_id=materials[0][0], other_material_id=materials[1][0])
+
+
+def check_transactions(state):
+    # 例外で抜けたブロックの書き込み（暗黙に始めたトランザクション）は取り消す
+    try:
+        with db.connect():
+            add_category("取り消すカテゴリ")
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    expect("取り消すカテゴリ" not in [row[1] for row in get_category_list()], "例外で抜けた書き込みが取り消されていません")
+
+    # :name のプレースホルダー（文字列の中の ? / : / % はそのまま）
+    with db.connect() as conn:
+        row = conn.execute(
+            "SELECT COUNT(*) FROM categories WHERE name LIKE :pattern AND name <> '?:name%'", {"pattern": "数%"}
+        ).fetchone()
+    expect(row[0] == 1, f"名前付きのプレースホルダーの結果が違います: {row}")
+
+    # 書き込むトランザクション（BEGIN IMMEDIATE）は1つずつ実行する
+    order = []
+    locked = threading.Event()
+
+    def first():
+        with db.transaction(immediate=True):
+            locked.set()
+            time.sleep(0.3)
+            order.append("first")
+
+    def second():
+        locked.wait()
+        with db.transaction(immediate=True):
+            order.append("second")
+
+    threads = [threading.Thread(target=first), threading.Thread(target=second)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    expect(order == ["first", "second"], f"書き込むトランザクションが同時に実行されました: {order}")
+
+
+def check_sessions(state):
+    math_id, material_id = state["category_id"], state["material_id"]
+    version, _ = read_data_version()
+    with db.transaction(immediate=True):
+        session_id = start_session(material_id)
+    ongoing = get_ongoing_session()
+    expect(ongoing is not None and ongoing[0] == session_id, "進行中のセッションが見つかりません")
+    expect(read_data_version()[0] > version, "data_version が増えていません")
+
+    try:
+        with db.transaction(immediate=True):
+            start_session(state["other_material_id"])
+    except db.dialect().integrity_errors as error:
+        expect(db.dialect().violates(error, 'idx_sessions_single_open'), f"別の制約の違反です: {error}")
+    else:
+        raise CheckFailed("進行中のセッションが2件作られました")
+
+    with db.transaction(immediate=True):
+        expect(stop_session() == session_id, "セッションを終了できません")
+    expect(get_ongoing_session() is None, "セッションが終了していません")
+
+    # 1時間半のセッション（日付をまたぐ）に書き換える
+    start = datetime.now().replace(hour=23, minute=0, second=0, microsecond=0) - timedelta(days=3)
+    with db.transaction(immediate=True):
+        update_session(session_id, material_id, start, start + timedelta(minutes=90))
+    contribution = get_session_contribution(session_id)
+    expect(contribution is not None and abs(contribution[2] - 90) < 1e-6, f"セッションの時間が違います: {contribution}")
+    expect(dict(get_material_totals()).get("線形代数") == 90, f"教材の累計が違います: {get_material_totals()}")
+    expect(dict(get_category_totals()).get("数学") == 90, f"カテゴリの累計が違います: {get_category_totals()}")
+
+    buckets = get_study_time_buckets(start - timedelta(days=1), start + timedelta(days=2), bucket="day")
+    expect(
+        [(label, round(minutes)) for label, _, _, minutes in buckets]
+        == [(start.strftime('%Y-%m-%d'), 60), ((start + timedelta(days=1)).strftime('%Y-%m-%d'), 30)],
+        f"日ごとの集計が違います: {buckets}",
+    )
+    weekly = get_study_time_buckets(start - timedelta(days=1), start + timedelta(days=2), bucket="week", group="category")
+    monday = (start - timedelta(days=start.weekday())).strftime('%Y-%m-%d')
+    expect(all(row[2] == "数学" for row in weekly), f"カテゴリごとの集計が違います: {weekly}")
+    expect(weekly[0][0] == monday, f"週の区切りが違います: {weekly}")
+
+    expect(not delete_material(material_id), "セッションのある教材を削除できてしまいます")
+    expect(not delete_category(math_id), "教材のあるカテゴリを削除できてしまいます")
+    state["session_id"] = session_id
+
+
+def check_archive(state):
+    material_id, session_id = state["material_id"], state["session_id"]
+    # 保管の対象になる古いセッションと、保管されない最新のセッション
+    old_start = datetime.now() - timedelta(days=400)
+    with db.transaction(immediate=True):
+        old_id = start_session(material_id)
+        update_session(old_id, material_id, old_start, old_start + timedelta(minutes=30))
+        newest_id = start_session(material_id)
+        stop_session()
+    totals = dict(get_material_totals())
+
+    moved_sessions, _ = archive.archive_old_records(days=365)
+    expect(moved_sessions == 1, f"保管したセッション数が違います: {moved_sessions}")
+    expect(archive.counts()["sessions_archive"] == 1, "保管用のテーブルにセッションがありません")
+    expect(dict(get_material_totals()) == totals, "保管すると累計が変わります")
+    rows, _ = get_sessions_page(datetime.now() + timedelta(days=1), limit=10)
+    expect([row[0] for row in rows] == [newest_id, session_id, old_id], f"履歴に保管したセッションが含まれません: {rows}")
+    expect(get_sessions(session_id=old_id)[0] == old_id, "保管したセッションを ID で取得できません")
+    exported = [row[0] for row in iter_sessions(batch_size=1)]
+    expect(exported == [old_id, session_id, newest_id], f"エクスポートの順番が違います: {exported}")
+
+    # 保管したセッションを編集すると元のテーブルに戻る
+    with db.transaction(immediate=True):
+        update_session(old_id, material_id, old_start, old_start + timedelta(minutes=45))
+    expect(archive.counts()["sessions_archive"] == 0, "編集したセッションが保管用のテーブルに残っています")
+    with db.transaction(immediate=True):
+        delete_session(newest_id)
+    expect(get_sessions(session_id=newest_id) is None, "セッションを削除できません")
+    with db.connect() as conn:
+        mismatches = rollup.verify(conn.cursor())
+    expect(not mismatches, f"集計テーブルが一致しません: {mismatches}")
+
+
+def check_exercises(state):
+    add_exercise_category("脚")
+    add_exercise_category("腕")
+    with db.connect() as conn:
+        categories = conn.execute('SELECT id, name FROM exercise_categories ORDER BY id').fetchall()
+    legs_id = _id_by_name(categories, "脚")
+    arms_id = _id_by_name(categories, "腕")
+    add_exercise("スクワット", legs_id, "reps")
+    with db.connect() as conn:
+        exercise_id = conn.execute('SELECT id FROM exercises').fetchone()[0]
+    update_exercise(exercise_id, "スクワット", legs_id, "reps")
+    expect(get_exercise(exercise_id)[1:] == ("スクワット", legs_id, "reps"), "運動メニューを更新できません")
+
+    add_exercise_log(exercise_id, 20, "reps")
+    add_exercise_log(exercise_id, 30, "reps")
+    recent = get_recent_exercise_logs(days=7)
+    expect(len(recent) == 2 and recent[0][2] == "スクワット", f"直近の運動記録が違います: {recent}")
+    logs, next_cursor = get_exercise_logs_page(exercise_id=exercise_id, limit=1)
+    expect(len(logs) == 1 and next_cursor is not None, f"運動記録のページ送りが違います: {logs}")
+    expect(logs[0][6] == 50, f"その日の合計が違います: {logs}")
+
+    log_id = logs[0][5]
+    with db.transaction(immediate=True):
+        update_exercise_log(log_id, "2020-01-02 00:00:00", exercise_id, 25)
+    log = get_exercise_log(log_id)
+    expect(log is not None and log[1] == "2020-01-02" and log[3] == 25, f"運動記録を更新できません: {log}")
+    # 集計テーブルの日付は UTC の記録時刻のローカル時刻の日付
+    local_day = datetime(2020, 1, 2, tzinfo=timezone.utc).astimezone().strftime('%Y-%m-%d')
+    with db.connect() as conn:
+        days = conn.execute('SELECT day FROM daily_exercise_totals WHERE total_value = 25').fetchall()
+    expect(days == [(local_day,)], f"運動の集計の日付が違います: {days}（{local_day} のはず）")
+
+    expect(not delete_exercise_category(legs_id), "運動メニューのある部位カテゴリを削除できてしまいます")
+    expect(delete_exercise_category(arms_id), "部位カテゴリを削除できません")
+    expect(not delete_exercise(exercise_id), "記録のある運動メニューを削除できてしまいます")
+    state["exercise_id"] = exercise_id
+
+
+def check_goals(state):
+    material_id, category_id = state["material_id"], state["category_id"]
+    # 昨日と一昨日に1時間ずつ勉強した（今日はまだ。3日前は check_sessions の1時間半）
+    today = datetime.now().replace(hour=10, minute=0, second=0, microsecond=0)
+    with db.transaction(immediate=True):
+        for days_ago in (1, 2):
+            session_id = start_session(material_id)
+            stop_session()
+            start = today - timedelta(days=days_ago)
+            update_session(session_id, material_id, start, start + timedelta(minutes=60))
+    goals.add_goal("material", material_id, "day", 60)
+    goals.add_goal("category", category_id, "week", 100000)
+    goals.add_goal("exercise", state["exercise_id"], "day", 1)
+
+    statuses = {status["scope"]: status for status in goals.goal_statuses(tuple(goals.SCOPES))}
+    material = statuses["教材"]
+    expect(not material["achieved"] and material["streak"] == 3, f"教材の目標の状況が違います: {material}")
+    category = statuses["カテゴリ"]
+    expect(not category["on_track"] and category["completion_day"] is None, f"カテゴリの目標の見込みが違います: {category}")
+    exercise = statuses["運動メニュー"]
+    expect(exercise["achieved"] and exercise["streak"] == 1, f"運動の目標の状況が違います: {exercise}")
+
+    # 目標の対象を削除すると目標も削除する
+    add_material("削除する教材", category_id)
+    with db.connect() as conn:
+        other_id = conn.execute('SELECT MAX(id) FROM materials').fetchone()[0]
+    goals.add_goal("material", other_id, "week", 30)
+    expect(delete_material(other_id), "教材を削除できません")
+    expect(len(goals.get_goals()) == 3, f"削除した教材の目標が残っています: {goals.get_goals()}")
+    with db.connect() as conn:
+        mismatches = rollup.verify(conn.cursor())
+    expect(not mismatches, f"集計テーブルが一致しません: {mismatches}")
+
+
+# (名前, 確認, 失敗したら後の確認をやめるか（後の確認がここで作ったデータを使う場合）)
+CHECKS = (
+    ("スキーマ", check_schema, True),
+    ("カテゴリ・教材", check_reference_data, True),
+    ("トランザクション", check_transactions, False),
+    ("セッション・集計", check_sessions, True),
+    ("保管", check_archive, False),
+    ("運動の記録", check_exercises, False),
+    ("目標", check_goals, False),
+)
+
+
+def run_checks():
+    """すべての確認を順に実行する。:return: 失敗した確認の数"""
+    failures = 0
+    state = {}  # 前の確認で作った ID
+    for name, check, required in CHECKS:
+        started = time.perf_counter()
+        try:
+            check(state)
+        except CheckFailed as e:
+            failures += 1
+            print(f"NG {name}: {e}")
+            if required:
+                break
+            continue
+        print(f"OK {name}（{(time.perf_counter() - started) * 1000:.0f} ms）")
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="データベースの読み書きが同じように動くか確認する")
+    parser.add_argument("database", nargs="?", help="PostgreSQL の URL または SQLite のファイル（省略すると一時ファイル）")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.database or os.path.join(tmp, "storage_check.db")
+        db.configure(path=path)
+        print(f"確認するデータベース: {redact(path)}（{db.dialect().name}）")
+        try:
+            failures = run_checks()
+        finally:
+            db.configure()
+    if failures:
+        print(f"{failures} 件の確認に失敗しました。")
+        return 1
+    print("すべての確認に成功しました。")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,22 @@
 # utils.py
 from datetime import datetime
 
+def to_epoch(value):
+    """datetime または ISO 形式の文字列をエポック秒（整数）に変換（空の場合は None）"""
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return int(value.timestamp())
+
+def from_epoch(value):
+    """エポック秒を datetime（ローカル時刻）に変換（移行前の ISO 形式の文字列も受け付ける）"""
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return datetime.fromtimestamp(value)
+
 def format_duration(minutes):
     """分を時間:分の形式にフォーマット"""
     hours = int(minutes // 60)
@@ -9,25 +25,54 @@ def format_duration(minutes):
 
 def format_start_time(start_time):
     """開始時刻を hh時mm分 の形式にフォーマット"""
-    start = datetime.fromisoformat(start_time)
+    start = from_epoch(start_time)
     return start.strftime("%H時%M分")
 
 def format_start_date(start_time):
     """開始時刻を yyyy年mm月dd日 の形式にフォーマット"""
-    start = datetime.fromisoformat(start_time)
+    start = from_epoch(start_time)
     return start.strftime("%Y年%m月%d日")
 
 def format_end_time(end_time):
     """終了時刻を hh時mm分 の形式にフォーマット"""
-    if end_time:
-        end = datetime.fromisoformat(end_time)
+    if end_time is not None:
+        end = from_epoch(end_time)
         return end.strftime("%H時%M分")
     return "未終了"
 
+def format_sessions(sessions):
+    """
+    セッションの行 (id, 教材名, 開始時刻, 終了時刻) のリストを表示用の
+    (開始日, 教材名, 開始時刻, 終了時刻, 時間, id) のリストにまとめて変換する
+    - 各時刻は1回だけ datetime に変換する
+    - 開始日の文字列は日ごとに使い回す（同じ日のセッションが続くため）
+    """
+    date_strings = {}
+    enriched = []
+    append = enriched.append
+    for session_id, material_name, start_time, end_time in sessions:
+        start = from_epoch(start_time)
+        day = (start.year, start.month, start.day)
+        start_date = date_strings.get(day)
+        if start_date is None:
+            start_date = date_strings[day] = f"{start.year:04d}年{start.month:02d}月{start.day:02d}日"
+        formatted_start_time = f"{start.hour:02d}時{start.minute:02d}分"
+
+        if end_time is not None:
+            end = from_epoch(end_time)
+            formatted_end_time = f"{end.hour:02d}時{end.minute:02d}分"
+            duration = format_duration((end_time - start_time) / 60)
+        else:
+            formatted_end_time = "未終了"
+            duration = "進行中"
+
+        append((start_date, material_name, formatted_start_time, formatted_end_time, duration, session_id))
+    return enriched
+
 def format_datetime_for_input(dt_string):
     """Datetimeをinput[type=datetime-local]形式に変換"""
-    if dt_string:
-        dt = datetime.fromisoformat(dt_string)
+    if dt_string is not None:
+        dt = from_epoch(dt_string)
         return dt.strftime('%Y-%m-%dT%H:%M')
     return None
 
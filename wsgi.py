@@ -0,0 +1,13 @@
+# wsgi.py
+"""
+本番環境用のエントリーポイント（WSGI サーバーから読み込む）
+
+    gunicorn --workers 4 wsgi:app
+
+- 複数のワーカーが同じ SQLite ファイルを共有できる（WAL・busy_timeout・書き込みは BEGIN IMMEDIATE）
+- 秘密鍵は STUDY_SECRET_KEY または instance/secret_key から読み込むので、ワーカー間でセッションが共有される
+- --preload で fork 前に読み込んでも、接続・Discord の送信スレッドは子プロセスで作り直される
+"""
+from app import create_app
+
+app = create_app()